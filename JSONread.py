@@ -1,6 +1,8 @@
 """tools to deal with brain hierarchy from the AIBS"""
 import numpy as np
 
+from annotate_cerebellum.hierarchy import BrainHierarchy, RegionNameIndex, hex_to_rgb
+
 id_to_region_dictionary = {}  # id to region name
 id_to_region_dictionary_ALLNAME = {}  # id to complete name
 region_dictionary_to_id = {}  # name to id
@@ -18,6 +20,8 @@ id_to_color = {}  # region id to color in RGB
 region_to_color = {}  # complete name to color in RGB
 id_to_abv = {}
 region_dictionary_to_abv = {}
+hierarchy = None  # BrainHierarchy index of the regions
+name_index = None  # RegionNameIndex of the complete names
 
 
 def find_unique_regions(annotation,
@@ -25,7 +29,8 @@ def find_unique_regions(annotation,
                         region_dictionary_to_id_ALLNAME,
                         region_dictionary_to_id_ALLNAME_parent,
                         name2allname,
-                        top_region_name="Basic cell groups and regions"):
+                        top_region_name="Basic cell groups and regions",
+                        histogram=None):
     """
     Finds unique regions ids that are present in an annotation file
     and are contained in the top_region_name
@@ -33,13 +38,16 @@ def find_unique_regions(annotation,
     Dictionaries parameters correspond to the ones produced in JSONread
 
     Parameters:
-        annotation: 3D numpy ndarray of integers ids of the regions
+        annotation: 3D numpy ndarray of integers ids of the regions. Not used if histogram is
+        provided.
         id_to_region_dictionary_ALLNAME: dictionary from region id to region complete name
         region_dictionary_to_id_ALLNAME: dictionary from region complete name to region id
         region_dictionary_to_id_ALLNAME_parent: dictionary from region complete name
         to its parent complete name
         name2allname: dictionary from region name to region complete name
         top_region_name: name of the most broader region included in the uniques
+        histogram: tuple of the sorted region ids present in the annotation and their voxel
+        counts, as returned by annotate_cerebellum.utils.load_label_histogram.
 
     Returns:
         List of unique regions id in the annotation file that are included in top_region_name
@@ -47,15 +55,19 @@ def find_unique_regions(annotation,
 
     # Take the parent of the top region to stop the loop
     root_allname = region_dictionary_to_id_ALLNAME_parent[name2allname[top_region_name]]
+    present_ids = np.unique(annotation) if histogram is None else histogram[0]
     uniques = []
-    for uniq in np.unique(annotation)[1:]:  # Cell regions without outside
+    found = set()
+    for uniq in present_ids[1:]:  # Cell regions without outside
         allname = id_to_region_dictionary_ALLNAME[uniq]
-        if top_region_name in id_to_region_dictionary_ALLNAME[uniq] and uniq not in uniques:
+        if top_region_name in id_to_region_dictionary_ALLNAME[uniq] and uniq not in found:
             uniques.append(uniq)
+            found.add(uniq)
             parent_allname = region_dictionary_to_id_ALLNAME_parent[allname]
             id_parent = region_dictionary_to_id_ALLNAME[parent_allname]
-            while id_parent not in uniques and parent_allname != root_allname:
+            while id_parent not in found and parent_allname != root_allname:
                 uniques.append(id_parent)
+                found.add(id_parent)
                 parent_allname = region_dictionary_to_id_ALLNAME_parent[parent_allname]
                 if parent_allname == "":
                     break
@@ -64,6 +76,37 @@ def find_unique_regions(annotation,
     return np.array(uniques)
 
 
+def region_voxel_counts(histogram, id_to_region_dictionary_ALLNAME,
+                        region_dictionary_to_id_ALLNAME_parent,
+                        region_dictionary_to_id_ALLNAME):
+    """
+    Computes the number of voxels of each region, including the voxels of its subregions.
+    Dictionaries parameters correspond to the ones produced in JSONread
+
+    Parameters:
+        histogram: tuple of the sorted region ids present in the annotation and their voxel
+        counts, as returned by annotate_cerebellum.utils.load_label_histogram.
+        id_to_region_dictionary_ALLNAME: dictionary from region id to region complete name
+        region_dictionary_to_id_ALLNAME_parent: dictionary from region complete name
+        to its parent complete name
+        region_dictionary_to_id_ALLNAME: dictionary from region complete name to region id
+
+    Returns:
+        Dictionary of region id to its number of voxels. Regions without voxels are not listed.
+    """
+    counts = {}
+    for id_reg, count in zip(np.asarray(histogram[0]).tolist(),
+                             np.asarray(histogram[1]).tolist()):
+        if id_reg not in id_to_region_dictionary_ALLNAME:
+            continue
+        allname = id_to_region_dictionary_ALLNAME[id_reg]
+        while allname != '':
+            id_parent = region_dictionary_to_id_ALLNAME[allname]
+            counts[id_parent] = counts.get(id_parent, 0) + count
+            allname = region_dictionary_to_id_ALLNAME_parent[allname]
+    return counts
+
+
 def find_children(uniques, id_to_region_dictionary_ALLNAME, is_leaf,
                   region_dictionary_to_id_ALLNAME_parent,
                   region_dictionary_to_id_ALLNAME):
@@ -87,28 +130,44 @@ def find_children(uniques, id_to_region_dictionary_ALLNAME, is_leaf,
          List of distances from a leaf region in the hierarchy tree for each region in uniques.
     """
 
-    children = {}
-    order_ = np.zeros(uniques.shape)
-    for id_reg, allname in id_to_region_dictionary_ALLNAME.items():
-        if is_leaf[allname]:
-            inc = 0
-            ids_reg = [id_reg]
-            parentname = region_dictionary_to_id_ALLNAME_parent[allname]
-            while parentname != '':
-                if parentname not in children:
-                    children[parentname] = []
-                children[parentname] += ids_reg
-                inc += 1
-                id_parent = region_dictionary_to_id_ALLNAME[parentname]
-                if id_parent in uniques:
-                    ids_reg.append(id_parent)
-                    place_ = np.where(uniques == id_parent)
-                    order_[place_] = max(order_[place_], inc)
-                allname = parentname
-                parentname = region_dictionary_to_id_ALLNAME_parent[allname]
-
-    for parent, child in children.items():
-        children[parent] = np.unique(child)
+    # Tree structure from the parent dictionary
+    sub_regions = {}
+    for allname in id_to_region_dictionary_ALLNAME.values():
+        parentname = region_dictionary_to_id_ALLNAME_parent[allname]
+        if parentname != '':
+            sub_regions.setdefault(parentname, []).append(allname)
+
+    # Post-order traversal: each region gathers the ids of its sub-regions which are either
+    # leaves or present in uniques, and its distance from the deepest leaf below it.
+    uniques_set = set(np.asarray(uniques).tolist())
+    descendants = {}
+    height = {}
+    stack = [(allname, False) for allname in sub_regions
+             if region_dictionary_to_id_ALLNAME_parent[allname] not in sub_regions]
+    while len(stack) > 0:
+        allname, explored = stack.pop()
+        if not explored:
+            stack.append((allname, True))
+            stack.extend((child, False) for child in sub_regions.get(allname, []))
+            continue
+        height[allname] = 0
+        if allname not in sub_regions:
+            continue
+        ids_reg = []
+        for child in sub_regions[allname]:
+            height[allname] = max(height[allname], height[child] + 1)
+            id_child = region_dictionary_to_id_ALLNAME[child]
+            if is_leaf[child] or id_child in uniques_set:
+                ids_reg.append([id_child])
+            if child in descendants:
+                ids_reg.append(descendants[child])
+        descendants[allname] = np.concatenate(ids_reg)
+
+    children = {allname: np.unique(ids_reg) for allname, ids_reg in descendants.items()}
+    id_to_height = {region_dictionary_to_id_ALLNAME[allname]: value
+                    for allname, value in height.items()}
+    order_ = np.array([id_to_height.get(id_reg, 0) for id_reg in np.asarray(uniques).tolist()],
+                      dtype=float).reshape(uniques.shape)
     return children, order_
 
 
@@ -130,14 +189,70 @@ def filter_region(annotation, allname, children,
         3d numpy ndarray of boolean, boolean mask with all the voxels of a region
         and its children set to True.
     """
-    if not is_leaf[allname]:
-        filter_ = np.in1d(annotation,
-                          np.concatenate((children[allname],
-                                          [region_dictionary_to_id_ALLNAME[allname]]))
-                          ).reshape(annotation.shape)
+    return filter_regions(annotation, [allname], children, is_leaf,
+                          region_dictionary_to_id_ALLNAME)[allname]
+
+
+def filter_regions(annotation, allnames, children, is_leaf, region_dictionary_to_id_ALLNAME,
+                   as_bitfield=False, slab_size=16):
+    """
+    Computes the 3d boolean masks of several regions and their subregions in a single pass over
+    the annotations. A lookup table from region id to a bitfield of the regions containing it is
+    built from the hierarchy, and the annotation volume is processed slab by slab along its
+    first axis to bound the memory used.
+    Dictionaries parameters correspond to the ones produced in JSONread.
+
+    Parameters:
+        annotation: 3D numpy ndarray of integers ids of the regions
+        allnames: List of complete names of the regions (at most 64 regions)
+        children: Dictionary of region complete name to list of child region ids
+        is_leaf: dictionary from region complete name to boolean,
+        True if the region is a leaf region.
+        region_dictionary_to_id_ALLNAME: dictionary from region complete name to region id
+        as_bitfield: if True, returns a single volume of unsigned integers in which the bit i
+        is set for the voxels belonging to the region allnames[i].
+        slab_size: number of planes of the annotation volume processed at once.
+
+    Returns:
+        Dictionary of region complete name to 3d numpy ndarray of boolean, boolean mask with all
+        the voxels of a region and its children set to True, or the bitfield volume if
+        as_bitfield is True.
+    """
+    if len(allnames) > 64:
+        raise Exception("At most 64 regions can be filtered at once.")
+    bit_type = np.min_scalar_type((1 << len(allnames)) - 1 if len(allnames) > 0 else 0)
+    if bit_type.kind != "u":
+        bit_type = np.dtype(np.uint8)
+    region_ids = []
+    for allname in allnames:
+        ids_reg = [region_dictionary_to_id_ALLNAME[allname]]
+        if not is_leaf[allname]:
+            ids_reg = np.concatenate((children[allname], ids_reg))
+        region_ids.append(np.asarray(ids_reg, dtype=annotation.dtype))
+    keys = np.unique(np.concatenate(region_ids)) if len(region_ids) > 0 \
+        else np.zeros(0, dtype=annotation.dtype)
+    table = np.zeros(len(keys) + 1, dtype=bit_type)  # last entry for ids outside the regions
+    for i, ids_reg in enumerate(region_ids):
+        table[np.searchsorted(keys, ids_reg)] |= bit_type.type(1 << i)
+
+    if as_bitfield:
+        result = np.zeros(annotation.shape, dtype=bit_type)
     else:
-        filter_ = annotation == region_dictionary_to_id_ALLNAME[allname]
-    return filter_
+        result = {allname: np.zeros(annotation.shape, dtype=bool) for allname in allnames}
+    if len(keys) == 0:
+        # No region to filter: empty dictionary or zero bitfield
+        return result
+    for start in range(0, annotation.shape[0], slab_size):
+        slab = annotation[start:start + slab_size]
+        positions = np.searchsorted(keys, slab)
+        positions[keys[np.minimum(positions, len(keys) - 1)] != slab] = len(keys)
+        bits = table[positions]
+        if as_bitfield:
+            result[start:start + slab_size] = bits
+        else:
+            for i, allname in enumerate(allnames):
+                result[allname][start:start + slab_size] = (bits & bit_type.type(1 << i)) != 0
+    return result
 
 
 def return_ids_containing_str_list(str_list, force_leaf=False):
@@ -150,35 +265,34 @@ def return_ids_containing_str_list(str_list, force_leaf=False):
         List of region id matching condition
     """
 
-    id_list = []
-    for kk in id_to_region_dictionary_ALLNAME:
-        region_is_in = True
-        allname = id_to_region_dictionary_ALLNAME[kk]
-        if force_leaf and not is_leaf[allname]:
-            continue
-        for str1 in str_list:
-            if (allname.lower()).find(str1.lower(
-            )) < 0:  # if any of the regions is not there, do not take
-                region_is_in = False
-                break
-        if region_is_in:
-            id_list.append(kk)
-    return id_list
+    return get_name_index().query(str_list, force_leaf)
 
 
-def hex_to_rgb(value):
+def return_ids_starting_with(text, force_leaf=False):
     """
-    Converts a Hexadecimal color into its RGB value counterpart.
+    Retrieve the list of region id which complete name contains words starting with each word of
+    text. Used for interactive region search.
 
     Arguments:
-        value: string hexadecimal color to convert.
+        text: words or beginnings of words to search.
     Returns:
-        List of the Red, Green, and Blue components of the color
+        List of region id matching condition
     """
 
-    value = value.lstrip('#')
-    lv = len(value)
-    return tuple(int(value[i:i + lv // 3], 16) for i in range(0, lv, lv // 3))
+    return get_name_index().prefix_query(text, force_leaf)
+
+
+def get_name_index():
+    """
+    Returns the keyword index of the complete names of the regions, built on first use and
+    rebuilt when the regions dictionaries have changed.
+    """
+    global name_index
+    if name_index is None or len(name_index) != len(id_to_region_dictionary_ALLNAME):
+        name_index = RegionNameIndex(
+            id_to_region_dictionary_ALLNAME.keys(), id_to_region_dictionary_ALLNAME.values(),
+            [is_leaf[allname] for allname in id_to_region_dictionary_ALLNAME.values()])
+    return name_index
 
 
 def rgb2hex(rgb):
@@ -191,6 +305,8 @@ def search_children(object_,
                     darken=True):
     """
     Explores the hierarchy dictionary to extract its brain regions and fills external dictionaries.
+    The hierarchy is indexed in a BrainHierarchy object (see get_hierarchy) and the external
+    dictionaries are filled from this index.
     Arguments
         object_: dictionary of regions properties. See
         https://bbpteam.epfl.ch/documentation/projects/voxcell/latest/atlas.html#brain-region-hierarchy
@@ -198,39 +314,48 @@ def search_children(object_,
         lastname: name of the parent of the current brain region
         darken: if True, darkens the region colors too high
     """
+    global hierarchy
+    hierarchy = BrainHierarchy.from_dict(object_, darken, lastname_ALL, lastname)
+    fill_dictionaries(hierarchy)
+
+
+def load_hierarchy(hierarchy_filename, darken=True):
+    """
+    Loads the AIBS json hierarchy file and fills external dictionaries.
+    The parsed hierarchy is cached in a binary file next to the json file and reloaded from it
+    while the json file content does not change.
+    Arguments
+        hierarchy_filename: path to the AIBS json hierarchy file
+        darken: if True, darkens the region colors too high
+    """
+    global hierarchy
+    hierarchy = BrainHierarchy.from_json(hierarchy_filename, darken)
+    fill_dictionaries(hierarchy)
+
+
+def fill_dictionaries(brain_hierarchy):
+    """
+    Fills the external dictionaries with the regions of a BrainHierarchy index.
+    Arguments
+        brain_hierarchy: BrainHierarchy index of the brain regions
+    """
+    global name_index
+    name_index = None
+    dictionaries = brain_hierarchy.to_dictionaries()
+    for name, value in dictionaries.items():
+        container = globals()[name]
+        if isinstance(container, list):
+            container.extend(value)
+        else:
+            container.update(value)
+
+
+def get_hierarchy():
+    """
+    Returns the BrainHierarchy index of the last hierarchy explored with search_children.
+    """
+    return hierarchy
 
-    regions_ALLNAME_list.append(lastname_ALL + "|" + object_["name"])
-    name2allname[object_["name"]] = lastname_ALL + "|" + object_["name"]
-    allname2name[lastname_ALL + "|" + object_["name"]] = object_["name"]
-    id_to_region_dictionary[object_["id"]] = object_["name"]
-    id_to_abv[object_["id"]] = object_["acronym"]
-    id_to_region_dictionary_ALLNAME[
-        object_["id"]] = lastname_ALL + "|" + object_["name"]
-    region_dictionary_to_id[object_["name"]] = object_["id"]
-    region_dictionary_to_abv[object_["name"]] = object_["acronym"]
-    region_dictionary_to_id_ALLNAME[lastname_ALL + "|" +
-                                    object_["name"]] = object_["id"]
-    region_dictionary_to_id_ALLNAME_parent[lastname_ALL + "|" +
-                                           object_["name"]] = lastname_ALL
-    region_dictionary_to_id_parent[object_["name"]] = lastname
-    clrTMP = np.float32(
-        np.array(list(hex_to_rgb(object_["color_hex_triplet"]))))
-    if np.sum(clrTMP) > 255.0 * 3.0 * 0.75 and darken:
-        clrTMP *= 255.0 * 3.0 * 0.75 / np.sum(clrTMP)
-    region_to_color[lastname_ALL + "|" + object_["name"]] = list(clrTMP)
-    id_to_color[object_["id"]] = list(clrTMP)
-    region_keys.append(object_["name"])
-    try:
-        is_leaf[lastname_ALL + "|" + object_["name"]] = 1
-        # ~ region_dictionary_to_id_ALLNAME_child[  lastname_ALL+"|"+object_["name"] ] = children
-        # ~ id_children[object_["id"]] = object_["children"]
-        for children in object_["children"]:
-            search_children(children,
-                            lastname_ALL + "|" + object_["name"],
-                            object_["name"], darken=darken)
-            is_leaf[lastname_ALL + "|" + object_["name"]] = 0
-    except KeyError:
-        print("No children of object")
 
 allnameOrder = {}; iterTMP = 0
 
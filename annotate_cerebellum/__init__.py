@@ -5,7 +5,16 @@ cerebellum.
 __version__ = "0.0.1"
 __author__ = "Dimitri RODARIE"
 
-from annotate_cerebellum.utils import load_nrrd_npy_file, save_nrrd_npy_file
+from annotate_cerebellum.chunked_volume import ChunkedVolume
+from annotate_cerebellum.hierarchy import BrainHierarchy
+from annotate_cerebellum.utils import load_nrrd_npy_file, load_nrrd_npy_files, save_nrrd_npy_file
 from annotate_cerebellum.annotation_image import AnnotationImage
 from annotate_cerebellum.canvas_image import AutoScrollbar, CanvasImage
 from annotate_cerebellum.paint_tools import PaintTools
+from annotate_cerebellum.statistics import RegionStatistics
+from annotate_cerebellum.validation import ConsistencyChecker
+from annotate_cerebellum.volume_diff import VolumeDiff
+from annotate_cerebellum.session import SessionCache
+from annotate_cerebellum.shared_volumes import SharedVolumes
+from annotate_cerebellum.profiling import PROFILER, Profiler, profiled
+from annotate_cerebellum.memory import MemoryAccount, MemoryBudget
@@ -1,9 +1,19 @@
 """
 Model part of the application to visualize and modify cerebellar cortex annotation.
 """
+import multiprocessing
+import sys
+
 import numpy as np
 
-from annotate_cerebellum.utils import find_group
+from annotate_cerebellum import morphology
+from annotate_cerebellum.chunked_volume import ChunkedVolume, is_chunked_volume
+from annotate_cerebellum.memory import AnonymousMap
+from annotate_cerebellum.profiling import profiled
+from annotate_cerebellum.pyramid import N_LEVELS, load_pyramid, locate_region
+from annotate_cerebellum.rle_volume import RLEVolume
+from annotate_cerebellum.utils import arrival_levels, find_connected, grow_region, \
+    load_nrrd_npy_file, read_volume_shape, signed_distance
 
 DICT_REG_NUMBERS = {
     "out": 0,
@@ -23,14 +33,98 @@ DICT_REG_COLORS = {
     "corrected": (1, 1, 0),
 }
 
+# Morphological operations of clean_group
+CLEANUP_OPERATIONS = ["fill_holes", "close", "open", "remove_islands"]
+
+# Number of voxels displayed around the region of interest for each axis
+DISPLAY_MARGINS = [80, 80, 120]
+
+# Number of planes of the first axis encoded at once, see AnnotationImage.__prepare
+ENCODING_SLAB_SIZE = 16
+# Storages of the working annotations and encoded backup: numpy arrays or run-length encoded
+# volumes (see RLEVolume)
+STORAGES = ["dense", "rle"]
+
+# Color added to the Nissl expression for each group code, the last row (code -1) being the brain
+# voxels outside of the groups.
+_GROUP_COLORS = np.zeros((max(DICT_REG_NUMBERS.values()) + 2, 3), dtype=np.uint16)
+for _key, _value in DICT_REG_NUMBERS.items():
+    _GROUP_COLORS[_value] = 77 * np.array(DICT_REG_COLORS[_key])
+
+# Volumes and outputs of the encoding worker processes, inherited when forking
+_ENCODING = {}
+
+
+def _group_codes(volume, dict_reg_ids):
+    """
+    Convert brain region ids to group codes, -1 being the brain voxels outside of the groups.
+    """
+    codes = np.zeros(volume.shape, np.int8)
+    codes[volume > 0] = -1
+    for key, value in DICT_REG_NUMBERS.items():
+        if key in dict_reg_ids:
+            codes[np.isin(volume, dict_reg_ids[key])] = value
+    return codes
+
+
+def encode_slab(annotation, orig_ann, dict_reg_ids, codes_out, backup_out, start, stop):
+    """
+    Compute the group codes of planes of the first axis of the annotations, as in the working
+    annotations of AnnotationImage: outside voxels whose original group is not outside are
+    corrected.
+
+    :param ndarray annotation: Volumetric array of brain region ids.
+    :param ndarray orig_ann: Volumetric array of the original brain region ids, or None.
+    :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS to their list of brain
+        region ids.
+    :param ndarray codes_out: Volumetric array receiving the group codes of the annotations.
+    :param ndarray backup_out: Volumetric array receiving the group codes of the original
+        annotations, or None.
+    :param int start: index of the first plane.
+    :param int stop: index after the last plane.
+    :return: number of molecular and granular layer voxels of the planes, sum of their indices
+        for each axis and array of their [min, max] indices for each axis (None if no voxel).
+    :rtype: tuple
+    """
+    codes = _group_codes(annotation[start:stop], dict_reg_ids)
+    backup = _group_codes(orig_ann[start:stop], dict_reg_ids) if orig_ann is not None else codes
+    if backup_out is not None:
+        backup_out[start:stop] = backup
+    codes[(codes == DICT_REG_NUMBERS["out"]) * (backup != codes)] = DICT_REG_NUMBERS["corrected"]
+    codes_out[start:stop] = codes
+    positions = np.where(np.isin(codes, [DICT_REG_NUMBERS["mol"], DICT_REG_NUMBERS["gl"]]))
+    if len(positions[0]) == 0:
+        return 0, np.zeros(3, dtype=np.int64), None
+    positions = [positions[0] + start, positions[1], positions[2]]
+    return (len(positions[0]), np.array([np.sum(coords, dtype=np.int64) for coords in positions]),
+            np.array([[np.min(coords), np.max(coords)] for coords in positions]))
+
+
+def _encode_slab_worker(bounds):
+    return encode_slab(_ENCODING["annotation"], _ENCODING["orig_ann"],
+                       _ENCODING["dict_reg_ids"], _ENCODING["annCPY"], _ENCODING["backup"],
+                       *bounds)
+
+
+def _shared_zeros(shape, dtype):
+    """
+    Create an array in anonymous shared memory, written by the forked worker processes.
+    """
+    count = int(np.prod(shape))
+    buffer = AnonymousMap(-1, max(1, count * np.dtype(dtype).itemsize))
+    return np.frombuffer(buffer, dtype, count=count).reshape(shape)
+
 
 class AnnotationImage:
     """
     Class of the model of the user application to modify volumetric cerebellar annotations.
     Applies modification on the annotations.
+    Several models displaying different axes can share the same working annotations (see
+    multi_planar): a modification applied through one of them is visible in all of them.
     """
 
-    def __init__(self, annotation, dict_reg_ids, nissl, axis=0, backup=None):
+    def __init__(self, annotation, dict_reg_ids, nissl, axis=0, backup=None, state=None,
+                 source=None, processes=1, storage="dense"):
         """
         Initialize the annotation model class.
 
@@ -38,55 +132,328 @@ class AnnotationImage:
         :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS and DICT_REG_COLORS to
             their list brain region ids
         :param ndarray nissl: Volumetric array of float corresponding to nissl expression
+        :param int axis: Axis of the slices to display.
+        :param ndarray backup: Volumetric array of integers corresponding to the original brain
+            region ids
+        :param dict state: Prepared state of the model, as returned by get_state, for the same
+            volumes and region ids. If provided, the group encodings are not recomputed.
+        :param AnnotationImage source: Model of the same volumes and region ids whose working
+            annotations, backup and undo state are shared with this model.
+        :param int processes: Number of processes computing the group encodings, by slabs of the
+            first axis (see encode_slab).
+        :param str storage: Storage of the working annotations and encoded backup, one of
+            STORAGES. Run-length encoded volumes use several times less memory for whole brain
+            volumes, the other buffers only covering the bounding box of the region.
         """
+        self.roi = None
         self.annotation = annotation
         self.orig_ann = backup
-        self.nissl = np.copy(nissl)
+        self.nissl = nissl  # only read, may be a read-only shared or memory mapped volume
         if self.nissl.shape != self.annotation.shape:
             raise Exception("The annotation and nissl volumes must have the same shape.")
         if backup is not None and self.annotation.shape != backup.shape:
             raise Exception("The annotation and backup volumes must have the same shape.")
+        if not 0 <= axis <= 2:
+            raise Exception(("The axis value is incorrect: {}. "
+                             "Only 3 dimensions are possible").format(axis))
+        if storage not in STORAGES:
+            raise Exception("Unknown storage: {}. Available storages: {}".format(
+                storage, ", ".join(STORAGES)))
         self.dict_reg_ids = dict_reg_ids
+        self.axis = axis
+        if source is not None:
+            self.__share(source)
+        else:
+            if state is None:
+                self.__prepare(processes, storage)
+            else:
+                self.annCPY = state["annCPY"]
+                self.backup = state["backup"]
+                if storage == "rle" and not isinstance(self.annCPY, RLEVolume):
+                    self.annCPY = RLEVolume.from_array(self.annCPY)
+                    self.backup = RLEVolume.from_array(self.backup)
+                self.ids = np.asarray(state["ids"], dtype=int)
+                self.center = np.asarray(state["center"], dtype=int)
+                self.inv_dict_reg_ids = np.asarray(state["inv_dict_reg_ids"], dtype=int)
+            # All modifications happen within the bounding box of the region: keep the groups
+            # before the last operation, as last saved and of the original annotations inside it.
+            box = self.__box()
+            self.previous_state = np.copy(self.annCPY[box])
+            self.saved_state = np.copy(self.annCPY[box])
+            self.original_state = np.copy(self.backup[box])
+            if self.orig_ann is None:
+                # Original region ids, overwritten in the annotations by the saves
+                self.original_ids = np.copy(self.annotation[box])
+            self.views = []
+        self.views.append(self)
+        self.slice_pos = int(self.center[self.axis])
+        # Number of modifications of the model and last modification of each slice, compared by
+        # the statistics and consistency checks with the last version they have seen
+        self.version = 0
+        self.slice_versions = np.zeros(self.annCPY.shape[self.axis], dtype=np.int64)
+        self.key_slices = set()  # slices corrected by hand, see interpolate_slices
+        self.__slice_scales = None  # Nissl normalization of each slice, see wand_3d
+        self.__wand_cache = None
+        self.committed = False  # True once changes have been written in the annotations
+        self.generate_image()
+
+    @classmethod
+    def multi_planar(cls, annotation, dict_reg_ids, nissl, axes=(0, 1, 2), backup=None,
+                     state=None, cropped=False, processes=1, storage="dense"):
+        """
+        Initialize one model per axis, all sharing the same working annotations.
+
+        :param ndarray annotation: Volumetric array of integers corresponding to brain region ids
+        :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS and DICT_REG_COLORS to
+            their list brain region ids
+        :param ndarray nissl: Volumetric array of float corresponding to nissl expression
+        :param list axes: Axes of the slices to display.
+        :param ndarray backup: Volumetric array of integers corresponding to the original brain
+            region ids
+        :param dict state: Prepared state of the model, as returned by get_state. Ignored if
+            cropped is True.
+        :param bool cropped: If True, the models work on views of the region of interest of the
+            volumes (stored in their roi attribute), so that the working annotations only cover
+            this region. The saved changes are written in the annotation volume.
+        :param int processes: Number of processes computing the group encodings.
+        :param str storage: Storage of the working annotations, one of STORAGES.
+        :return: list of the models, one for each axis
+        :rtype: list
+        """
+        roi = None
+        if cropped:
+            roi = cls.region_roi(annotation, dict_reg_ids, axes[0])
+            annotation, nissl = annotation[roi], nissl[roi]
+            backup = backup[roi] if backup is not None else None
+            state = None
+        views = [cls(annotation, dict_reg_ids, nissl, axes[0], backup, state,
+                     processes=processes, storage=storage)]
+        views[0].roi = roi
+        for axis in axes[1:]:
+            views.append(cls(annotation, dict_reg_ids, nissl, axis, backup, source=views[0]))
+        return views
+
+    @classmethod
+    def region_roi(cls, annotation, dict_reg_ids, axis=0, slab_size=16):
+        """
+        Find the region of interest of a region in an annotation volume: the bounding box of its
+        molecular and granular layers extended with the display margins.
+
+        :param ndarray annotation: Volumetric array of integers corresponding to brain region ids
+        :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS and DICT_REG_COLORS to
+            their list brain region ids
+        :param int axis: Axis of the slices to display.
+        :param int slab_size: number of planes searched at once.
+        :return: region of interest
+        :rtype: tuple
+        """
+        ids = np.concatenate((dict_reg_ids["mol"], dict_reg_ids["gl"]))
+        bbox = None
+        for start in range(0, annotation.shape[0], slab_size):
+            positions = np.where(np.isin(annotation[start:start + slab_size], ids))
+            if len(positions[0]) == 0:
+                continue
+            slab_bbox = np.array([[np.min(coords), np.max(coords) + 1] for coords in positions])
+            slab_bbox[0] += start
+            if bbox is None:
+                bbox = slab_bbox
+            else:
+                bbox[:, 0] = np.minimum(bbox[:, 0], slab_bbox[:, 0])
+                bbox[:, 1] = np.maximum(bbox[:, 1], slab_bbox[:, 1])
+        if bbox is None:
+            raise Exception("The region could not be found in the annotation volume.")
+        return cls.__region_roi(bbox, axis, annotation.shape)
+
+    def __share(self, source):
+        """
+        Use the working state of another model of the same volumes and region ids.
+
+        :param AnnotationImage source: model whose working state is shared.
+        """
+        if source.annotation is not self.annotation:
+            raise Exception("Models sharing their working state must use the same annotations.")
+        self.roi = source.roi
+        self.annCPY = source.annCPY
+        self.backup = source.backup
+        self.ids = source.ids
+        self.center = source.center
+        self.inv_dict_reg_ids = source.inv_dict_reg_ids
+        self.previous_state = source.previous_state
+        self.saved_state = source.saved_state
+        self.original_state = source.original_state
+        if self.orig_ann is None:
+            self.original_ids = source.original_ids
+        self.views = source.views
+
+    def __prepare(self, processes=1, storage="dense"):
+        """
+        Compute the group encodings of the annotations and backup, the bounding box of the region
+        and its center. The volumes are encoded by slabs of the first axis, in parallel worker
+        processes writing in shared output arrays if processes > 1 on Linux, where processes are
+        forked. Forking is not used on macOS, where it is unsafe once Tk has started.
+        Run-length encoded volumes are encoded in the current process.
+
+        :param int processes: Number of worker processes.
+        :param str storage: Storage of the encoded volumes, one of STORAGES.
+        """
         self.inv_dict_reg_ids = np.zeros(np.max(list(DICT_REG_NUMBERS.values())) + 1, dtype=int)
         self.inv_dict_reg_ids[DICT_REG_NUMBERS["mol"]] = self.dict_reg_ids["mol"][0]
         self.inv_dict_reg_ids[DICT_REG_NUMBERS["gl"]] = self.dict_reg_ids["gl"][0]
         self.inv_dict_reg_ids[DICT_REG_NUMBERS["fib"]] = self.dict_reg_ids["fib"][0]
 
-        if not 0 <= axis <= 2:
-            raise Exception(("The axis value is incorrect: {}. "
-                             "Only 3 dimensions are possible").format(axis))
-        self.axis = axis
-        self.annCPY = np.zeros(annotation.shape, np.int8)
-        self.annCPY[self.annotation > 0] = -1
-        for key, value in DICT_REG_NUMBERS.items():
-            if key in self.dict_reg_ids:
-                self.annCPY[np.isin(self.annotation, self.dict_reg_ids[key])] = value
-        offsets = [80, 80, 120]
-        offsets[axis] = 1
-        if backup is not None:
-            self.backup = np.zeros(annotation.shape, np.int8)
-            self.backup[backup > 0] = -1
-            for key, value in DICT_REG_NUMBERS.items():
-                if key in self.dict_reg_ids:
-                    self.backup[np.isin(backup, self.dict_reg_ids[key])] = value
+        shape = self.annotation.shape
+        slabs = [(start, min(start + ENCODING_SLAB_SIZE, shape[0]))
+                 for start in range(0, shape[0], ENCODING_SLAB_SIZE)]
+        if storage == "dense" and processes > 1 and len(slabs) > 1 and \
+                sys.platform.startswith("linux"):
+            self.annCPY = _shared_zeros(shape, np.int8)
+            self.backup = _shared_zeros(shape, np.int8)
+            _ENCODING.update(annotation=self.annotation, orig_ann=self.orig_ann,
+                             dict_reg_ids=self.dict_reg_ids, annCPY=self.annCPY,
+                             backup=self.backup)
+            try:
+                with multiprocessing.get_context("fork").Pool(min(processes, len(slabs))) as pool:
+                    results = pool.map(_encode_slab_worker, slabs)
+            finally:
+                _ENCODING.clear()
         else:
-            self.backup = np.copy(self.annCPY)
-        self.annCPY[(self.annCPY == DICT_REG_NUMBERS["out"]) *
-                    (self.backup != self.annCPY)] = DICT_REG_NUMBERS["corrected"]
-        if self.axis == 2:
-            self.annCPY = self.annCPY.swapaxes(0, 1)
-            self.backup = self.backup.swapaxes(0, 1)
-            self.nissl = self.nissl.swapaxes(0, 1)
-            offsets = [offsets[1], offsets[0], offsets[2]]
-        self.previous_state = np.copy(self.annCPY)
+            if storage == "rle":
+                self.annCPY, self.backup = RLEVolume(shape), RLEVolume(shape)
+            else:
+                self.annCPY, self.backup = np.zeros(shape, np.int8), np.zeros(shape, np.int8)
+            results = [encode_slab(self.annotation, self.orig_ann, self.dict_reg_ids, self.annCPY,
+                                   self.backup, start, stop) for start, stop in slabs]
 
-        filter_ = np.where(np.isin(self.annCPY, [DICT_REG_NUMBERS["mol"], DICT_REG_NUMBERS["gl"]]))
+        # Merge the bounding boxes of the slabs
+        count = sum(result[0] for result in results)
+        if count == 0:
+            raise Exception("The region could not be found in the annotation volume.")
+        bounds = np.array([result[2] for result in results if result[2] is not None])
+        offsets = list(DISPLAY_MARGINS)
+        offsets[self.axis] = 1
         self.ids = np.zeros((3, 2), dtype=int)
         for i in range(3):
-            self.ids[i] = [max(0, np.min(filter_[i] - offsets[i])),
-                           min(int(self.annCPY.shape[i]) - 1, np.max(filter_[i] + offsets[i]))]
-        self.slice_pos = int(np.mean(filter_[axis]))
-        self.generate_image()
+            self.ids[i] = [max(0, np.min(bounds[:, i, 0]) - offsets[i]),
+                           min(int(shape[i]) - 1, np.max(bounds[:, i, 1]) + offsets[i])]
+        self.center = np.sum([result[1] for result in results], axis=0) // count
+
+    def get_state(self):
+        """
+        Get the prepared state of the model, which can be stored and given back to the
+        constructor to skip the preparation of the model.
+
+        :return: Dictionary of the working annotations (annCPY), the encoded backup, the bounding
+            box of the region (ids), the center of the region (initial slice positions) and the
+            inverse group dictionary.
+        :rtype: dict
+        """
+        return {
+            "annCPY": self.annCPY,
+            "backup": self.backup,
+            "ids": self.ids,
+            "center": self.center,
+            "inv_dict_reg_ids": self.inv_dict_reg_ids,
+        }
+
+    @classmethod
+    def from_chunked(cls, annotation, dict_reg_ids, nissl, axis=0, backup=None):
+        """
+        Initialize the annotation model from chunked volumes, loading only the chunks that
+        intersect the bounding box of the molecular and granular layers of the region.
+        The region of interest loaded is stored in the roi attribute so that the corrected
+        annotations can be written back with annotation.write(model.annotation, model.roi).
+
+        :param ChunkedVolume annotation: Chunked volume of brain region ids
+        :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS and DICT_REG_COLORS to
+            their list brain region ids
+        :param ChunkedVolume nissl: Chunked volume of nissl expression
+        :param int axis: Axis of the slices to display.
+        :param ChunkedVolume backup: Chunked volume of the original brain region ids
+        :return: annotation model of the region of interest
+        :rtype: AnnotationImage
+        """
+        bbox = annotation.bounding_box(np.concatenate((dict_reg_ids["mol"], dict_reg_ids["gl"])))
+        if bbox is None:
+            raise Exception("The region could not be found in the annotation volume.")
+        roi = cls.__region_roi(bbox, axis, annotation.shape)
+        model = cls(annotation.read(roi), dict_reg_ids, nissl.read(roi), axis,
+                    backup.read(roi) if backup is not None else None)
+        model.roi = roi
+        return model
+
+    @classmethod
+    def from_files(cls, annotation_filename, dict_reg_ids, nissl_filename, axis=0,
+                   backup_filename=None, level_id=2):
+        """
+        Initialize the annotation model from volumetric files, loading only the full resolution
+        data surrounding the region. The region is located on a coarse level of the cached
+        annotation pyramid. The region of interest loaded is stored in the roi attribute.
+
+        :param str annotation_filename: path to the volume of brain region ids
+        :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS and DICT_REG_COLORS to
+            their list brain region ids
+        :param str nissl_filename: path to the volume of nissl expression
+        :param int axis: Axis of the slices to display.
+        :param str backup_filename: path to the volume of the original brain region ids
+        :param int level_id: pyramid level used to locate the region (1 for the finest level).
+        :return: annotation model of the region of interest
+        :rtype: AnnotationImage
+        """
+        if is_chunked_volume(annotation_filename) and is_chunked_volume(nissl_filename) and \
+                (backup_filename is None or is_chunked_volume(backup_filename)):
+            return cls.from_chunked(ChunkedVolume(annotation_filename), dict_reg_ids,
+                                    ChunkedVolume(nissl_filename), axis,
+                                    ChunkedVolume(backup_filename) if backup_filename else None)
+        shape = read_volume_shape(annotation_filename)
+        # The default number of levels is loaded so that the prebuilt pyramids are used
+        level = load_pyramid(annotation_filename, max(level_id, N_LEVELS))[level_id - 1]
+        bbox = locate_region(level, np.concatenate((dict_reg_ids["mol"], dict_reg_ids["gl"])),
+                             level_id, shape)
+        if bbox is None:
+            raise Exception("The region could not be found in the annotation volume.")
+        roi = cls.__region_roi(bbox, axis, shape)
+        model = cls(load_nrrd_npy_file(annotation_filename, roi), dict_reg_ids,
+                    load_nrrd_npy_file(nissl_filename, roi), axis,
+                    load_nrrd_npy_file(backup_filename, roi) if backup_filename else None)
+        model.roi = roi
+        return model
+
+    @staticmethod
+    def __region_roi(bbox, axis, shape):
+        """
+        Extend the bounding box of a region with the display margins.
+
+        :param ndarray bbox: Array of [start, stop[ positions of the region for each dimension.
+        :param int axis: Axis of the slices to display.
+        :param tuple shape: Shape of the whole volume.
+        :return: region of interest to load
+        :rtype: tuple
+        """
+        offsets = list(DISPLAY_MARGINS)
+        offsets[axis] = 1
+        return tuple(slice(int(max(0, start - offset)), int(min(dim, stop + offset)))
+                     for (start, stop), offset, dim in zip(bbox, offsets, shape))
+
+    def buffers(self):
+        """
+        Get the buffers held by the model, to account for the memory it uses.
+
+        :return: Dictionary of buffer name to ndarray (None if the model does not hold it).
+        :rtype: dict
+        """
+        return {
+            "annotation": self.annotation,
+            "orig_ann": self.orig_ann,
+            "nissl": self.nissl,
+            "annCPY": self.annCPY,
+            "backup": self.backup,
+            "previous_state": self.previous_state,
+            "saved_state": self.saved_state,
+            "original_state": self.original_state,
+            "original_ids": getattr(self, "original_ids", None),
+            "picRGB": self.picRGB,
+            "nissl_img": self.nissl_img,
+        }
 
     def get_slice(self):
         """
@@ -111,6 +478,18 @@ class AnnotationImage:
             raise Exception(("The axis value is incorrect: {}. "
                              "Only 3 dimensions are possible").format(self.axis))
 
+    def get_plane(self, volume):
+        """
+        Get the image to display from a volume, without copy for numpy arrays. Sagittal images
+        (axis 2) are transposed so that their rows follow the second axis of the volume.
+
+        :param ndarray volume: Volumetric array, e.g. the working annotations.
+        :return: 2D view of the volume
+        :rtype: ndarray
+        """
+        plane = volume[self.get_slice()]
+        return plane.T if self.axis == 2 else plane
+
     def get_position(self, pixel):
         """
         Get the voxel index in the volume for the pixel chosen
@@ -124,84 +503,187 @@ class AnnotationImage:
         if self.axis == 1:
             return np.s_[self.ids[0, 0] + pixel[0], self.slice_pos, self.ids[2, 0] + pixel[1]]
         if self.axis == 2:
-            return np.s_[self.ids[0, 0] + pixel[0], self.ids[1, 0] + pixel[1], self.slice_pos]
+            return np.s_[self.ids[0, 0] + pixel[1], self.ids[1, 0] + pixel[0], self.slice_pos]
+
+    def __voxels(self, pixels, positions=None):
+        """
+        Get the voxel indices in the volume of pixels of the image, ignoring the pixels outside of
+        the image.
 
+        :param ndarray pixels: Array of pixel positions, of shape (N, 2).
+        :param ndarray positions: Slice position of each pixel. Defaults to the displayed slice.
+        :return: tuple of the voxel indices for each axis
+        :rtype: tuple
+        """
+        pixels = np.reshape(np.asarray(pixels, dtype=int), (-1, 2))
+        inside = np.all((pixels >= 0) * (pixels < self.picRGB.shape[:2]), axis=1)
+        pixels = pixels[inside]
+        rows, cols = pixels[:, 0], pixels[:, 1]
+        if positions is None:
+            slice_pos = np.full(len(pixels), self.slice_pos, dtype=int)
+        else:
+            slice_pos = np.asarray(positions, dtype=int)[inside]
+        if self.axis == 0:
+            return slice_pos, self.ids[1, 0] + rows, self.ids[2, 0] + cols
+        if self.axis == 1:
+            return self.ids[0, 0] + rows, slice_pos, self.ids[2, 0] + cols
+        return self.ids[0, 0] + cols, self.ids[1, 0] + rows, slice_pos
+
+    def __pixels(self, voxels):
+        """
+        Get the pixel positions in the image of voxels of the displayed slice.
+
+        :param tuple voxels: tuple of the voxel indices for each axis.
+        :return: rows and columns of the pixels
+        :rtype: tuple
+        """
+        if self.axis == 0:
+            return voxels[1] - self.ids[1, 0], voxels[2] - self.ids[2, 0]
+        if self.axis == 1:
+            return voxels[0] - self.ids[0, 0], voxels[2] - self.ids[2, 0]
+        return voxels[1] - self.ids[1, 0], voxels[0] - self.ids[0, 0]
+
+    def __planes(self, start, stop):
+        """
+        Get the images of the working annotations of consecutive slices, without copy.
+
+        :param int start: position of the first slice.
+        :param int stop: position after the last slice.
+        :return: 3D view of the working annotations, the first axis being the slice position
+        :rtype: ndarray
+        """
+        box = list(self.__box())
+        box[self.axis] = slice(start, stop)
+        planes = np.moveaxis(self.annCPY[tuple(box)], self.axis, 0)
+        return np.swapaxes(planes, 1, 2) if self.axis == 2 else planes
+
+    def __box(self):
+        """
+        Get the bounding box of the region in the working annotations.
+
+        :return: tuple of slices
+        :rtype: tuple
+        """
+        return tuple(slice(start, stop + 1) for start, stop in self.ids)
+
+    @profiled("AnnotationImage.generate_image")
     def generate_image(self):
         """
-        Generate a 2D RGB image which correspond to the current coronal slice.
+        Generate a 2D RGB image which correspond to the current slice.
         """
-        slice_pos = self.get_slice()
-        self.picRGB = np.zeros((self.annCPY[slice_pos].shape[0],
-                                self.annCPY[slice_pos].shape[1], 3), np.uint16)
-        max_nissl = np.max(self.nissl[slice_pos])
+        annotations = self.get_plane(self.annCPY)
+        nissl = self.get_plane(self.nissl)
+        self.picRGB = np.zeros(annotations.shape + (3,), np.uint16)
+        max_nissl = np.max(nissl)
         if max_nissl > 0:
             self.picRGB[:, :, 0] = self.picRGB[:, :, 1] = self.picRGB[:, :, 2] = np.uint16(
-                255.0 * (self.nissl[slice_pos] / max_nissl))
-        else:
-            self.picRGB[:, :, 0] = self.picRGB[:, :, 1] = self.picRGB[:, :, 2] = 0
+                255.0 * (nissl / max_nissl))
 
         self.nissl_img = np.copy(self.picRGB)
+        self.picRGB += _GROUP_COLORS[annotations]
+        self.picRGB = np.asarray(np.minimum(self.picRGB, 255), dtype=np.uint8)
+
+    def modified_slices(self, version):
+        """
+        Positions of the slices modified since a version of the model.
 
-        for key, value in DICT_REG_NUMBERS.items():
-            filter_ = np.where(self.annCPY[slice_pos] == value)
-            self.picRGB[filter_[0], filter_[1], :] += np.uint16(77 * np.array(DICT_REG_COLORS[key]))
-        self.picRGB[self.picRGB > 255] = 255
-        self.picRGB = np.asarray(self.picRGB, dtype=np.uint8)
+        :param int version: value of the version attribute when the slices were last read.
+        :return: sorted array of slice positions
+        :rtype: ndarray
+        """
+        return np.where(self.slice_versions > version)[0]
+
+    @profiled("AnnotationImage.draw")
+    def __draw(self, voxels):
+        """
+        Mark voxels of the working annotations as modified and redraw those of the displayed slice.
+
+        :param tuple voxels: tuple of the voxel indices for each axis.
+        """
+        self.version += 1
+        self.slice_versions[np.unique(voxels[self.axis])] = self.version
+        in_slice = voxels[self.axis] == self.slice_pos
+        if np.any(in_slice):
+            voxels = tuple(coords[in_slice] for coords in voxels)
+            rows, cols = self.__pixels(voxels)
+            self.picRGB[rows, cols] = np.minimum(
+                self.nissl_img[rows, cols] + _GROUP_COLORS[self.annCPY[voxels]], 255)
+
+    @profiled("AnnotationImage.modify")
+    def __modify(self, voxels, values, undoable=True):
+        """
+        Change the group of voxels of the working annotations and update the images of all the
+        models sharing them. Only the rows or columns of their slices intersecting the modified
+        voxels are redrawn.
+
+        :param tuple voxels: tuple of the voxel indices for each axis, inside the bounding box.
+        :param ndarray values: new group codes of the voxels.
+        :param bool undoable: If True, the operation can be undone with revert_slice.
+        """
+        if undoable:
+            self.previous_state[...] = self.annCPY[self.__box()]
+        self.annCPY[voxels] = values
+        for view in self.views:
+            view.__draw(voxels)
+
+    def __new_values(self, voxels, key):
+        """
+        Select the voxels which can be changed to a group and compute their new group codes.
 
+        :param tuple voxels: tuple of the voxel indices for each axis.
+        :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
+            value.
+        :return: voxels to modify and their new values
+        :rtype: tuple
+        """
+        values = self.annCPY[voxels]
+        to_update = (values != DICT_REG_NUMBERS["prot"]) * (values != DICT_REG_NUMBERS[key])
+        voxels = tuple(coords[to_update] for coords in voxels)
+        new_values = np.full(len(voxels[0]), DICT_REG_NUMBERS[key], dtype=self.annCPY.dtype)
+        if key == "out":
+            new_values[self.backup[voxels] != DICT_REG_NUMBERS["out"]] = \
+                DICT_REG_NUMBERS["corrected"]
+        return voxels, new_values
+
+    @profiled("AnnotationImage.update_slice")
     def update_slice(self, voxels_to_update, key):
         """
         Change the value of the voxels listed in parameters in the annotations.
 
-        :param ndarray voxels_to_update: list of voxels to update
+        :param ndarray voxels_to_update: list of pixels of the image to update
         :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
             value.
         """
-        change = False
-        for voxel in voxels_to_update:
-            slice_pos = self.get_position(voxel)
-            if 0 <= voxel[0] < self.picRGB.shape[0] and \
-                    0 <= voxel[1] < self.picRGB.shape[1] and \
-                    not self.annCPY[slice_pos] == DICT_REG_NUMBERS["prot"] and \
-                    self.annCPY[slice_pos] != DICT_REG_NUMBERS[key]:
-                if not change:
-                    self.previous_state = np.copy(self.annCPY)
-                    change = True
-                if key == "out" and DICT_REG_NUMBERS[key] != self.backup[slice_pos]:
-                    key = "corrected"
-                self.annCPY[slice_pos] = DICT_REG_NUMBERS[key]
-                self.picRGB[voxel[0], voxel[1]] = np.uint8(
-                    np.minimum(self.nissl_img[voxel[0],
-                                              voxel[1]] + 77 * np.array(DICT_REG_COLORS[key]), 255))
+        voxels, new_values = self.__new_values(self.__voxels(voxels_to_update), key)
+        if len(new_values) > 0:
+            self.__modify(voxels, new_values)
 
+    @profiled("AnnotationImage.revert_slice")
     def revert_slice(self):
-        self.annCPY = np.copy(self.previous_state)
-        self.generate_image()
+        """
+        Undo the last operation applied on the annotations.
+        """
+        box = self.__box()
+        local = np.where(self.annCPY[box] != self.previous_state)
+        voxels = tuple(coords + start for coords, (start, _) in zip(local, self.ids))
+        self.__modify(voxels, self.previous_state[local], undoable=False)
 
+    @profiled("AnnotationImage.revert_voxels")
     def revert_voxels(self, voxels_to_update):
         """
         Revert changes in the annotations at the location of the list of voxels in parameter.
 
-        :param ndarray voxels_to_update: list of voxels to revert.
-        """
-        for voxel in voxels_to_update:
-            slice_pos = self.get_position(voxel)
-            if 0 <= voxel[0] < self.picRGB.shape[0] and \
-                    0 <= voxel[1] < self.picRGB.shape[1] and \
-                    not self.annCPY[slice_pos] == DICT_REG_NUMBERS["prot"]:
-                self.annCPY[slice_pos] = self.backup[slice_pos]
-                if self.annCPY[slice_pos] >= 0:
-                    key = None
-                    for loc_key, value in DICT_REG_NUMBERS.items():
-                        if value == self.backup[slice_pos]:
-                            key = loc_key
-                            break
-                    if key:
-                        self.picRGB[voxel[0], voxel[1]] = np.uint8(np.minimum(
-                            self.nissl_img[voxel[0],
-                                           voxel[1]] + 77 * np.array(DICT_REG_COLORS[key]), 255))
-                else:
-                    self.picRGB[voxel[0], voxel[1]] = np.uint8(self.nissl_img[voxel[0], voxel[1]])
+        :param ndarray voxels_to_update: list of pixels of the image to revert.
+        """
+        voxels = self.__voxels(voxels_to_update)
+        values = self.annCPY[voxels]
+        backup = self.backup[voxels]
+        to_revert = (values != DICT_REG_NUMBERS["prot"]) * (values != backup)
+        if np.any(to_revert):
+            self.__modify(tuple(coords[to_revert] for coords in voxels), backup[to_revert],
+                          undoable=False)
 
+    @profiled("AnnotationImage.change_slice")
     def change_slice(self, new_pos):
         """
         Change the position of the slice and regenerate the image.
@@ -211,6 +693,7 @@ class AnnotationImage:
         self.slice_pos = new_pos
         self.generate_image()
 
+    @profiled("AnnotationImage.fill")
     def fill(self, position, key):
         """
         Fill all voxels surrounding a voxel that belong to the same group.
@@ -219,21 +702,279 @@ class AnnotationImage:
         :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
             value.
         """
-        slice_pos = self.get_slice()
-        image = self.annCPY[slice_pos]
-        voxels_to_update = find_group(image, position, image[position[0], position[1]])
+        image = self.get_plane(self.annCPY)
+        if np.any(np.asarray(position) < 0) or np.any(np.asarray(position) >= image.shape):
+            return
+        voxels_to_update = find_connected(image == image[position[0], position[1]], position)
         self.update_slice(voxels_to_update, key)
 
+    @staticmethod
+    def __group_mask(codes, keys):
+        """
+        Get the voxels belonging to groups.
+
+        :param ndarray codes: group codes of the voxels.
+        :param list keys: Keys of DICT_REG_NUMBERS of the groups. If None, all the voxels are
+            selected.
+        :return: Boolean array, or None if keys is None.
+        :rtype: ndarray
+        """
+        if keys is None:
+            return None
+        values = [DICT_REG_NUMBERS[key] for key in keys]
+        if "out" in keys:
+            values.append(DICT_REG_NUMBERS["corrected"])
+        return np.isin(codes, values)
+
+    def wand_region(self, position, tolerance, keys=None):
+        """
+        Find the pixels of the displayed slice connected to a pixel whose Nissl intensity, as
+        displayed (0 to 255), differs from the one of the pixel by at most a tolerance.
+        The minimum tolerance reaching each pixel is computed once per starting pixel, so that
+        changing the tolerance only thresholds it.
+
+        :param list position: Initial pixel position.
+        :param int tolerance: Maximum difference of intensity, between 0 and 255.
+        :param list keys: Keys of DICT_REG_NUMBERS of the groups to which the region is
+            restricted. If None, the region can extend over all the groups.
+        :return: Array of the pixel positions of the region, of shape (N, 2).
+        :rtype: ndarray
+        """
+        position = tuple(int(coord) for coord in position)
+        if any(coord < 0 or coord >= dim for coord, dim in zip(position,
+                                                                self.nissl_img.shape[:2])):
+            return np.zeros((0, 2), dtype=int)
+        cache_key = (self.slice_pos, position)
+        mask = self.__group_mask(self.get_plane(self.annCPY), keys)
+        if self.__wand_cache is None or self.__wand_cache[0] != cache_key or \
+                not np.array_equal(self.__wand_cache[1], mask):
+            self.__wand_cache = (cache_key, mask,
+                                 arrival_levels(self.nissl_img[:, :, 0], position, mask))
+        return np.argwhere(self.__wand_cache[2] <= tolerance)
+
+    @profiled("AnnotationImage.wand")
+    def wand(self, position, key, tolerance, keys=None):
+        """
+        Change the group of the pixels of the displayed slice selected by the magic wand, see
+        wand_region.
+
+        :param list position: Initial pixel position.
+        :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
+            value.
+        :param int tolerance: Maximum difference of intensity, between 0 and 255.
+        :param list keys: Keys of DICT_REG_NUMBERS of the groups to which the region is
+            restricted.
+        """
+        self.update_slice(self.wand_region(position, tolerance, keys), key)
+
+    @profiled("AnnotationImage.wand_3d")
+    def wand_3d(self, position, key, tolerance, keys=None):
+        """
+        Change the group of the voxels connected in 3D to a voxel whose Nissl intensity differs
+        from the one of the voxel by at most a tolerance, within the bounding box of the region.
+        The intensities are normalized slice by slice as in the displayed images.
+
+        :param list position: Initial voxel indices in the annotations (annCPY).
+        :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
+            value.
+        :param int tolerance: Maximum difference of intensity, between 0 and 255.
+        :param list keys: Keys of DICT_REG_NUMBERS of the groups to which the region is
+            restricted.
+        """
+        position = np.asarray(position, dtype=int)
+        if np.any(position < self.ids[:, 0]) or np.any(position > self.ids[:, 1]):
+            return
+        box = self.__box()
+        nissl = self.nissl[box]
+        if self.__slice_scales is None:
+            # Maximum of the displayed image of each slice
+            axes = tuple(i for i in range(3) if i != self.axis)
+            maxima = np.max(nissl, axis=axes).astype(np.float32)
+            self.__slice_scales = np.divide(255.0, maxima, out=np.zeros_like(maxima),
+                                          where=maxima > 0)
+        shape = [1, 1, 1]
+        shape[self.axis] = -1
+        intensity = np.floor(nissl * np.reshape(self.__slice_scales, shape))
+        local_position = position - self.ids[:, 0]
+        voxels = grow_region(intensity, local_position, tolerance,
+                             self.__group_mask(self.annCPY[box], keys))
+        self.update_voxels(voxels + self.ids[:, 0], key)
+
+    @profiled("AnnotationImage.interpolate_slices")
+    def interpolate_slices(self, key_slices=None):
+        """
+        Fill the slices between consecutive key slices by interpolating the shape of each group.
+        The signed distance to the boundary of each group is computed on the two key slices
+        surrounding a slice and linearly interpolated; each voxel takes the group with the lowest
+        interpolated distance. Protected voxels are not modified and the whole interpolation can be
+        undone with revert_slice.
+
+        :param list key_slices: positions of the key slices along the axis of the model. Defaults
+            to the key_slices attribute.
+        :return: Number of voxels modified.
+        :rtype: int
+        """
+        if key_slices is None:
+            key_slices = self.key_slices
+        out, corrected = DICT_REG_NUMBERS["out"], DICT_REG_NUMBERS["corrected"]
+        key_slices = sorted(pos for pos in set(key_slices)
+                            if self.ids[self.axis, 0] <= pos <= self.ids[self.axis, 1])
+        all_voxels, all_values = [], []
+        for start, stop in zip(key_slices[:-1], key_slices[1:]):
+            if stop - start < 2:
+                continue
+            first, last = self.__planes(start, start + 1)[0], self.__planes(stop, stop + 1)[0]
+            # Corrected voxels are outside voxels
+            first = np.where(first == corrected, out, first)
+            last = np.where(last == corrected, out, last)
+            weights = np.asarray((np.arange(start + 1, stop) - start) / (stop - start),
+                                 dtype=np.float32)[:, None, None]
+            planes = self.__planes(start + 1, stop)
+            best = np.full(planes.shape, np.inf, dtype=np.float32)
+            groups = np.zeros(planes.shape, dtype=self.annCPY.dtype)
+            # Voxels of other brain regions (-1) are neither interpolated nor modified
+            for code in np.setdiff1d(np.union1d(first, last), [-1]):
+                distance = (1 - weights) * signed_distance(first == code) + \
+                    weights * signed_distance(last == code)
+                closer = distance < best
+                best[closer] = distance[closer]
+                groups[closer] = code
+            current = np.where(planes == corrected, out, planes)
+            to_update = (groups != current) * (planes != DICT_REG_NUMBERS["prot"]) * \
+                (groups != DICT_REG_NUMBERS["prot"]) * (planes >= 0) * (best < np.inf)
+            positions, rows, cols = np.where(to_update)
+            all_voxels.append(self.__voxels(np.array([rows, cols]).T, positions + start + 1))
+            all_values.append(groups[to_update])
+        if len(all_voxels) == 0:
+            return 0
+        voxels = tuple(np.concatenate(coords) for coords in zip(*all_voxels))
+        values = np.concatenate(all_values)
+        if len(values) > 0:
+            values[(values == out) * (self.backup[voxels] != out)] = corrected
+            self.__modify(voxels, values)
+        return len(values)
+
+    @profiled("AnnotationImage.clean_group")
+    def clean_group(self, operation, key, size=1, planar=True, workers=None):
+        """
+        Clean a group of the working annotations with a morphological operation, within the
+        bounding box of the region:
+
+        * fill_holes: voxels enclosed by the group are added to it.
+        * close: gaps narrower than 2 * size voxels are added to the group.
+        * open: parts of the group thinner than 2 * size voxels are removed.
+        * remove_islands: connected parts of the group of less than size voxels are removed.
+
+        Removed voxels take the most frequent group among their neighbors. Protected voxels and
+        voxels of other brain regions are not modified, and the operation can be undone with
+        revert_slice.
+
+        :param str operation: One of CLEANUP_OPERATIONS.
+        :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the group
+            to clean.
+        :param int size: Number of erosions and dilations of close and open, minimum number of
+            voxels of the parts kept by remove_islands.
+        :param bool planar: If True, each slice of the axis of the model is processed
+            independently, otherwise the operation is applied in 3D.
+        :param int workers: Maximum number of threads processing the slabs of the bounding box.
+        :return: Number of voxels modified.
+        :rtype: int
+        """
+        if operation not in CLEANUP_OPERATIONS:
+            raise Exception("Unknown cleanup operation: {}. Available operations: {}".format(
+                operation, ", ".join(CLEANUP_OPERATIONS)))
+        if key in ["prot", "corrected"]:
+            raise Exception("The {} group cannot be cleaned.".format(key))
+        out, corrected = DICT_REG_NUMBERS["out"], DICT_REG_NUMBERS["corrected"]
+        box = self.__box()
+        current = self.annCPY[box]
+        # Corrected voxels are outside voxels
+        codes = np.where(current == corrected, out, current)
+        mask = self.__group_mask(codes, [key])
+        axis = self.axis if planar else None
+        if operation == "fill_holes":
+            cleaned = morphology.fill_holes(mask, axis, workers)
+        elif operation == "close":
+            cleaned = morphology.closing(mask, size, axis, workers)
+        elif operation == "open":
+            cleaned = morphology.opening(mask, size, axis, workers)
+        else:
+            cleaned = morphology.remove_small_islands(mask, size, axis, workers)
+        groups = np.copy(codes)
+        groups[cleaned & ~mask] = DICT_REG_NUMBERS[key]
+        groups = morphology.fill_from_neighbors(
+            groups, mask & ~cleaned,
+            [DICT_REG_NUMBERS[group] for group in ["out", "fib", "mol", "gl"] if group != key],
+            axis)
+        to_update = (groups != codes) * (codes != DICT_REG_NUMBERS["prot"]) * (codes >= 0)
+        local = np.where(to_update)
+        if len(local[0]) == 0:
+            return 0
+        voxels = tuple(coords + start for coords, (start, _) in zip(local, self.ids))
+        values = groups[local]
+        values[(values == out) * (self.backup[voxels] != out)] = corrected
+        self.__modify(voxels, values)
+        return len(values)
+
+    @profiled("AnnotationImage.update_voxels")
+    def update_voxels(self, voxels_to_update, key):
+        """
+        Change the value of voxels of the annotations, anywhere in the bounding box of the region.
+
+        :param ndarray voxels_to_update: Array of the voxels indices in the annotations (annCPY),
+            of shape (N, 3). Voxels outside of the bounding box are ignored.
+        :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
+            value.
+        """
+        voxels_to_update = np.reshape(np.asarray(voxels_to_update, dtype=int), (-1, 3))
+        inside = np.all((voxels_to_update >= self.ids[:, 0]) *
+                        (voxels_to_update <= self.ids[:, 1]), axis=1)
+        voxels, new_values = self.__new_values(tuple(voxels_to_update[inside].T), key)
+        if len(new_values) > 0:
+            self.__modify(voxels, new_values)
+
+    @profiled("AnnotationImage.fill_3d")
+    def fill_3d(self, position, key):
+        """
+        Fill all voxels connected to a voxel in 3D that belong to the same group, within the
+        bounding box of the region.
+
+        :param list position: Initial voxel indices in the annotations (annCPY).
+        :param str key: Key of the DICT_REG_NUMBERS and DICT_REG_COLORS corresponding to the new
+            value.
+        """
+        box = self.__box()
+        position = np.asarray(position, dtype=int)
+        if np.any(position < self.ids[:, 0]) or np.any(position > self.ids[:, 1]):
+            return
+        sub_volume = self.annCPY[box]
+        local_position = position - self.ids[:, 0]
+        voxels = find_connected(sub_volume == sub_volume[tuple(local_position)], local_position)
+        self.update_voxels(voxels + self.ids[:, 0], key)
+
+    @profiled("AnnotationImage.apply_changes")
     def apply_changes(self):
         """
-        Save changes applied on the annotations. Update backup.
-        """
-        protected_vox = self.annCPY == DICT_REG_NUMBERS["prot"]
-        modified_vox = self.annCPY != self.backup
-        filter_ = np.where(modified_vox * ~protected_vox)
-        filter_ann = (filter_[1], filter_[0], filter_[2]) if self.axis == 2 else filter_
-        self.annotation[filter_ann] = self.inv_dict_reg_ids[self.annCPY[filter_]]
-        filter_ = np.where(~modified_vox * ~protected_vox)
-        filter_ann = (filter_[1], filter_[0], filter_[2]) if self.axis == 2 else filter_
-        self.annotation[filter_ann] = self.orig_ann[filter_ann]
-        self.backup = np.copy(self.annCPY)
+        Save changes applied on the annotations since the last save. Voxels back to their original
+        group recover their original region id. Update backup.
+
+        :return: Number of voxels modified in the annotations.
+        :rtype: int
+        """
+        box = self.__box()
+        current = self.annCPY[box]
+        local = np.where((current != self.saved_state) * (current != DICT_REG_NUMBERS["prot"]))
+        codes = current[local]
+        original = codes == self.original_state[local]
+        filter_ = tuple(coords + start for coords, (start, _) in zip(local, self.ids))
+        values = self.inv_dict_reg_ids[codes]
+        if self.orig_ann is not None:
+            values[original] = self.orig_ann[filter_][original]
+        else:
+            values[original] = self.original_ids[local][original]
+        self.annotation[filter_] = values
+        self.saved_state[...] = current
+        self.backup[box] = current
+        for view in self.views:
+            view.committed = view.committed or len(codes) > 0
+        return len(codes)
@@ -0,0 +1,251 @@
+"""
+Headless correction of the cerebellar annotations, driven by a script of edit operations.
+
+A script is a JSON (or YAML, if PyYAML is installed) file with the following structure::
+
+    {
+        "nissl": "data/ara_nissl_25.nrrd",
+        "annotation": "data/annotation_corrected_clfd.npy",
+        "backup": "data/annotation_corrected_clf.npy",
+        "hierarchy": "data/brain_regions.json",
+        "output": "data/annotation_corrected_clfd.npy",
+        "protected_regions": ["Lingula (I)", "Flocculus", "Crus 1"],
+        "processes": 4,
+        "regions": [
+            {
+                "region": "Lobule II",
+                "axis": 0,
+                "operations": [
+                    {"op": "paint", "slice": 350, "key": "gl", "points": [[10, 12], [30, 40]]},
+                    {"op": "erase", "slice": 350, "points": [[10, 12], [12, 20]]},
+                    {"op": "fill", "slice": 351, "key": "mol", "position": [20, 25]},
+                    {"op": "fill_3d", "key": "fib", "position": [352, 140, 230]},
+                    {"op": "interpolate", "key_slices": [350, 360, 380]},
+                    {"op": "wand", "slice": 352, "key": "gl", "position": [40, 52],
+                     "tolerance": 20, "keys": ["mol", "gl"]},
+                    {"op": "wand_3d", "key": "gl", "position": [352, 140, 230], "tolerance": 20},
+                    {"op": "clean", "operation": "remove_islands", "key": "gl", "size": 20,
+                     "planar": false},
+                    {"op": "undo"}
+                ]
+            }
+        ]
+    }
+
+The 2D positions (points of the paint polylines, eraser polylines, fill and wand positions) are
+pixel positions (row, column) in the images displayed by the interactive application for the
+slice. The wand tolerances are differences of displayed Nissl intensity (0 to 255).
+The clean operations are the morphological operations of AnnotationImage.clean_group, applied
+slice by slice unless planar is false.
+The 3D positions are voxel indices in the annotation volume. The slices and 3D positions must be
+inside the bounding box of the region (AnnotationImage.ids).
+Regions are corrected independently and their changes are merged in the order of the script.
+"""
+import argparse
+import json
+import multiprocessing
+from time import perf_counter
+
+import numpy as np
+
+from annotate_cerebellum.annotation_image import AnnotationImage
+from annotate_cerebellum.hierarchy import BrainHierarchy, cerebellar_layer_ids
+from annotate_cerebellum.utils import DEFAULT_HEADER, draw_2d_line, load_nrrd_npy_files, \
+    save_nrrd_npy_file
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Volumes shared with the worker processes
+_VOLUMES = {}
+
+
+def load_script(filename):
+    """
+    Load a correction script from a JSON or YAML file.
+
+    :param str filename: path to the script.
+    :return: content of the script
+    :rtype: dict
+    """
+    with open(filename, "r") as f:
+        if filename.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise Exception("PyYAML is required to read YAML scripts.")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _polyline(points):
+    """
+    Pixels crossed by a polyline.
+    """
+    points = np.reshape(np.asarray(points, dtype=int), (-1, 2))
+    if len(points) == 1:
+        return points
+    return np.unique(np.concatenate([draw_2d_line(x0, y0, x1, y1)
+                                     for (x0, y0), (x1, y1) in zip(points[:-1], points[1:])]),
+                     axis=0)
+
+
+def _check_position(annotation_image, operation):
+    """
+    Check that the slice and the 3D position of an operation are inside the bounding box of the
+    region, the edits outside of it being ignored when the changes are computed.
+    """
+    ids = annotation_image.ids
+    axis = annotation_image.axis
+    if "slice" in operation and not ids[axis, 0] <= int(operation["slice"]) <= ids[axis, 1]:
+        raise Exception("The slice {} of the operation {} is outside of the region (slices {} to "
+                        "{}).".format(operation["slice"], operation["op"], ids[axis, 0],
+                                      ids[axis, 1]))
+    if operation["op"] in ["fill_3d", "wand_3d"]:
+        position = np.asarray(operation["position"], dtype=int)
+        if position.shape != (3,) or np.any(position < ids[:, 0]) or \
+                np.any(position > ids[:, 1]):
+            raise Exception("The position {} of the operation {} is outside of the region "
+                            "(voxels {} to {}).".format(operation["position"], operation["op"],
+                                                        ids[:, 0].tolist(), ids[:, 1].tolist()))
+
+
+def apply_operations(annotation_image, operations):
+    """
+    Apply a list of edit operations on an annotation model. The operations whose slice or 3D
+    position is outside of the bounding box of the region raise an exception.
+
+    :param AnnotationImage annotation_image: annotation model to modify.
+    :param list operations: list of operations, see the module documentation.
+    """
+    for operation in operations:
+        op = operation["op"]
+        _check_position(annotation_image, operation)
+        if "slice" in operation and operation["slice"] != annotation_image.slice_pos:
+            annotation_image.change_slice(int(operation["slice"]))
+        if op == "paint":
+            annotation_image.update_slice(_polyline(operation["points"]), operation["key"])
+        elif op == "erase":
+            annotation_image.revert_voxels(_polyline(operation["points"]))
+        elif op == "fill":
+            annotation_image.fill(np.asarray(operation["position"], dtype=int), operation["key"])
+        elif op == "fill_3d":
+            annotation_image.fill_3d(operation["position"], operation["key"])
+        elif op == "wand":
+            annotation_image.wand(operation["position"], operation["key"],
+                                  operation["tolerance"], operation.get("keys"))
+        elif op == "wand_3d":
+            annotation_image.wand_3d(operation["position"], operation["key"],
+                                     operation["tolerance"], operation.get("keys"))
+        elif op == "interpolate":
+            annotation_image.interpolate_slices(operation["key_slices"])
+        elif op == "clean":
+            annotation_image.clean_group(operation["operation"], operation["key"],
+                                         operation.get("size", 1), operation.get("planar", True))
+        elif op == "undo":
+            annotation_image.revert_slice()
+        else:
+            raise Exception("Operation not recognized: {}.".format(op))
+
+
+def correct_region(annotation, nissl, backup, dict_reg_ids, axis, operations):
+    """
+    Apply the operations of a region on its annotation model and compute the resulting changes of
+    the annotations, without modifying the input volumes.
+
+    :param ndarray annotation: Volumetric array of brain region ids.
+    :param ndarray nissl: Volumetric array of nissl expression.
+    :param ndarray backup: Volumetric array of the original brain region ids.
+    :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS to their list of
+        brain region ids.
+    :param int axis: Axis of the slices.
+    :param list operations: list of operations, see the module documentation.
+    :return: flat indices of the modified voxels of the annotations and their new region ids.
+    :rtype: tuple
+    """
+    annotation_image = AnnotationImage(annotation, dict_reg_ids, nissl, axis, backup)
+    box = tuple(slice(start, stop + 1) for start, stop in annotation_image.ids)
+    initial_state = np.copy(annotation_image.annCPY[box])
+    apply_operations(annotation_image, operations)
+    final_state = annotation_image.annCPY[box]
+    voxels = np.where(final_state != initial_state)
+    voxels = tuple(coords + start for coords, (start, _) in zip(voxels, annotation_image.ids))
+    codes = annotation_image.annCPY[voxels]
+    backup_codes = annotation_image.backup[voxels]
+    # Same rule as AnnotationImage.apply_changes: voxels back to their original group recover
+    # their original region id.
+    reference = backup if backup is not None else annotation
+    values = np.where(codes == backup_codes, reference[voxels],
+                      annotation_image.inv_dict_reg_ids[codes])
+    return np.ravel_multi_index(voxels, annotation.shape), values.astype(annotation.dtype)
+
+
+def _init_worker(volumes):
+    _VOLUMES.update(volumes)
+
+
+def _correct_region_worker(task):
+    dict_reg_ids, axis, operations = task
+    return correct_region(_VOLUMES["annotation"], _VOLUMES["nissl"], _VOLUMES["backup"],
+                          dict_reg_ids, axis, operations)
+
+
+def run_script(script, processes=None):
+    """
+    Load the volumes once, apply the operations of each region of a correction script and save
+    the corrected annotations.
+
+    :param dict script: content of the correction script, see the module documentation.
+    :param int processes: number of worker processes. Overrides the value of the script.
+        Regions are corrected in the main process if it is 1.
+    :return: corrected annotations
+    :rtype: ndarray
+    """
+    start = perf_counter()
+    hierarchy = BrainHierarchy.from_json(script["hierarchy"])
+    lobules = cerebellar_layer_ids(hierarchy, script.get("protected_regions", []))
+    filenames = [script["nissl"], script["annotation"]]
+    if script.get("backup", None):
+        filenames.append(script["backup"])
+    volumes = load_nrrd_npy_files(filenames, check_shapes=True)
+    volumes = dict(zip(["nissl", "annotation", "backup"], volumes + [None]))
+    print("Volumes loaded in {:.2f}s".format(perf_counter() - start))
+
+    tasks = []
+    for region in script["regions"]:
+        if region["region"] not in lobules:
+            raise Exception("Region not recognized: {}.".format(region["region"]))
+        tasks.append((lobules[region["region"]], int(region.get("axis", 0)),
+                      region.get("operations", [])))
+    processes = processes or script.get("processes", 1)
+    if processes > 1 and len(tasks) > 1:
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        with multiprocessing.get_context(method).Pool(min(processes, len(tasks)), _init_worker,
+                                                      (volumes,)) as pool:
+            results = pool.map(_correct_region_worker, tasks)
+    else:
+        _init_worker(volumes)
+        results = [_correct_region_worker(task) for task in tasks]
+
+    annotation = volumes["annotation"]
+    for region, (indices, values) in zip(script["regions"], results):
+        annotation.flat[indices] = values
+        print("{}: {} voxels modified".format(region["region"], len(indices)))
+    if script.get("output", None):
+        save_nrrd_npy_file(script["output"], annotation, header=DEFAULT_HEADER)
+    print("Script applied in {:.2f}s".format(perf_counter() - start))
+    return annotation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply a correction script on the cerebellar "
+                                                 "annotations without graphical interface")
+    parser.add_argument("script", help="JSON or YAML correction script")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of regions corrected in parallel")
+    args = parser.parse_args()
+    run_script(load_script(args.script), args.processes)
+
+
+if __name__ == "__main__":
+    main()
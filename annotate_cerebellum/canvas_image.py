@@ -12,6 +12,8 @@ import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
 
+from annotate_cerebellum.profiling import profiled
+
 
 class AutoScrollbar(ttk.Scrollbar):
     """
@@ -177,6 +179,7 @@ class CanvasImage:
         return (self.canvas.canvasx(0) - self.canvas.coords(self.container)[0],
                 self.canvas.canvasy(0) - self.canvas.coords(self.container)[1])
 
+    @profiled("CanvasImage.show_image")
     def show_image(self):
         """
         Show image on the Canvas. Implements correct image zoom almost like in Google Maps
@@ -228,6 +231,7 @@ class CanvasImage:
             self.canvas.lower(imageid)  # set image into background
             self.canvas.imagetk = imagetk  # keep an extra reference to prevent garbage-collection
 
+    @profiled("CanvasImage.load_image")
     def load_image(self):
         with warnings.catch_warnings():  # suppress DecompressionBombWarning
             warnings.simplefilter('ignore')
@@ -256,6 +260,13 @@ class CanvasImage:
             h /= self.__reduction  # divide on reduction degree
             self.__pyramid.append(self.__pyramid[-1].resize((int(w), int(h)), self.__filter))
 
+    def buffers(self):
+        """
+        Get the buffers held by the view, to account for the memory it uses.
+        """
+        return {"image_array": self.image_array, "pyramid": self.__pyramid}
+
+    @profiled("CanvasImage.update_image")
     def update_image(self, image):
         self.image_array = np.copy(image)
         self.load_image()
@@ -0,0 +1,271 @@
+"""
+Local chunked storage format for volumetric arrays that do not fit comfortably in memory.
+
+A chunked volume is a directory containing fixed-size zlib compressed chunks and a JSON index
+(``index.json``) describing the shape, data type and chunk shape of the volume. For integer
+volumes, the index also lists the values present in each chunk so that the bounding box of a set
+of region ids can be found without decompressing any chunk.
+"""
+import json
+import os
+import zlib
+from os.path import isdir, isfile, join
+
+import numpy as np
+
+CHUNKED_EXTENSION = ".chunks"
+INDEX_FILENAME = "index.json"
+DEFAULT_CHUNK_SHAPE = (64, 64, 64)
+
+
+def is_chunked_volume(filename):
+    """
+    Check if a path corresponds to a chunked volume directory.
+
+    :param str filename: path to test.
+    :return: True if the path has the chunked volume extension.
+    :rtype: bool
+    """
+    return filename.rstrip("/\\").endswith(CHUNKED_EXTENSION)
+
+
+class ChunkedVolume:
+    """
+    Volumetric array stored on disk as a directory of compressed chunks plus a JSON index.
+    Supports region of interest reads and writes, only touching the chunks intersecting the
+    region.
+    """
+
+    def __init__(self, path):
+        """
+        Open an existing chunked volume.
+
+        :param str path: path to the chunked volume directory.
+        """
+        self.path = path
+        index_file = join(path, INDEX_FILENAME)
+        if not isfile(index_file):
+            raise Exception("No chunked volume index found in {}.".format(path))
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.chunk_shape = tuple(index["chunk_shape"])
+        self.fill_value = index["fill_value"]
+        self.compression_level = index["compression_level"]
+        self.labels = index.get("labels", None)
+        self.n_chunks = tuple(int(np.ceil(s / c)) for s, c in zip(self.shape, self.chunk_shape))
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunk_shape=DEFAULT_CHUNK_SHAPE, fill_value=0,
+               compression_level=6):
+        """
+        Create an empty chunked volume. Chunks which are never written are filled with
+        fill_value.
+
+        :param str path: path to the chunked volume directory.
+        :param tuple shape: shape of the volume.
+        :param dtype: data type of the volume.
+        :param tuple chunk_shape: shape of each chunk.
+        :param fill_value: value of the voxels that have not been written.
+        :param int compression_level: zlib compression level, between 0 and 9.
+        :return: chunked volume object
+        :rtype: ChunkedVolume
+        """
+        if len(shape) != len(chunk_shape):
+            raise Exception("The chunk shape must have the same dimension as the volume.")
+        dtype = np.dtype(dtype)
+        if not isdir(path):
+            os.makedirs(path)
+        for filename in os.listdir(path):
+            if filename.endswith(".z"):
+                os.remove(join(path, filename))
+        index = {
+            "shape": [int(s) for s in shape],
+            "dtype": dtype.str,
+            "chunk_shape": [int(s) for s in chunk_shape],
+            "fill_value": fill_value.item() if isinstance(fill_value, np.generic) else fill_value,
+            "compression_level": int(compression_level),
+        }
+        if np.issubdtype(dtype, np.integer):
+            index["labels"] = {}
+        with open(join(path, INDEX_FILENAME), "w") as f:
+            json.dump(index, f)
+        return cls(path)
+
+    @classmethod
+    def from_array(cls, path, data, chunk_shape=DEFAULT_CHUNK_SHAPE, compression_level=6):
+        """
+        Store a volumetric array as a chunked volume.
+
+        :param str path: path to the chunked volume directory.
+        :param ndarray data: volumetric array to store.
+        :param tuple chunk_shape: shape of each chunk.
+        :param int compression_level: zlib compression level, between 0 and 9.
+        :return: chunked volume object
+        :rtype: ChunkedVolume
+        """
+        volume = cls.create(path, data.shape, data.dtype, chunk_shape,
+                            compression_level=compression_level)
+        volume.write(data)
+        return volume
+
+    def __chunk_file(self, chunk_id):
+        return join(self.path, "_".join(str(i) for i in chunk_id) + ".z")
+
+    def __save_index(self):
+        index = {
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "chunk_shape": list(self.chunk_shape),
+            "fill_value": self.fill_value,
+            "compression_level": self.compression_level,
+        }
+        if self.labels is not None:
+            index["labels"] = self.labels
+        with open(join(self.path, INDEX_FILENAME), "w") as f:
+            json.dump(index, f)
+
+    def __chunk_bounds(self, chunk_id):
+        return tuple(slice(i * c, min((i + 1) * c, s))
+                     for i, c, s in zip(chunk_id, self.chunk_shape, self.shape))
+
+    def __normalize_roi(self, roi):
+        """
+        Convert a region of interest into a tuple of start and stop positions.
+        """
+        if roi is None:
+            roi = ()
+        if not isinstance(roi, tuple):
+            roi = (roi,)
+        if len(roi) > len(self.shape):
+            raise Exception("Too many indices for the chunked volume.")
+        roi = roi + (slice(None),) * (len(self.shape) - len(roi))
+        bounds = []
+        for index, dim in zip(roi, self.shape):
+            if not isinstance(index, slice):
+                raise Exception("Only slices are supported to index chunked volumes.")
+            start, stop, step = index.indices(dim)
+            if step != 1:
+                raise Exception("Strided slices are not supported for chunked volumes.")
+            bounds.append((start, max(start, stop)))
+        return bounds
+
+    def __intersecting_chunks(self, bounds):
+        ranges = [range(start // c, (stop - 1) // c + 1) if stop > start else range(0)
+                  for (start, stop), c in zip(bounds, self.chunk_shape)]
+        return np.stack(np.meshgrid(*ranges, indexing="ij"), -1).reshape(-1, len(self.shape))
+
+    def read_chunk(self, chunk_id):
+        """
+        Read and decompress a single chunk.
+
+        :param tuple chunk_id: index of the chunk in the chunk grid.
+        :return: content of the chunk.
+        :rtype: ndarray
+        """
+        chunk_bounds = self.__chunk_bounds(chunk_id)
+        chunk_shape = tuple(b.stop - b.start for b in chunk_bounds)
+        filename = self.__chunk_file(chunk_id)
+        if not isfile(filename):
+            return np.full(chunk_shape, self.fill_value, dtype=self.dtype)
+        with open(filename, "rb") as f:
+            buffer = zlib.decompress(f.read())
+        return np.frombuffer(buffer, dtype=self.dtype).reshape(chunk_shape).copy()
+
+    def write_chunk(self, chunk_id, data):
+        """
+        Compress and write a single chunk.
+
+        :param tuple chunk_id: index of the chunk in the chunk grid.
+        :param ndarray data: content of the chunk.
+        """
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        with open(self.__chunk_file(chunk_id), "wb") as f:
+            f.write(zlib.compress(data.tobytes(), self.compression_level))
+        if self.labels is not None:
+            self.labels["_".join(str(i) for i in chunk_id)] = np.unique(data).tolist()
+
+    def read(self, roi=None):
+        """
+        Read a region of interest of the volume. Only the chunks intersecting the region are
+        decompressed.
+
+        :param tuple roi: tuple of slices defining the region of interest, e.g. np.s_[10:20, :, 5:].
+            If None, the whole volume is read.
+        :return: array of the region of interest.
+        :rtype: ndarray
+        """
+        bounds = self.__normalize_roi(roi)
+        result = np.full([stop - start for start, stop in bounds], self.fill_value,
+                         dtype=self.dtype)
+        for chunk_id in self.__intersecting_chunks(bounds):
+            chunk_bounds = self.__chunk_bounds(chunk_id)
+            inter = [(max(b.start, start), min(b.stop, stop))
+                     for b, (start, stop) in zip(chunk_bounds, bounds)]
+            chunk = self.read_chunk(chunk_id)
+            result[tuple(slice(lo - start, hi - start)
+                         for (lo, hi), (start, _) in zip(inter, bounds))] = \
+                chunk[tuple(slice(lo - b.start, hi - b.start)
+                            for (lo, hi), b in zip(inter, chunk_bounds))]
+        return result
+
+    def write(self, data, roi=None):
+        """
+        Write an array in a region of interest of the volume. Only the chunks intersecting the
+        region are rewritten.
+
+        :param ndarray data: array to write. Its shape must match the region of interest.
+        :param tuple roi: tuple of slices defining the region of interest. If None, the whole
+            volume is written.
+        """
+        bounds = self.__normalize_roi(roi)
+        data = np.asarray(data)
+        if data.shape != tuple(stop - start for start, stop in bounds):
+            raise Exception("The data shape does not match the region of interest.")
+        for chunk_id in self.__intersecting_chunks(bounds):
+            chunk_bounds = self.__chunk_bounds(chunk_id)
+            inter = [(max(b.start, start), min(b.stop, stop))
+                     for b, (start, stop) in zip(chunk_bounds, bounds)]
+            full_chunk = all(lo == b.start and hi == b.stop
+                             for (lo, hi), b in zip(inter, chunk_bounds))
+            chunk = None if full_chunk else self.read_chunk(chunk_id)
+            part = data[tuple(slice(lo - start, hi - start)
+                              for (lo, hi), (start, _) in zip(inter, bounds))]
+            if full_chunk:
+                chunk = part
+            else:
+                chunk[tuple(slice(lo - b.start, hi - b.start)
+                            for (lo, hi), b in zip(inter, chunk_bounds))] = part
+            self.write_chunk(chunk_id, chunk)
+        self.__save_index()
+
+    def __getitem__(self, roi):
+        return self.read(roi)
+
+    def __setitem__(self, roi, data):
+        bounds = self.__normalize_roi(roi)
+        self.write(np.broadcast_to(data, [stop - start for start, stop in bounds]), roi)
+
+    def bounding_box(self, ids):
+        """
+        Find the bounding box of the chunks containing any of the values in ids. Uses the index
+        only, no chunk is decompressed.
+
+        :param list ids: list of values (e.g. region ids) to look for.
+        :return: Array of [start, stop[ positions for each dimension, aligned on the chunk grid,
+            or None if no chunk contains the values.
+        :rtype: ndarray
+        """
+        if self.labels is None:
+            raise Exception("Bounding boxes can only be computed on integer chunked volumes.")
+        ids = np.asarray(ids)
+        chunk_ids = [np.array(key.split("_"), dtype=int) for key, values in self.labels.items()
+                     if np.any(np.isin(values, ids))]
+        if len(chunk_ids) == 0:
+            return None
+        chunk_ids = np.array(chunk_ids)
+        chunk_shape = np.array(self.chunk_shape)
+        return np.array([np.min(chunk_ids, axis=0) * chunk_shape,
+                         np.minimum((np.max(chunk_ids, axis=0) + 1) * chunk_shape,
+                                    self.shape)]).T
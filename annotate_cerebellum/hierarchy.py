@@ -0,0 +1,477 @@
+"""
+Array based index of the brain region hierarchy from the AIBS.
+"""
+import hashlib
+import json
+import os
+from bisect import bisect_left
+from collections import OrderedDict
+from os.path import isfile
+
+import numpy as np
+
+
+def hex_to_rgb(value):
+    """
+    Converts a Hexadecimal color into its RGB value counterpart.
+
+    :param str value: hexadecimal color to convert.
+    :return: Red, Green, and Blue components of the color
+    :rtype: tuple
+    """
+    value = value.lstrip('#')
+    lv = len(value)
+    return tuple(int(value[i:i + lv // 3], 16) for i in range(0, lv, lv // 3))
+
+
+class BrainHierarchy:
+    """
+    Brain region hierarchy stored as arrays of nodes in depth-first pre-order.
+    Each node is identified by its index in these arrays. Since the nodes are sorted in pre-order,
+    the descendants of a node are the contiguous nodes between its entry and exit positions of the
+    Euler tour of the tree.
+    """
+
+    def __init__(self, ids, names, acronyms, parents, colors, root_parent_full_name="",
+                 root_parent_name=""):
+        """
+        Initialize the hierarchy index from arrays of nodes sorted in depth-first pre-order.
+
+        :param ndarray ids: region ids of the nodes.
+        :param list names: region names of the nodes.
+        :param list acronyms: region acronyms of the nodes.
+        :param ndarray parents: index of the parent of each node, -1 for the root.
+        :param ndarray colors: RGB colors of the nodes, as float array of shape (n, 3).
+        :param str root_parent_full_name: complete name of the parent of the root, if the
+            hierarchy is a sub-tree of a larger hierarchy.
+        :param str root_parent_name: name of the parent of the root.
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = list(names)
+        self.acronyms = list(acronyms)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.colors = np.asarray(colors, dtype=np.float32)
+        self.root_parent_full_name = root_parent_full_name
+        self.root_parent_name = root_parent_name
+        self.cache_key = ""
+        n_nodes = len(self.ids)
+        if np.any(self.parents >= np.arange(n_nodes)):
+            raise Exception("The hierarchy nodes must be sorted in depth-first pre-order.")
+
+        self.depth = np.zeros(n_nodes, dtype=np.int64)
+        for i in range(1, n_nodes):
+            self.depth[i] = self.depth[self.parents[i]] + 1
+        self.is_leaf = np.ones(n_nodes, dtype=bool)
+        self.is_leaf[self.parents[self.parents >= 0]] = False
+        # Euler tour: node i covers the positions [entry[i], exit[i][ of the pre-order arrays
+        subtree_size = np.ones(n_nodes, dtype=np.int64)
+        for depth in range(int(np.max(self.depth, initial=0)), 0, -1):
+            nodes = np.where(self.depth == depth)[0]
+            np.add.at(subtree_size, self.parents[nodes], subtree_size[nodes])
+        self.entry = np.arange(n_nodes)
+        self.exit = self.entry + subtree_size
+
+        self.__sorter = np.argsort(self.ids, kind="stable")
+        self.__full_names = None
+        self.__full_name_to_index = None
+        self.__name_to_index = None
+
+    @classmethod
+    def from_dict(cls, root, darken=True, root_parent_full_name="", root_parent_name=""):
+        """
+        Build the hierarchy index from the nested dictionary of the AIBS json file.
+        The tree is explored iteratively so that deep hierarchies do not reach the recursion limit.
+
+        :param dict root: dictionary of regions properties of the root region. See
+            https://bbpteam.epfl.ch/documentation/projects/voxcell/latest/atlas.html#brain-region-hierarchy
+        :param bool darken: if True, darkens the region colors too high
+        :param str root_parent_full_name: complete name of the parent of the root
+        :param str root_parent_name: name of the parent of the root
+        :return: hierarchy index
+        :rtype: BrainHierarchy
+        """
+        ids, names, acronyms, parents, colors = [], [], [], [], []
+        to_explore = [(root, -1)]
+        while len(to_explore) > 0:
+            object_, parent = to_explore.pop()
+            index = len(ids)
+            ids.append(object_["id"])
+            names.append(object_["name"])
+            acronyms.append(object_["acronym"])
+            parents.append(parent)
+            colors.append(hex_to_rgb(object_["color_hex_triplet"]))
+            to_explore.extend((child, index) for child in reversed(object_.get("children", [])))
+        colors = np.array(colors, dtype=np.float32).reshape(-1, 3)
+        if darken:
+            sums = np.sum(colors, axis=1)
+            too_bright = sums > 255.0 * 3.0 * 0.75
+            colors[too_bright] *= (255.0 * 3.0 * 0.75 / sums[too_bright])[:, None]
+        return cls(ids, names, acronyms, parents, colors, root_parent_full_name, root_parent_name)
+
+    @classmethod
+    def from_json(cls, filename, darken=True, cache=True):
+        """
+        Build the hierarchy index from an AIBS json file.
+        If cache is True, the parsed hierarchy is stored in a binary file next to the json file
+        (with the .cache.npz extension) and reloaded from it as long as the json file content does
+        not change.
+
+        :param str filename: path to the json file.
+        :param bool darken: if True, darkens the region colors too high
+        :param bool cache: if True, uses the binary cache of the hierarchy.
+        :return: hierarchy index
+        :rtype: BrainHierarchy
+        """
+        with open(filename, "rb") as f:
+            raw_content = f.read()
+        cache_file = filename + ".cache.npz"
+        if cache:
+            key = hashlib.sha1(raw_content).hexdigest() + ("_darken" if darken else "")
+            if isfile(cache_file):
+                try:
+                    hierarchy = cls.load(cache_file)
+                except Exception:
+                    # Unreadable cache, e.g. truncated: the json file is parsed again
+                    hierarchy = None
+                if hierarchy is not None and hierarchy.cache_key == key:
+                    return hierarchy
+        content = json.loads(raw_content)
+        if "msg" in content:
+            content = content["msg"][0]
+        hierarchy = cls.from_dict(content, darken)
+        if cache:
+            hierarchy.save(cache_file, key)
+        return hierarchy
+
+    def save(self, filename, cache_key=""):
+        """
+        Save the hierarchy index in a binary numpy file. The index is written to a temporary file
+        which replaces the file at the end, so that the processes reading the file concurrently
+        never see a partial file.
+
+        :param str filename: path to the npz file.
+        :param str cache_key: key identifying the source of the hierarchy.
+        """
+        temporary = "{}.{}.tmp".format(filename, os.getpid())
+        with open(temporary, "wb") as f:
+            np.savez(f, ids=self.ids, names=np.array(self.names, dtype=str),
+                     acronyms=np.array(self.acronyms, dtype=str), parents=self.parents,
+                     colors=self.colors, is_leaf=self.is_leaf, depth=self.depth,
+                     exit=self.exit, root_parent_full_name=self.root_parent_full_name,
+                     root_parent_name=self.root_parent_name, cache_key=cache_key)
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a hierarchy index saved with BrainHierarchy.save.
+
+        :param str filename: path to the npz file.
+        :return: hierarchy index
+        :rtype: BrainHierarchy
+        """
+        with np.load(filename) as content:
+            hierarchy = cls.__new__(cls)
+            hierarchy.ids = content["ids"]
+            hierarchy.names = content["names"].tolist()
+            hierarchy.acronyms = content["acronyms"].tolist()
+            hierarchy.parents = content["parents"]
+            hierarchy.colors = content["colors"]
+            hierarchy.is_leaf = content["is_leaf"]
+            hierarchy.depth = content["depth"]
+            hierarchy.entry = np.arange(len(hierarchy.ids))
+            hierarchy.exit = content["exit"]
+            hierarchy.root_parent_full_name = str(content["root_parent_full_name"])
+            hierarchy.root_parent_name = str(content["root_parent_name"])
+            hierarchy.cache_key = str(content["cache_key"])
+        hierarchy.__sorter = np.argsort(hierarchy.ids, kind="stable")
+        hierarchy.__full_names = None
+        hierarchy.__full_name_to_index = None
+        hierarchy.__name_to_index = None
+        return hierarchy
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def full_names(self):
+        """
+        Complete names of the nodes, i.e. the names of their ancestors and their own name joined
+        with "|". Computed on first access.
+        """
+        if self.__full_names is None:
+            full_names = []
+            for name, parent in zip(self.names, self.parents):
+                prefix = full_names[parent] if parent >= 0 else self.root_parent_full_name
+                full_names.append(prefix + "|" + name)
+            self.__full_names = full_names
+        return self.__full_names
+
+    def index(self, ids):
+        """
+        Convert region ids into node indices.
+
+        :param ids: region id or array of region ids.
+        :return: node index or array of node indices.
+        """
+        ids = np.asarray(ids)
+        positions = np.searchsorted(self.ids, ids, sorter=self.__sorter)
+        positions = np.minimum(positions, len(self.ids) - 1)
+        indices = self.__sorter[positions]
+        if np.any(self.ids[indices] != ids):
+            raise KeyError("Region id not found in the hierarchy: {}".format(
+                ids[self.ids[indices] != ids] if ids.ndim > 0 else ids))
+        return int(indices) if indices.ndim == 0 else indices
+
+    def contains(self, ids):
+        """
+        Check which region ids belong to the hierarchy.
+
+        :param ids: array of region ids.
+        :return: boolean array, True if the region id is in the hierarchy.
+        :rtype: ndarray
+        """
+        ids = np.asarray(ids)
+        positions = np.minimum(np.searchsorted(self.ids, ids, sorter=self.__sorter),
+                               len(self.ids) - 1)
+        return self.ids[self.__sorter[positions]] == ids
+
+    def index_from_full_name(self, full_name):
+        """
+        Convert a region complete name into a node index.
+
+        :param str full_name: complete name of the region.
+        :return: node index
+        :rtype: int
+        """
+        if self.__full_name_to_index is None:
+            self.__full_name_to_index = {name: i for i, name in enumerate(self.full_names)}
+        return self.__full_name_to_index[full_name]
+
+    def index_from_name(self, name):
+        """
+        Convert a region name into a node index.
+
+        :param str name: name of the region.
+        :return: node index
+        :rtype: int
+        """
+        if self.__name_to_index is None:
+            self.__name_to_index = {name: i for i, name in enumerate(self.names)}
+        return self.__name_to_index[name]
+
+    def is_descendant(self, id_reg, id_ancestor, strict=False):
+        """
+        Check if a region is contained in another region.
+
+        :param id_reg: region id or array of region ids to test.
+        :param int id_ancestor: region id of the potential ancestor.
+        :param bool strict: if True, a region is not considered as its own descendant.
+        :return: boolean or array of booleans
+        """
+        index = self.index(id_reg)
+        ancestor = self.index(id_ancestor)
+        start = self.entry[ancestor] + 1 if strict else self.entry[ancestor]
+        return (start <= index) & (index < self.exit[ancestor])
+
+    def descendants(self, id_reg, include_self=False, leaves_only=False):
+        """
+        Get the region ids of all the regions contained in a region.
+
+        :param int id_reg: region id.
+        :param bool include_self: if True, includes id_reg in the result.
+        :param bool leaves_only: if True, returns only the leaf regions.
+        :return: array of region ids, sorted in pre-order
+        :rtype: ndarray
+        """
+        index = self.index(id_reg)
+        nodes = np.s_[self.entry[index] + (0 if include_self else 1):self.exit[index]]
+        if leaves_only:
+            return self.ids[nodes][self.is_leaf[nodes]]
+        return self.ids[nodes]
+
+    def ancestors(self, id_reg, include_self=False):
+        """
+        Get the region ids of all the regions containing a region, from the closest to the root.
+
+        :param int id_reg: region id.
+        :param bool include_self: if True, includes id_reg in the result.
+        :return: array of region ids
+        :rtype: ndarray
+        """
+        index = self.index(id_reg)
+        nodes = [index] if include_self else []
+        index = self.parents[index]
+        while index >= 0:
+            nodes.append(index)
+            index = self.parents[index]
+        return self.ids[np.array(nodes, dtype=np.int64)]
+
+    def to_dictionaries(self):
+        """
+        Export the hierarchy as the dictionaries of region properties used in JSONread.
+
+        :return: dictionary of dictionaries, keyed by the name of the JSONread variables.
+        :rtype: dict
+        """
+        full_names = self.full_names
+        ids = self.ids.tolist()
+        parent_full_names = [full_names[p] if p >= 0 else self.root_parent_full_name
+                             for p in self.parents]
+        parent_names = [self.names[p] if p >= 0 else self.root_parent_name for p in self.parents]
+        colors = [list(color) for color in self.colors]
+        return {
+            "id_to_region_dictionary": dict(zip(ids, self.names)),
+            "id_to_region_dictionary_ALLNAME": dict(zip(ids, full_names)),
+            "region_dictionary_to_id": dict(zip(self.names, ids)),
+            "region_dictionary_to_id_ALLNAME": dict(zip(full_names, ids)),
+            "region_dictionary_to_id_ALLNAME_parent": dict(zip(full_names, parent_full_names)),
+            "region_dictionary_to_id_parent": dict(zip(self.names, parent_names)),
+            "allname2name": dict(zip(full_names, self.names)),
+            "name2allname": dict(zip(self.names, full_names)),
+            "region_keys": list(self.names),
+            "regions_ALLNAME_list": list(full_names),
+            "is_leaf": dict(zip(full_names, self.is_leaf.astype(int).tolist())),
+            "id_to_color": dict(zip(ids, colors)),
+            "region_to_color": dict(zip(full_names, colors)),
+            "id_to_abv": dict(zip(ids, self.acronyms)),
+            "region_dictionary_to_abv": dict(zip(self.names, self.acronyms)),
+        }
+
+
+class RegionNameIndex:
+    """
+    Inverted index of region names for case insensitive keyword and prefix queries.
+    Names are indexed by all their substrings of at most ngram characters. A keyword query
+    intersects the posting lists of the keyword n-grams and checks the remaining candidates.
+    """
+
+    def __init__(self, ids, names, is_leaf=None, ngram=3):
+        """
+        Build the index.
+
+        :param list ids: region ids.
+        :param list names: region names (e.g. complete names) matching the ids.
+        :param list is_leaf: booleans, True if the region is a leaf region.
+        :param int ngram: maximum length of the indexed substrings.
+        """
+        self.ids = list(ids)
+        self.names = [name.lower() for name in names]
+        self.is_leaf = np.ones(len(self.ids), dtype=bool) if is_leaf is None \
+            else np.asarray(is_leaf, dtype=bool)
+        self.ngram = ngram
+        postings = {}
+        tokens = {}
+        for position, name in enumerate(self.names):
+            grams = {name[i:i + n] for n in range(1, ngram + 1)
+                     for i in range(len(name) - n + 1)}
+            for gram in grams:
+                postings.setdefault(gram, []).append(position)
+            for token in "".join(c if c.isalnum() else " " for c in name).split():
+                tokens.setdefault(token, set()).add(position)
+        self.__postings = {gram: np.array(positions) for gram, positions in postings.items()}
+        self.__tokens = sorted(tokens)
+        self.__token_postings = [np.array(sorted(tokens[token])) for token in self.__tokens]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __keyword_positions(self, keyword):
+        """
+        Positions of the names containing the keyword.
+        """
+        if len(keyword) == 0:
+            return np.arange(len(self.ids))
+        if len(keyword) <= self.ngram:
+            return self.__postings.get(keyword, np.zeros(0, dtype=int))
+        postings = []
+        for i in range(len(keyword) - self.ngram + 1):
+            gram_positions = self.__postings.get(keyword[i:i + self.ngram], None)
+            if gram_positions is None:
+                return np.zeros(0, dtype=int)
+            postings.append(gram_positions)
+        # Intersect the rarest n-grams only, the candidates left are checked directly
+        postings.sort(key=len)
+        positions = postings[0]
+        for gram_positions in postings[1:3]:
+            positions = np.intersect1d(positions, gram_positions, assume_unique=True)
+        return np.array([p for p in positions if keyword in self.names[p]], dtype=int)
+
+    def __select(self, positions, leaf_only):
+        if leaf_only:
+            positions = positions[self.is_leaf[positions]]
+        return [self.ids[p] for p in np.sort(positions)]
+
+    def query(self, keywords, leaf_only=False):
+        """
+        Find the regions whose name contains all the keywords, ignoring case.
+
+        :param list keywords: list of keywords.
+        :param bool leaf_only: if True, returns only leaf regions.
+        :return: list of region ids, in the order in which they were indexed.
+        :rtype: list
+        """
+        positions = np.arange(len(self.ids))
+        for keyword in keywords:
+            positions = np.intersect1d(positions, self.__keyword_positions(keyword.lower()),
+                                       assume_unique=True)
+            if len(positions) == 0:
+                break
+        return self.__select(positions, leaf_only)
+
+    def prefix_query(self, text, leaf_only=False):
+        """
+        Find the regions whose name contains words starting with each word of text, ignoring
+        case. Used for interactive region search.
+
+        :param str text: words or beginnings of words to search.
+        :param bool leaf_only: if True, returns only leaf regions.
+        :return: list of region ids, in the order in which they were indexed.
+        :rtype: list
+        """
+        positions = np.arange(len(self.ids))
+        for prefix in "".join(c if c.isalnum() else " " for c in text.lower()).split():
+            start = bisect_left(self.__tokens, prefix)
+            stop = start
+            while stop < len(self.__tokens) and self.__tokens[stop].startswith(prefix):
+                stop += 1
+            matches = self.__token_postings[start:stop]
+            prefix_positions = np.unique(np.concatenate(matches)) if len(matches) > 0 \
+                else np.zeros(0, dtype=int)
+            positions = np.intersect1d(positions, prefix_positions, assume_unique=True)
+        return self.__select(positions, leaf_only)
+
+
+def cerebellar_layer_ids(hierarchy, protected_regions=()):
+    """
+    List the cerebellar cortex lobules of a hierarchy with the region ids of their groups, in the
+    format expected by AnnotationImage.
+
+    :param BrainHierarchy hierarchy: hierarchy index.
+    :param list protected_regions: names of the regions which cannot be modified. The protection
+        is lifted for the lobule being corrected.
+    :return: Ordered dictionary of lobule name to the dictionary linking the keys of
+        DICT_REG_NUMBERS to their list of region ids.
+    :rtype: OrderedDict
+    """
+    name_index = RegionNameIndex(hierarchy.ids.tolist(), hierarchy.full_names, hierarchy.is_leaf)
+    ids_mol = name_index.query(["Cerebellar cortex", "molecular"], True)
+    ids_ft = name_index.query(["cerebellum related fiber tracts"], True)
+    ids_prot = np.concatenate([hierarchy.descendants(hierarchy.ids[hierarchy.index_from_name(name)])
+                               for name in protected_regions] + [np.zeros(0, dtype=np.int64)])
+    lobules = OrderedDict()
+    for id_mol in ids_mol[1:]:  # The first one is the molecular layer of the whole cortex
+        index = hierarchy.index(id_mol)
+        parent = hierarchy.parents[index]
+        parent_full_name = hierarchy.full_names[parent]
+        id_gr = hierarchy.ids[hierarchy.index_from_full_name(
+            parent_full_name + "|" + hierarchy.names[parent] + ", granular layer")]
+        lobules[hierarchy.names[parent]] = {
+            "mol": [id_mol],
+            "gl": [int(id_gr)],
+            "fib": ids_ft,
+            "out": [0],
+            "prot": ids_prot[~hierarchy.is_descendant(ids_prot, hierarchy.ids[parent])].tolist()
+            if len(ids_prot) > 0 else [],
+        }
+    return lobules
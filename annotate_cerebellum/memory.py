@@ -0,0 +1,360 @@
+"""
+Memory accounting of the editing sessions and memory budget.
+
+MemoryAccount lists the buffers held by the annotation models and their views (volumes, working
+annotations, undo states, images and image pyramids), counts the memory shared by several buffers
+once and flags the redundant full-volume copies.
+
+MemoryBudget chooses how the volumes and the annotation model are held so that a session fits in
+a given amount of memory:
+
+* full: the volumes are loaded in memory and the working annotations cover the whole volume.
+* cropped: the working annotations only cover the region of interest, the model working on views
+  of the volumes (see AnnotationImage.multi_planar).
+* compact: the Nissl volume is also stored as 8-bit intensities, converted slab by slab from
+  its file (see load_compact_volume).
+* lazy: numpy volumes are memory mapped so that only the pages of the displayed region are read.
+"""
+import mmap
+
+import numpy as np
+
+from annotate_cerebellum.chunked_volume import ChunkedVolume, is_chunked_volume
+from annotate_cerebellum.rle_volume import RLEVolume
+from annotate_cerebellum.utils import iter_nrrd_slabs, load_nrrd_npy_file, read_volume_shape
+
+MEMORY_MODES = ["full", "cropped", "compact", "lazy"]
+# Peak number of bytes per voxel used to prepare the working annotations: the encoded annotations
+# and backup (int8) and the temporary boolean masks.
+PREPARE_BYTES_PER_VOXEL = 4
+
+
+def _byte_bounds(array):
+    """
+    Get the first and last (excluded) addresses of the memory used by an array.
+    """
+    low = high = array.__array_interface__["data"][0]
+    for dim, stride in zip(array.shape, array.strides):
+        if dim == 0:
+            return low, low
+        if stride < 0:
+            low += stride * (dim - 1)
+        else:
+            high += stride * (dim - 1)
+    return low, high + array.itemsize
+
+
+class AnonymousMap(mmap.mmap):
+    """
+    Anonymous memory map, not backed by a file, written by forked worker processes. Its pages are
+    private to the process once the workers have exited.
+    """
+
+
+def _is_mapped(array):
+    """
+    Check if an array is backed by a memory mapped file or a shared memory block, whose pages are
+    not private to the process.
+    """
+    base = array
+    while base is not None:
+        if isinstance(base, AnonymousMap):
+            return False
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        if isinstance(base, memoryview):
+            base = base.obj
+        else:
+            base = getattr(base, "base", None)
+    return False
+
+
+def _image_size(image):
+    """
+    Size in bytes of a PIL image.
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+class MemoryAccount:
+    """
+    List of the buffers held by an editing session, with the memory they use.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, owner, name, buffer):
+        """
+        Register a buffer.
+
+        :param str owner: name of the object holding the buffer.
+        :param str name: name of the buffer.
+        :param buffer: ndarray, RLEVolume, PIL image or list of PIL images (e.g. an image
+            pyramid).
+        """
+        if buffer is None:
+            return
+        entry = {"owner": owner, "name": name, "shape": None, "dtype": None, "bounds": None,
+                 "mapped": False}
+        if isinstance(buffer, np.ndarray):
+            entry.update(nbytes=int(buffer.nbytes), shape=tuple(buffer.shape),
+                         dtype=str(buffer.dtype), bounds=_byte_bounds(buffer),
+                         mapped=_is_mapped(buffer), array=buffer)
+        elif isinstance(buffer, RLEVolume):
+            entry.update(nbytes=int(buffer.nbytes), shape=tuple(buffer.shape),
+                         dtype="rle " + str(buffer.dtype))
+        elif isinstance(buffer, (list, tuple)):
+            entry.update(nbytes=sum(_image_size(image) for image in buffer))
+        else:
+            entry.update(nbytes=_image_size(buffer))
+        self.entries.append(entry)
+
+    def add_model(self, model, owner="AnnotationImage"):
+        """
+        Register the buffers of an annotation model.
+
+        :param AnnotationImage model: annotation model.
+        :param str owner: name of the model in the report.
+        """
+        for name, buffer in model.buffers().items():
+            self.add(owner, name, buffer)
+
+    def add_canvas(self, canvas, owner="CanvasImage"):
+        """
+        Register the buffers of the view of an annotation model.
+
+        :param CanvasImage canvas: view of the annotations.
+        :param str owner: name of the view in the report.
+        """
+        for name, buffer in canvas.buffers().items():
+            self.add(owner, name, buffer)
+
+    def __resolve(self):
+        """
+        Compute the bytes of each entry not already used by the previous entries, and the entries
+        whose memory is used by a previous entry.
+        """
+        intervals = []
+        for entry in self.entries:
+            entry["shared_with"] = []
+            if entry["bounds"] is None:
+                entry["counted"] = entry["nbytes"]
+                continue
+            low, high = entry["bounds"]
+            covered = []
+            for other, (other_low, other_high) in intervals:
+                start, stop = max(low, other_low), min(high, other_high)
+                if start < stop:
+                    covered.append((start, stop))
+                    name = "{}.{}".format(other["owner"], other["name"])
+                    if name not in entry["shared_with"]:
+                        entry["shared_with"].append(name)
+            covered_bytes, end = 0, low
+            for start, stop in sorted(covered):
+                start = max(start, end)
+                if stop > start:
+                    covered_bytes += stop - start
+                    end = stop
+            entry["counted"] = max(0, min(entry["nbytes"], high - low - covered_bytes))
+            intervals.append((entry, (low, high)))
+
+    def total(self, mapped=False):
+        """
+        Memory used by the registered buffers, each byte being counted once.
+
+        :param bool mapped: if True, get the memory of the memory mapped and shared buffers,
+            whose pages are loaded on demand or shared with other processes, instead of the
+            private memory.
+        :return: number of bytes
+        :rtype: int
+        """
+        self.__resolve()
+        return sum(entry["counted"] for entry in self.entries if entry["mapped"] == mapped)
+
+    def redundant_copies(self):
+        """
+        Find the full-volume buffers that are copies of another buffer, and the derived
+        full-volume buffers that could be cropped because the model only modifies the bounding box
+        of the region.
+
+        :return: list of descriptions of the redundant buffers
+        :rtype: list
+        """
+        self.__resolve()
+        shapes = [entry["shape"] for entry in self.entries if entry["name"] == "annotation"]
+        if len(shapes) == 0:
+            return []
+        volume_shape = max(shapes, key=np.prod)
+        full = [entry for entry in self.entries
+                if entry["shape"] == volume_shape and entry["counted"] > 0 and "array" in entry]
+        messages = []
+        for i, entry in enumerate(full):
+            for other in full[:i]:
+                if entry["dtype"] == other["dtype"] and \
+                        np.array_equal(entry["array"], other["array"]):
+                    messages.append("{}.{} is a copy of {}.{} ({:.1f} MB)".format(
+                        entry["owner"], entry["name"], other["owner"], other["name"],
+                        entry["counted"] / 2 ** 20))
+                    break
+        boxes = [entry for entry in self.entries if entry["name"] == "previous_state"]
+        if len(boxes) > 0:
+            box_size = max(int(np.prod(entry["shape"])) for entry in boxes)
+            for entry in full:
+                if entry["owner"].startswith("AnnotationImage") and \
+                        entry["name"] in ["annCPY", "backup"] and \
+                        box_size < np.prod(volume_shape) / 2:
+                    messages.append("{}.{} covers the whole volume while only {:.0%} of it can "
+                                    "be modified ({:.1f} MB, use the cropped mode)".format(
+                                        entry["owner"], entry["name"],
+                                        box_size / np.prod(volume_shape),
+                                        entry["counted"] / 2 ** 20))
+        return messages
+
+    def report(self):
+        """
+        Describe the memory used by each buffer, the totals and the redundant copies.
+
+        :return: report
+        :rtype: str
+        """
+        self.__resolve()
+        lines = ["{:45s} {:>20s} {:>8s} {:>10s}".format("buffer", "shape", "dtype", "MB")]
+        for entry in self.entries:
+            if entry["mapped"]:
+                status = " (mapped)"
+            elif entry["counted"] < entry["nbytes"]:
+                status = " (shared with {})".format(", ".join(entry["shared_with"]))
+            else:
+                status = ""
+            lines.append("{:45s} {:>20s} {:>8s} {:10.1f}{}".format(
+                "{}.{}".format(entry["owner"], entry["name"])[:45],
+                "x".join(str(dim) for dim in entry["shape"]) if entry["shape"] else "",
+                entry["dtype"] or "", entry["counted"] / 2 ** 20, status))
+        lines.append("Private memory: {:.1f} MB, mapped or shared: {:.1f} MB".format(
+            self.total() / 2 ** 20, self.total(mapped=True) / 2 ** 20))
+        for message in self.redundant_copies():
+            lines.append("Redundant: " + message)
+        return "\n".join(lines)
+
+
+def _quantize(slab, max_value):
+    """
+    Convert a slab of intensities to 8 bits, the maximum intensity being 255.
+    """
+    if max_value <= 0:
+        return np.zeros(slab.shape, dtype=np.uint8)
+    slab = np.asarray(slab, dtype=np.float32)
+    return np.rint(np.clip(slab, 0, None) * (255.0 / max_value)).astype(np.uint8)
+
+
+def compact_volume(volume, slab_size=16):
+    """
+    Convert a volume of intensities (e.g. Nissl expression) to 8-bit intensities, proportional
+    to the original values. The images of the annotation model are normalized slice by slice so
+    they keep the same contrast, up to the quantization.
+
+    :param volume: volume of non-negative intensities, ndarray (e.g. memory mapped) or
+        ChunkedVolume, read by slabs.
+    :param int slab_size: number of planes converted at once.
+    :return: volume of uint8 intensities
+    :rtype: ndarray
+    """
+    compact = np.zeros(volume.shape, dtype=np.uint8)
+    starts = range(0, volume.shape[0], slab_size)
+    max_value = max([float(np.max(volume[start:start + slab_size])) for start in starts],
+                    default=0.0)
+    for start in starts:
+        compact[start:start + slab_size] = _quantize(volume[start:start + slab_size], max_value)
+    return compact
+
+
+def load_compact_volume(filename, slab_size=16):
+    """
+    Load a volume of intensities as 8-bit intensities (see compact_volume) without holding the
+    original volume: numpy files are memory mapped, chunked volumes are read by region of
+    interest and nrrd files are decompressed twice by slabs (to find the maximum intensity, then
+    to convert the slabs).
+
+    :param str filename: path to the npy, nrrd or chunked volume file.
+    :param int slab_size: number of planes converted at once.
+    :return: volume of uint8 intensities
+    :rtype: ndarray
+    """
+    if is_chunked_volume(filename):
+        return compact_volume(ChunkedVolume(filename), slab_size)
+    if not filename.endswith(".nrrd"):
+        return compact_volume(load_nrrd_npy_file(filename, mmap_mode="r"), slab_size)
+    max_value = max([float(np.max(slab)) for _, slab in iter_nrrd_slabs(filename, slab_size)],
+                    default=0.0)
+    compact = np.zeros(read_volume_shape(filename), dtype=np.uint8)
+    for start, slab in iter_nrrd_slabs(filename, slab_size):
+        compact[..., start:start + slab.shape[-1]] = _quantize(slab, max_value)
+    return compact
+
+
+def estimate_model_memory(n_voxels, n_box_voxels, n_views=1, backup=True):
+    """
+    Estimate the peak memory used to prepare an annotation model.
+
+    :param int n_voxels: number of voxels of the volumes given to the model.
+    :param int n_box_voxels: number of voxels of the bounding box of the region.
+    :param int n_views: number of models sharing the working annotations.
+    :param bool backup: True if a backup volume is given to the model.
+    :return: number of bytes
+    :rtype: int
+    """
+    box_bytes = 3 * n_box_voxels + (0 if backup else 4 * n_box_voxels)
+    return PREPARE_BYTES_PER_VOXEL * n_voxels + box_bytes + n_views * 4096 * 1024
+
+
+class MemoryBudget:
+    """
+    Choice of the memory modes of a session so that it fits in a memory budget.
+    """
+
+    def __init__(self, limit):
+        """
+        :param int limit: memory budget in bytes.
+        """
+        self.limit = limit
+
+    def volume_mode(self, filenames):
+        """
+        Choose how to hold the annotation, Nissl and backup volumes, from the headers of their
+        files: in memory (full), with 8-bit Nissl intensities (compact) or memory mapped (lazy,
+        numpy files only). Enough memory must remain to prepare the working annotations of a
+        region.
+
+        :param list filenames: paths to the files of the annotation, Nissl and backup volumes.
+        :return: one of full, compact and lazy
+        :rtype: str
+        """
+        shape = read_volume_shape(filenames[0])
+        n_voxels = int(np.prod(shape))
+        volumes = 4 * n_voxels * len(filenames)  # uint32 annotations and float32 Nissl
+        model = estimate_model_memory(n_voxels, n_voxels // 8)
+        if volumes + model <= self.limit:
+            return "full"
+        if volumes - 3 * n_voxels + model <= self.limit or \
+                not all(filename.endswith(".npy") for filename in filenames):
+            return "compact"
+        return "lazy"
+
+    def model_mode(self, annotation, roi, held=0, n_views=1, backup=True):
+        """
+        Choose whether the working annotations of a region cover the whole volume (full) or only
+        its region of interest (cropped).
+
+        :param ndarray annotation: volume of brain region ids.
+        :param tuple roi: region of interest of the region, see AnnotationImage.region_roi.
+        :param int held: memory already used by the session, e.g. by the volumes.
+        :param int n_views: number of models sharing the working annotations.
+        :param bool backup: True if a backup volume is given to the model.
+        :return: full or cropped
+        :rtype: str
+        """
+        n_roi = int(np.prod([s.stop - s.start for s in roi]))
+        if held + estimate_model_memory(annotation.size, n_roi, n_views, backup) <= self.limit:
+            return "full"
+        return "cropped"
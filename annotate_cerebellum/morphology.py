@@ -0,0 +1,297 @@
+"""
+Vectorized morphological operations on binary masks, used to clean the groups of the working
+annotations after manual painting: hole filling, opening, closing and removal of small islands.
+
+The operations use the cross structuring element (face neighbors). They are applied either in 3D
+or slice by slice (axis parameter: the planes orthogonal to this axis are processed
+independently). The volumes are split into slabs processed in parallel threads, with an overlap
+when the operation propagates across the slabs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from annotate_cerebellum.utils import find_connected
+
+# Number of planes processed by each thread
+SLAB_SIZE = 16
+
+
+def _directions(ndim, axis=None):
+    """
+    Axes along which the neighbors of a voxel are considered.
+    """
+    return [i for i in range(ndim) if i != axis]
+
+
+def _shift(mask, direction, step, fill_value):
+    """
+    Shift a mask by one voxel along a direction, filling the uncovered border with a value.
+    """
+    shifted = np.full(mask.shape, fill_value, dtype=bool)
+    source = [slice(None)] * mask.ndim
+    target = [slice(None)] * mask.ndim
+    if step > 0:
+        source[direction], target[direction] = slice(None, -1), slice(1, None)
+    else:
+        source[direction], target[direction] = slice(1, None), slice(None, -1)
+    shifted[tuple(target)] = mask[tuple(source)]
+    return shifted
+
+
+def _in_slabs(function, mask, axis=None, halo=0, workers=None):
+    """
+    Apply a function on slabs of a mask in parallel threads. Slabs are split along the axis of
+    the planes if provided, otherwise along the first axis with an overlap of halo planes.
+    """
+    split_axis = 0 if axis is None else axis
+    size = mask.shape[split_axis]
+    if size <= SLAB_SIZE:
+        return function(mask)
+    result = np.zeros(mask.shape, dtype=bool)
+
+    def process(start):
+        stop = min(size, start + SLAB_SIZE)
+        low, high = max(0, start - halo), min(size, stop + halo)
+        source = [slice(None)] * mask.ndim
+        source[split_axis] = slice(low, high)
+        slab = function(mask[tuple(source)])
+        inner = [slice(None)] * mask.ndim
+        inner[split_axis] = slice(start - low, start - low + stop - start)
+        target = [slice(None)] * mask.ndim
+        target[split_axis] = slice(start, stop)
+        result[tuple(target)] = slab[tuple(inner)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(process, range(0, size, SLAB_SIZE)))
+    return result
+
+
+def dilate(mask, iterations=1, axis=None, workers=None):
+    """
+    Dilate a binary mask with the cross structuring element.
+
+    :param np.ndarray mask: Boolean n-dimensional array.
+    :param int iterations: Number of dilations.
+    :param int axis: If provided, the planes orthogonal to this axis are dilated independently.
+    :param int workers: Maximum number of threads.
+    :return: Dilated mask
+    :rtype: ndarray
+    """
+    def process(slab):
+        for _ in range(iterations):
+            dilated = np.copy(slab)
+            for direction in _directions(slab.ndim, axis):
+                for step in (1, -1):
+                    dilated |= _shift(slab, direction, step, False)
+            slab = dilated
+        return slab
+    return _in_slabs(process, np.asarray(mask, dtype=bool), axis, iterations, workers)
+
+
+def erode(mask, iterations=1, axis=None, workers=None):
+    """
+    Erode a binary mask with the cross structuring element. The voxels outside of the array are
+    considered to belong to the mask, so that the mask is not eroded from the array borders.
+
+    :param np.ndarray mask: Boolean n-dimensional array.
+    :param int iterations: Number of erosions.
+    :param int axis: If provided, the planes orthogonal to this axis are eroded independently.
+    :param int workers: Maximum number of threads.
+    :return: Eroded mask
+    :rtype: ndarray
+    """
+    def process(slab):
+        for _ in range(iterations):
+            eroded = np.copy(slab)
+            for direction in _directions(slab.ndim, axis):
+                for step in (1, -1):
+                    eroded &= _shift(slab, direction, step, True)
+            slab = eroded
+        return slab
+    return _in_slabs(process, np.asarray(mask, dtype=bool), axis, iterations, workers)
+
+
+def opening(mask, iterations=1, axis=None, workers=None):
+    """
+    Erode then dilate a mask: removes the speckles and thin protrusions.
+    See erode for the parameters.
+    """
+    return dilate(erode(mask, iterations, axis, workers), iterations, axis, workers)
+
+
+def closing(mask, iterations=1, axis=None, workers=None):
+    """
+    Dilate then erode a mask: fills the small gaps and smooths the concave edges.
+    See erode for the parameters.
+    """
+    return erode(dilate(mask, iterations, axis, workers), iterations, axis, workers)
+
+
+def count_neighbors(mask, axis=None):
+    """
+    Count the face neighbors of each voxel belonging to a mask.
+
+    :param np.ndarray mask: Boolean n-dimensional array.
+    :param int axis: If provided, only the neighbors in the planes orthogonal to this axis are
+        counted.
+    :return: Array of the number of neighbors in the mask
+    :rtype: ndarray
+    """
+    mask = np.asarray(mask, dtype=bool)
+    counts = np.zeros(mask.shape, dtype=np.uint8)
+    for direction in _directions(mask.ndim, axis):
+        for step in (1, -1):
+            counts += _shift(mask, direction, step, False)
+    return counts
+
+
+def _border_seeds(shape, axis=None):
+    """
+    Positions of the border of an array (only the borders of the planes if axis is provided).
+    """
+    border = np.zeros(shape, dtype=bool)
+    for direction in _directions(len(shape), axis):
+        for index in (0, -1):
+            position = [slice(None)] * len(shape)
+            position[direction] = index
+            border[tuple(position)] = True
+    return np.argwhere(border)
+
+
+def fill_holes(mask, axis=None, workers=None):
+    """
+    Fill the holes of a mask: the voxels outside of the mask which cannot be reached from the
+    borders of the array without crossing the mask.
+
+    :param np.ndarray mask: Boolean n-dimensional array.
+    :param int axis: If provided, the holes of each plane orthogonal to this axis are filled.
+    :param int workers: Maximum number of threads.
+    :return: Filled mask
+    :rtype: ndarray
+    """
+    def process(slab):
+        if axis is None:
+            planes = [slab]
+        else:
+            planes = [np.take(slab, i, axis=axis) for i in range(slab.shape[axis])]
+        filled = []
+        for plane in planes:
+            background = ~plane
+            seeds = _border_seeds(plane.shape)
+            seeds = seeds[background[tuple(seeds.T)]]
+            outside = np.zeros(plane.shape, dtype=bool)
+            if len(seeds) > 0:
+                outside[tuple(find_connected(background, seeds).T)] = True
+            filled.append(~outside)
+        return filled[0] if axis is None else np.stack(filled, axis=axis)
+    mask = np.asarray(mask, dtype=bool)
+    if axis is None:
+        return process(mask)
+    return _in_slabs(process, mask, axis, 0, workers)
+
+
+def label(mask, axis=None):
+    """
+    Label the connected components of a mask, through the voxel faces. Neighboring labels are
+    merged by hooking each label on the smallest neighboring one and pointer jumping, all the
+    voxel pairs being processed at once.
+
+    :param np.ndarray mask: Boolean n-dimensional array.
+    :param int axis: If provided, the components are computed in each plane orthogonal to this
+        axis.
+    :return: Array of the component labels (from 1, 0 outside of the mask) and array of the size
+        of each label (the first element being the size of the background).
+    :rtype: tuple
+    """
+    mask = np.asarray(mask, dtype=bool)
+    indices = np.full(mask.shape, -1, dtype=np.int64)
+    n_voxels = int(np.count_nonzero(mask))
+    indices[mask] = np.arange(n_voxels)
+    pairs = []
+    for direction in _directions(mask.ndim, axis):
+        first = [slice(None)] * mask.ndim
+        second = [slice(None)] * mask.ndim
+        first[direction], second[direction] = slice(None, -1), slice(1, None)
+        both = mask[tuple(first)] & mask[tuple(second)]
+        pairs.append((indices[tuple(first)][both], indices[tuple(second)][both]))
+    sources = np.concatenate([pair[0] for pair in pairs]) if pairs else np.zeros(0, np.int64)
+    targets = np.concatenate([pair[1] for pair in pairs]) if pairs else np.zeros(0, np.int64)
+    parents = np.arange(n_voxels)
+    while True:
+        source_parents, target_parents = parents[sources], parents[targets]
+        different = source_parents != target_parents
+        if not np.any(different):
+            break
+        source_parents, target_parents = source_parents[different], target_parents[different]
+        lowest = np.minimum(source_parents, target_parents)
+        np.minimum.at(parents, np.maximum(source_parents, target_parents), lowest)
+        while True:
+            grand_parents = parents[parents]
+            if np.array_equal(grand_parents, parents):
+                break
+            parents = grand_parents
+    roots, component_ids = np.unique(parents, return_inverse=True)
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    labels[mask] = component_ids + 1
+    sizes = np.bincount(labels.ravel(), minlength=len(roots) + 1)
+    return labels, sizes
+
+
+def remove_small_islands(mask, min_size, axis=None, workers=None):
+    """
+    Remove the connected components of a mask smaller than a number of voxels.
+
+    :param np.ndarray mask: Boolean n-dimensional array.
+    :param int min_size: Minimum number of voxels of the components to keep.
+    :param int axis: If provided, the components are computed in each plane orthogonal to this
+        axis.
+    :param int workers: Maximum number of threads.
+    :return: Mask of the components kept
+    :rtype: ndarray
+    """
+    def process(slab):
+        labels, sizes = label(slab, axis)
+        keep = sizes >= min_size
+        keep[0] = False
+        return keep[labels]
+    mask = np.asarray(mask, dtype=bool)
+    if axis is None:
+        return process(mask)
+    return _in_slabs(process, mask, axis, 0, workers)
+
+
+def fill_from_neighbors(codes, to_fill, values=None, axis=None, max_iterations=100):
+    """
+    Give to voxels the most frequent code of their neighbors which are not to be filled, from
+    the border of the region to fill towards its inside.
+
+    :param np.ndarray codes: n-dimensional array of integer codes.
+    :param np.ndarray to_fill: Boolean array of the voxels to fill.
+    :param list values: Codes which can be given to the voxels. Defaults to all the codes of the
+        voxels not to fill.
+    :param int axis: If provided, only the neighbors in the planes orthogonal to this axis are
+        considered.
+    :param int max_iterations: Maximum number of layers of voxels filled.
+    :return: Array of the codes, the voxels which could not be reached keeping their code.
+    :rtype: ndarray
+    """
+    codes = np.copy(codes)
+    to_fill = np.copy(to_fill)
+    if values is None:
+        values = np.unique(codes[~to_fill])
+    values = np.asarray(values, dtype=codes.dtype)
+    if len(values) == 0:
+        return codes
+    for _ in range(max_iterations):
+        if not np.any(to_fill):
+            break
+        counts = np.zeros((len(values),) + codes.shape, dtype=np.uint8)
+        for i, value in enumerate(values):
+            counts[i] = count_neighbors((codes == value) & ~to_fill, axis)
+        reached = to_fill & (np.max(counts, axis=0) > 0)
+        if not np.any(reached):
+            break
+        codes[reached] = values[np.argmax(counts, axis=0)[reached]]
+        to_fill[reached] = False
+    return codes
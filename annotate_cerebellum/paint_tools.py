@@ -4,11 +4,17 @@ annotations.
 """
 import numpy as np
 from os.path import join
-from tkinter import Tk, Frame, Button, Label, Scale, RIDGE, RAISED, SUNKEN, HORIZONTAL
+from tkinter import Tk, Toplevel, Frame, Button, Checkbutton, Label, OptionMenu, Scale, \
+    BooleanVar, StringVar, RIDGE, RAISED, SUNKEN, HORIZONTAL, LEFT
 from PIL import ImageTk, Image
 from annotate_cerebellum.canvas_image import CanvasImage
-from annotate_cerebellum.annotation_image import AnnotationImage
+from annotate_cerebellum.annotation_image import AnnotationImage, CLEANUP_OPERATIONS
+from annotate_cerebellum.memory import MemoryAccount, MemoryBudget
+from annotate_cerebellum.profiling import PROFILER, profiled
 from annotate_cerebellum.utils import draw_2d_line
+from annotate_cerebellum.validation import ConsistencyChecker
+
+AXES = ["coronal", "axial", "sagittal"]
 
 
 class PaintTools:
@@ -17,7 +23,8 @@ class PaintTools:
     Contains also the view of the paint toolbox.
     """
 
-    def __init__(self, placeholder, icon_folder, canvas, annotations, axis=0):
+    def __init__(self, placeholder, icon_folder, canvas, annotations, axis=0, regions=None,
+                 region=None, open_region=None, on_update=None):
         """
         Initialize the controller and the view of the paint toolbox for the annotation correction
         application.
@@ -26,10 +33,18 @@ class PaintTools:
         :param str icon_folder: Folder containing the icons of the painting toolbox.
         :param Widget canvas: View of the displayed annotations
         :param annotations: Model of the displayed annotations
+        :param int axis: Axis of the displayed slices
+        :param list regions: Names of the regions which can be opened. If provided with
+            open_region, a region and axis selector is added to the toolbox.
+        :param str region: Name of the displayed region.
+        :param open_region: Function called with a region name and an axis to open another region.
+        :param on_update: Function called after each modification of the annotations, e.g. to
+            refresh the other views of the annotations.
         """
         self.paint_tools = Frame(placeholder, relief=RIDGE, borderwidth=2)
         self.canvas = canvas
         self.annotations = annotations
+        self.on_update = on_update
 
         self.old_x = None
         self.old_y = None
@@ -118,6 +133,68 @@ class PaintTools:
                                     command=self.revert)
         self.revert_button.grid(row=1, column=6, padx=10, pady=10, sticky='nw')
 
+        # key slices and interpolation
+        self.key_button = Button(self.paint_tools, padx=6, bg="white", text="Key",
+                                 command=self.toggle_key_slice)
+        self.key_button.grid(row=0, column=7, padx=10, pady=10, sticky='nw')
+        self.interpolate_button = Button(self.paint_tools, padx=6, bg="white", text="Interp.",
+                                         command=self.interpolate)
+        self.interpolate_button.grid(row=1, column=7, padx=10, pady=10, sticky='nw')
+
+        # magic wand and its tolerance on the Nissl intensity
+        self.wand_button = Button(self.paint_tools, padx=6, bg="white", text="Wand",
+                                  command=self.use_wand)
+        self.wand_button.grid(row=0, column=8, padx=10, pady=10, sticky='nw')
+        self.tolerance_scale = Scale(self.paint_tools, from_=0, to=128, orient=HORIZONTAL,
+                                     length=100, label="Tolerance",
+                                     command=self.change_tolerance)
+        self.tolerance_scale.set(20)
+        self.tolerance_scale.grid(row=1, column=8, padx=10, sticky='nw')
+        self.last_wand = None  # position and key of the last wand selection
+
+        # morphological cleanup of the selected group
+        self.cleanup_var = StringVar(self.paint_tools, CLEANUP_OPERATIONS[0])
+        self.cleanup_menu = OptionMenu(self.paint_tools, self.cleanup_var, *CLEANUP_OPERATIONS)
+        self.cleanup_menu.grid(row=0, column=9, padx=10, pady=10, sticky='we')
+        self.clean_button = Button(self.paint_tools, padx=6, bg="white", text="Clean",
+                                   command=self.clean)
+        self.clean_button.grid(row=1, column=9, padx=10, pady=10, sticky='nw')
+        self.cleanup_size_scale = Scale(self.paint_tools, from_=1, to=64, orient=HORIZONTAL,
+                                        length=100, label="Size")
+        self.cleanup_size_scale.grid(row=0, column=10, padx=10, sticky='nw')
+        self.cleanup_3d_var = BooleanVar(self.paint_tools, False)
+        self.cleanup_3d_button = Checkbutton(self.paint_tools, text="3D",
+                                             variable=self.cleanup_3d_var)
+        self.cleanup_3d_button.grid(row=1, column=10, padx=10, pady=10, sticky='nw')
+
+        # consistency checks
+        self.checker = None
+        self.check_button = Button(self.paint_tools, padx=6, bg="white", text="Check",
+                                   command=self.check)
+        self.check_button.grid(row=2, column=6, padx=10, pady=10, sticky='nw')
+        self.next_issue_button = Button(self.paint_tools, padx=6, bg="white", text="Next issue",
+                                        command=self.next_issue)
+        self.next_issue_button.grid(row=2, column=7, padx=10, pady=10, sticky='nw')
+        self.issue_label = Label(self.paint_tools, text="")
+        self.issue_label.grid(row=2, column=8, columnspan=3, padx=10, sticky='w')
+
+        # region and axis selection
+        if regions and open_region is not None:
+            self.open_region = open_region
+            region_label = Label(self.paint_tools, text="Region:", font=('Arial', 10, 'bold'))
+            region_label.grid(row=2, column=0, padx=10, sticky='w')
+            self.region_var = StringVar(self.paint_tools, region if region else regions[0])
+            self.region_menu = OptionMenu(self.paint_tools, self.region_var, *regions)
+            self.region_menu.grid(row=2, column=1, padx=10, pady=10, columnspan=2, sticky='we')
+            axis_label = Label(self.paint_tools, text="Axis:", font=('Arial', 10, 'bold'))
+            axis_label.grid(row=2, column=3, padx=10, sticky='w')
+            self.axis_var = StringVar(self.paint_tools, AXES[axis])
+            self.axis_menu = OptionMenu(self.paint_tools, self.axis_var, *AXES)
+            self.axis_menu.grid(row=2, column=4, padx=10, pady=10, sticky='we')
+            self.open_button = Button(self.paint_tools, padx=6, bg="white", text="Open",
+                                      command=self.change_region)
+            self.open_button.grid(row=2, column=5, padx=10, pady=10, sticky='nw')
+
     def grid(self, **kw):
         """
         Put the Paint tools widget on the parent widget.
@@ -142,6 +219,13 @@ class PaintTools:
         self.__activate_button(self.fill_button)
         self.canvas.canvas.bind('<ButtonRelease-1>', self.fill)
 
+    def use_wand(self):
+        """
+        Activate the magic wand tool.
+        """
+        self.__activate_button(self.wand_button)
+        self.canvas.canvas.bind('<ButtonRelease-1>', self.wand)
+
     def use_eraser(self):
         """
         Activate the eraser tool.
@@ -150,12 +234,15 @@ class PaintTools:
         self.canvas.canvas.bind('<ButtonRelease-1>', self.__reset)
         self.canvas.canvas.bind('<B1-Motion>', self.erase)
 
+    @profiled("PaintTools.change_slice")
     def change_slice(self, coronal_pos):
         """
         Change the slice displayed based on the provided coronal position.
         """
         self.annotations.change_slice(int(coronal_pos))
         self.canvas.update_image(self.annotations.picRGB)
+        self.__show_key_slice()
+        self.last_wand = None
 
     def __change_color(self, some_button):
         """
@@ -211,6 +298,7 @@ class PaintTools:
         self.canvas.canvas.unbind('<ButtonRelease-1>')
         self.old_x = None
         self.old_y = None
+        self.last_wand = None
 
     def use_move(self):
         """
@@ -224,6 +312,7 @@ class PaintTools:
     def __reset(self, _):
         self.old_x, self.old_y = None, None
 
+    @profiled("PaintTools.paint")
     def paint(self, event):
         """
         Draw all the voxels between the current and previously recorded position of the mouse
@@ -240,10 +329,11 @@ class PaintTools:
             voxels_to_update = np.array([voxels_to_update[:, 1], voxels_to_update[:, 0]]).T
             # Update RGB
             self.annotations.update_slice(voxels_to_update, self.current_key)
-            self.canvas.update_image(self.annotations.picRGB)
+            self.__update_view()
         self.old_x = event.x
         self.old_y = event.y
 
+    @profiled("PaintTools.erase")
     def erase(self, event):
         """
         Revert the changes applied to the images and the annotation between the current and
@@ -260,10 +350,11 @@ class PaintTools:
             voxels_to_update = np.array([voxels_to_update[:, 1], voxels_to_update[:, 0]]).T
             # Update RGB
             self.annotations.revert_voxels(voxels_to_update)
-            self.canvas.update_image(self.annotations.picRGB)
+            self.__update_view()
         self.old_x = event.x
         self.old_y = event.y
 
+    @profiled("PaintTools.fill")
     def fill(self, event):
         """
         Set the value of all the pixels surrounding the current position of the mouse cursor that
@@ -278,20 +369,188 @@ class PaintTools:
                                     (event.x + offset_x) / self.canvas.imscale - 1]),
                            dtype=int),
                 self.current_key)
-            self.canvas.update_image(self.annotations.picRGB)
+            self.__update_view()
+
+    @profiled("PaintTools.wand")
+    def wand(self, event):
+        """
+        Set the value of the pixels connected to the current position of the mouse cursor whose
+        Nissl intensity is close to the one at that position, within the tolerance.
+
+        :param event: Position of the mouse cursor when the function is called.
+        """
+        offset_x, offset_y = self.canvas.get_offsets()
+        if self.current_key:
+            position = np.asarray(np.rint([(event.y + offset_y) / self.canvas.imscale - 1,
+                                           (event.x + offset_x) / self.canvas.imscale - 1]),
+                                  dtype=int)
+            self.annotations.wand(position, self.current_key, self.tolerance_scale.get())
+            self.last_wand = (position, self.current_key)
+            self.__update_view()
+
+    def change_tolerance(self, tolerance):
+        """
+        Change the tolerance of the magic wand. The last wand selection, if it is the last
+        operation, is applied again with the new tolerance.
+        """
+        if self.last_wand is not None:
+            position, key = self.last_wand
+            self.annotations.revert_slice()
+            self.annotations.wand(position, key, int(tolerance))
+            self.__update_view()
 
+    @profiled("PaintTools.save")
     def save(self):
         """
         Save the changes applied to the annotations. Update the backup.
         """
         self.annotations.apply_changes()
+        self.last_wand = None
 
+    @profiled("PaintTools.revert")
     def revert(self):
         """
         Revert the last changes applied to the annotations.
         """
         self.annotations.revert_slice()
+        self.last_wand = None
+        self.__update_view()
+
+    def toggle_key_slice(self):
+        """
+        Mark the displayed slice as a key slice for the interpolation, or unmark it.
+        """
+        self.annotations.key_slices ^= {self.annotations.slice_pos}
+        self.__show_key_slice()
+
+    def __show_key_slice(self):
+        self.key_button.config(relief=SUNKEN if self.annotations.slice_pos in
+                               self.annotations.key_slices else RAISED)
+
+    def interpolate(self):
+        """
+        Fill the slices between the key slices by interpolation. Can be undone with the revert
+        button.
+        """
+        self.annotations.interpolate_slices()
+        self.last_wand = None
+        self.__update_view()
+
+    @profiled("PaintTools.clean")
+    def clean(self):
+        """
+        Apply the selected morphological cleanup operation on the selected group, on the
+        displayed slices or in 3D. Can be undone with the revert button.
+        """
+        if self.current_key:
+            self.annotations.clean_group(self.cleanup_var.get(), self.current_key,
+                                         self.cleanup_size_scale.get(),
+                                         planar=not self.cleanup_3d_var.get())
+            self.last_wand = None
+            self.__update_view()
+
+    def check(self):
+        """
+        Check the consistency of the annotations of the region and display the number of issues.
+        """
+        self.checker = ConsistencyChecker.from_annotation_image(self.annotations)
+        totals = self.checker.totals()
+        self.issue_label.config(text="{} voxels in {} slices".format(
+            sum(totals.values()), len(self.checker.slices())))
+
+    def next_issue(self):
+        """
+        Display the next slice containing voxels violating the consistency rules, after updating
+        the checks of the modified slices.
+        """
+        if self.checker is None:
+            self.check()
+        else:
+            self.checker.refresh(self.annotations)
+        position = self.checker.next_slice(self.annotations.slice_pos)
+        if position is None:
+            self.issue_label.config(text="No issue")
+            return
+        self.slice_scale.set(position)
+        index = position - self.checker.origin[self.checker.axis]
+        self.issue_label.config(text=", ".join(
+            "{}: {}".format(name, count) for name, count in
+            zip(self.checker.rule_names, self.checker.counts[:, index]) if count > 0))
+
+    @profiled("PaintTools.update_view")
+    def __update_view(self):
+        """
+        Display the modified annotations.
+        """
         self.canvas.update_image(self.annotations.picRGB)
+        if self.on_update is not None:
+            self.on_update()
+
+    def change_region(self):
+        """
+        Open the region and axis selected in the toolbox.
+        """
+        self.open_region(self.region_var.get(), AXES.index(self.axis_var.get()))
+
+    def set_annotations(self, canvas, annotations, axis=0):
+        """
+        Change the displayed annotation model, e.g. when another region is opened.
+
+        :param Widget canvas: View of the displayed annotations
+        :param annotations: Model of the displayed annotations
+        :param int axis: Axis of the displayed slices
+        """
+        self.canvas = canvas
+        self.annotations = annotations
+        self.old_x, self.old_y = None, None
+        self.slice_scale.configure(from_=self.annotations.ids[axis, 0],
+                                   to=self.annotations.ids[axis, 1])
+        self.slice_scale.set(self.annotations.slice_pos)
+        self.__show_key_slice()
+        self.checker = None
+        self.issue_label.config(text="")
+        if self.active_button is not None:
+            self.active_button.invoke()  # bind the active tool to the new view
+
+
+class ProfilerOverlay:
+    """
+    Window displaying the latency report of the profiler, refreshed while it is open.
+    """
+
+    def __init__(self, placeholder, profiler=PROFILER, interval=500):
+        """
+        :param Widget placeholder: Parent widget of the window
+        :param Profiler profiler: Profiler to report
+        :param int interval: Refresh interval in milliseconds
+        """
+        self.profiler = profiler
+        self.interval = interval
+        self.window = Toplevel(placeholder)
+        self.window.title("Latency")
+        self.window.attributes("-topmost", True)
+        self.label = Label(self.window, font=("Courier", 9), justify=LEFT, anchor="nw")
+        self.label.pack(fill="both", expand=True)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.__job = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Display the current report and schedule the next refresh.
+        """
+        self.label.configure(text=self.profiler.report())
+        self.__job = self.window.after(self.interval, self.refresh)
+
+    def close(self):
+        if self.__job is not None:
+            self.window.after_cancel(self.__job)
+            self.__job = None
+        self.window.destroy()
+
+    @property
+    def is_open(self):
+        return self.__job is not None
 
 
 class PaintAnnotations:
@@ -299,31 +558,165 @@ class PaintAnnotations:
     Class to load the user application to modify volumetric cerebellar annotations.
     """
 
-    def __init__(self, annotation, nissl, dict_reg_ids, axis=0, icon_folder="icons", backup=None):
+    def __init__(self, annotation, nissl, dict_reg_ids, axis=0, icon_folder="icons", backup=None,
+                 state=None, regions=None, region=None, load_state=None, memory_budget=None,
+                 processes=1, storage="dense"):
         """
         Initialize the application.
 
         :param annotation: np.ndarray annotation volume
         :param nissl: np.ndarray Nissl volume
         :param dict_reg_ids: dictionary linking cerebellum layers to their region ids.
+        :param axis: axis of the slices to display, or list of axes to display side by side
+            (multi-planar mode). The toolbox applies to the view under the mouse cursor.
         :param icon_folder: folder location for the icons used in the app
-        """
+        :param backup: np.ndarray original annotation volume
+        :param state: prepared state of the annotation model, e.g. from a SessionCache
+        :param regions: dictionary of region name to its dictionary linking cerebellum layers to
+            their region ids (see hierarchy.cerebellar_layer_ids). If provided, other regions can
+            be opened from the toolbox without reloading the volumes.
+        :param region: name of the region corresponding to dict_reg_ids.
+        :param load_state: function returning the prepared state of the annotation model (or None)
+            for a dictionary of region ids and an axis, e.g. SessionCache.load_or_prepare. Used
+            only while no change has been saved in the annotations.
+        :param int memory_budget: memory budget of the session in bytes. When preparing the
+            working annotations of the whole volume would exceed it, the annotation models work on
+            the region of interest only (cropped mode).
+        :param int processes: number of processes preparing the working annotations of a region.
+        :param str storage: storage of the working annotations, "dense" (numpy arrays) or "rle"
+            (run-length encoded, for whole brain volumes at high resolution).
+        """
+        self.axes = list(axis) if isinstance(axis, (list, tuple)) else [axis]
         self.root = Tk()
         self.root.title("Mouse Brain Paint")
-        self.root.geometry('800x600')
-        self.root.columnconfigure(0, weight=1)
+        self.root.geometry('800x600' if len(self.axes) == 1 else '1200x600')
+        for column in range(len(self.axes)):
+            self.root.columnconfigure(column, weight=1)
         self.root.rowconfigure(0, weight=1)
         self.root.rowconfigure(1, weight=7)
 
-        self.annotations = AnnotationImage(annotation, dict_reg_ids, nissl, axis, backup)
-        self.canvas = CanvasImage(self.root, self.annotations.picRGB)
-        self.canvas.grid(row=1, column=0)  # show widget
-        self.toolbox = PaintTools(self.root, icon_folder, self.canvas, self.annotations, axis)
-        self.toolbox.grid(row=0, column=0)
+        self.annotation = annotation
+        self.nissl = nissl
+        self.backup = backup
+        self.budget = MemoryBudget(memory_budget) if memory_budget else None
+        self.processes = processes
+        self.storage = storage
+        self.regions = regions
+        self.load_state = load_state
+        self.committed = False  # True once changes have been saved in the annotations
+        self.views = []
+        self.canvases = []
+        self.__open(annotation, dict_reg_ids, state)
+        self.toolbox = PaintTools(self.root, icon_folder, self.canvas, self.annotations,
+                                  self.axes[0], list(regions.keys()) if regions else None, region,
+                                  self.open_region, self.refresh_views)
+        self.toolbox.grid(row=0, column=0, columnspan=len(self.axes))
+        # F11 prints the memory used by the session, F12 shows the latency of the tools when the
+        # profiler is enabled
+        self.root.bind('<F11>', lambda event: print(self.memory_account().report()))
+        self.overlay = None
+        if PROFILER.enabled:
+            self.root.bind('<F12>', lambda event: self.toggle_overlay())
         self.root.mainloop()
 
+    def __open(self, annotation, dict_reg_ids, state):
+        """
+        Create the annotation models of a region and their views, one for each axis.
+        """
+        for canvas in self.canvases:
+            canvas.destroy()
+        self.views = []  # release the previous working state before preparing the next
+        self.annotations = None
+        cropped = False
+        if self.budget is not None:
+            account = MemoryAccount()
+            for name, volume in [("annotation", annotation), ("nissl", self.nissl),
+                                 ("backup", self.backup)]:
+                account.add("PaintAnnotations", name, volume)
+            roi = AnnotationImage.region_roi(annotation, dict_reg_ids, self.axes[0])
+            cropped = self.budget.model_mode(annotation, roi, account.total(), len(self.axes),
+                                             self.backup is not None) == "cropped"
+        self.views = AnnotationImage.multi_planar(annotation, dict_reg_ids, self.nissl, self.axes,
+                                                  self.backup, state, cropped, self.processes,
+                                                  self.storage)
+        self.canvases = []
+        for i, view in enumerate(self.views):
+            canvas = CanvasImage(self.root, view.picRGB)
+            canvas.grid(row=1, column=i)  # show widget
+            canvas.canvas.bind('<Enter>', lambda event, index=i: self.activate_view(index))
+            self.canvases.append(canvas)
+        self.annotations = self.views[0]
+        self.canvas = self.canvases[0]
+
+    def activate_view(self, index):
+        """
+        Apply the toolbox to one of the displayed views.
+
+        :param int index: index of the view in the list of axes.
+        """
+        if self.views[index] is not self.annotations:
+            self.annotations = self.views[index]
+            self.canvas = self.canvases[index]
+            self.toolbox.set_annotations(self.canvas, self.annotations, self.axes[index])
+
+    def toggle_overlay(self):
+        """
+        Open or close the window displaying the latency report of the profiler.
+        """
+        if self.overlay is not None and self.overlay.is_open:
+            self.overlay.close()
+        else:
+            self.overlay = ProfilerOverlay(self.root)
+
+    @profiled("PaintAnnotations.refresh_views")
+    def refresh_views(self):
+        """
+        Display the modifications of the annotations in the views not used by the toolbox.
+        """
+        for view, canvas in zip(self.views, self.canvases):
+            if view is not self.annotations:
+                canvas.update_image(view.picRGB)
+
+    def open_region(self, region, axis=0):
+        """
+        Save the changes of the current region and open another region, reusing the loaded
+        volumes.
+
+        :param str region: name of the region to open, key of the regions dictionary.
+        :param int axis: axis of the slices to display. In multi-planar mode, all the axes are
+            displayed again.
+        """
+        self.annotations.apply_changes()
+        self.committed = self.committed or self.annotations.committed
+        if len(self.axes) == 1:
+            self.axes = [axis]
+        dict_reg_ids = self.regions[region]
+        # Cached states are computed from the files: they are outdated once changes are saved.
+        state = None
+        if self.load_state is not None and not self.committed:
+            state = self.load_state(dict_reg_ids, self.axes[0])
+        self.__open(self.annotation, dict_reg_ids, state)
+        self.toolbox.set_annotations(self.canvas, self.annotations, self.axes[0])
+
+    def memory_account(self):
+        """
+        Account for the memory used by the annotation models and their views.
+
+        :return: buffers of the session
+        :rtype: MemoryAccount
+        """
+        account = MemoryAccount()
+        for name, volume in [("annotation", self.annotation), ("nissl", self.nissl),
+                             ("backup", self.backup)]:
+            account.add("PaintAnnotations", name, volume)
+        for view, canvas in zip(self.views, self.canvases):
+            suffix = "[{}]".format(AXES[view.axis])
+            account.add_model(view, "AnnotationImage" + suffix)
+            account.add_canvas(canvas, "CanvasImage" + suffix)
+        return account
+
     def get_annotations(self):
         """
         Getter for the annotations volume.
         """
-        return self.annotations.annotation
+        return self.annotation
@@ -0,0 +1,225 @@
+"""
+Opt-in latency instrumentation of the interactive tools. The functions decorated with profiled
+record their duration in the global PROFILER when it is enabled, together with the event (outermost
+profiled call, e.g. a mouse motion handled by PaintTools.paint) they belong to. The profiler reports
+latency percentiles for each function, the time spent in each stage of the events, and exports the
+recorded calls as a Chrome trace (chrome://tracing, Perfetto or speedscope).
+
+The profiler is disabled by default: the decorated functions only check a flag. Enable it with
+PROFILER.enable() or by setting the ANNOTATE_CEREBELLUM_PROFILE environment variable before
+starting the application. If the variable is a path to a JSON file, the trace is written there and
+the report is printed when the application exits::
+
+    ANNOTATE_CEREBELLUM_PROFILE=trace.json python manual_annotation_correct.py
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+from collections import defaultdict, deque
+from time import perf_counter
+
+import numpy as np
+
+
+class Profiler:
+    """
+    Recorder of the duration of the profiled calls.
+    """
+
+    def __init__(self, max_samples=10000, max_trace_events=200000):
+        """
+        :param int max_samples: number of latest durations kept for each function.
+        :param int max_trace_events: number of latest calls kept for the trace export.
+        """
+        self.enabled = False
+        self.max_samples = max_samples
+        self.max_trace_events = max_trace_events
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__origin = perf_counter()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """
+        Remove all the recorded calls.
+        """
+        with self.__lock:
+            self.samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+            # Total time spent in each function during each kind of event
+            self.stages = defaultdict(lambda: defaultdict(float))
+            self.trace_events = deque(maxlen=self.max_trace_events)
+
+    def __stack(self):
+        if not hasattr(self.__local, "stack"):
+            self.__local.stack = []
+        return self.__local.stack
+
+    def start(self, name):
+        """
+        Start a profiled call. Calls started before it is stopped are its stages.
+
+        :param str name: name of the function or stage.
+        """
+        self.__stack().append((name, perf_counter()))
+
+    def stop(self):
+        """
+        Stop the last started call and record its duration.
+
+        :return: duration of the call in seconds
+        :rtype: float
+        """
+        stack = self.__stack()
+        name, start = stack.pop()
+        duration = perf_counter() - start
+        event = stack[0][0] if len(stack) > 0 else name
+        with self.__lock:
+            self.samples[name].append(duration)
+            self.stages[event][name] += duration
+            self.trace_events.append((name, start, duration, threading.get_ident(), event))
+        return duration
+
+    def span(self, name):
+        """
+        Context manager profiling a block of code.
+
+        :param str name: name of the stage.
+        """
+        return _Span(self, name)
+
+    def summary(self):
+        """
+        Latency statistics of each profiled function.
+
+        :return: Dictionary of function name to the count of calls and the mean, p50, p95, p99
+            and max latency in milliseconds.
+        :rtype: dict
+        """
+        with self.__lock:
+            samples = {name: np.array(values) * 1000 for name, values in self.samples.items()}
+        summary = {}
+        for name, values in samples.items():
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[name] = {"count": len(values), "mean": float(np.mean(values)),
+                             "p50": float(p50), "p95": float(p95), "p99": float(p99),
+                             "max": float(np.max(values))}
+        return summary
+
+    def breakdown(self):
+        """
+        Share of the time of each kind of event spent in each of its stages. The stages are
+        nested: the time of a stage includes the time of the stages it calls.
+
+        :return: Dictionary of event name to the dictionary of stage name to its share of the
+            total time of the event.
+        :rtype: dict
+        """
+        with self.__lock:
+            stages = {event: dict(times) for event, times in self.stages.items()}
+        breakdown = {}
+        for event, times in stages.items():
+            total = times.get(event, 0)
+            if total > 0:
+                breakdown[event] = {name: time / total for name, time in times.items()
+                                    if name != event}
+        return breakdown
+
+    def report(self, max_stages=5):
+        """
+        Describe the latency of the profiled functions and the main stages of each event.
+
+        :param int max_stages: maximum number of stages listed for each event.
+        :return: report
+        :rtype: str
+        """
+        summary = self.summary()
+        breakdown = self.breakdown()
+        lines = ["{:40s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+            "function (ms)", "count", "p50", "p95", "p99", "max")]
+        for name in sorted(summary, key=lambda name_: -summary[name_]["p95"]):
+            stats = summary[name]
+            lines.append("{:40s} {:7d} {:9.2f} {:9.2f} {:9.2f} {:9.2f}".format(
+                name[:40], stats["count"], stats["p50"], stats["p95"], stats["p99"],
+                stats["max"]))
+            stages = sorted(breakdown.get(name, {}).items(), key=lambda item: -item[1])
+            for stage, share in stages[:max_stages]:
+                lines.append("    {:36s} {:5.1f}%".format(stage[:36], share * 100))
+        return "\n".join(lines)
+
+    def export_trace(self, filename):
+        """
+        Write the recorded calls in the Chrome trace event format.
+
+        :param str filename: path to the JSON trace file.
+        """
+        with self.__lock:
+            events = list(self.trace_events)
+        pid = os.getpid()
+        trace = [{"name": name, "cat": event, "ph": "X", "pid": pid, "tid": tid,
+                  "ts": (start - self.__origin) * 1e6, "dur": duration * 1e6}
+                 for name, start, duration, tid, event in events]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+class _Span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.active = False
+
+    def __enter__(self):
+        self.active = self.profiler.enabled
+        if self.active:
+            self.profiler.start(self.name)
+        return self
+
+    def __exit__(self, *_):
+        if self.active:
+            self.profiler.stop()
+
+
+PROFILER = Profiler()
+
+
+def profiled(name):
+    """
+    Decorator recording the duration of the calls of a function in the global profiler, when it
+    is enabled.
+
+    :param str name: name of the function in the reports and traces.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            PROFILER.start(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PROFILER.stop()
+        return wrapper
+    return decorator
+
+
+def _profile_at_exit(filename):
+    print(PROFILER.report())
+    if filename.endswith(".json"):
+        PROFILER.export_trace(filename)
+        print("Trace written in {}".format(filename))
+
+
+if os.environ.get("ANNOTATE_CEREBELLUM_PROFILE"):
+    PROFILER.enable()
+    atexit.register(_profile_at_exit, os.environ["ANNOTATE_CEREBELLUM_PROFILE"])
@@ -0,0 +1,170 @@
+"""
+Multi-resolution pyramids of annotation volumes (block mode), used to locate regions at a coarse
+resolution before loading the full resolution data of the region to correct.
+
+Pyramids are cached next to their source file, in a directory named after the source file with
+the ``.pyramid`` extension. The cache is invalidated when the size or modification time of the
+source file changes.
+"""
+import argparse
+import json
+import os
+from os.path import isdir, isfile, join
+
+import numpy as np
+
+from annotate_cerebellum.utils import file_signature, load_nrrd_npy_file
+
+PYRAMID_EXTENSION = ".pyramid"
+REDUCTION = 2
+# Default number of downsampled levels
+N_LEVELS = 3
+
+
+def _blocks(slab, factor):
+    """
+    Reshape a volume whose dimensions are multiple of factor into an array of blocks.
+
+    :return: array of shape (n0, n1, n2, factor ** 3)
+    """
+    n0, n1, n2 = [s // factor for s in slab.shape]
+    blocks = slab.reshape(n0, factor, n1, factor, n2, factor).transpose(0, 2, 4, 1, 3, 5)
+    return blocks.reshape(n0, n1, n2, factor ** 3)
+
+
+def _pad(volume, factor):
+    """
+    Pad a volume by replicating its last voxels so that its dimensions are multiple of factor.
+    """
+    pad = [(0, (-s) % factor) for s in volume.shape]
+    if any(p[1] > 0 for p in pad):
+        return np.pad(volume, pad, mode="edge")
+    return volume
+
+
+def _downsample(volume, factor, slab_size, reduce_blocks, dtype):
+    """
+    Downsample a volume slab by slab along its first axis with a block reduction function.
+    """
+    shape = [int(np.ceil(s / factor)) for s in volume.shape]
+    result = np.zeros(shape, dtype=dtype)
+    slab_size = max(1, slab_size // factor)
+    for start in range(0, shape[0], slab_size):
+        stop = min(start + slab_size, shape[0])
+        slab = _pad(np.asarray(volume[start * factor:stop * factor]), factor)
+        result[start:stop] = reduce_blocks(_blocks(slab, factor))
+    return result
+
+
+def _block_mode(blocks):
+    """
+    Most frequent value of each block. Ties are resolved with the smallest value.
+    """
+    blocks = np.sort(blocks, axis=-1)
+    counts = np.zeros(blocks.shape, dtype=np.uint16)
+    for i in range(blocks.shape[-1]):
+        counts[..., i] = np.sum(blocks == blocks[..., i:i + 1], axis=-1)
+    return np.take_along_axis(blocks, np.argmax(counts, axis=-1)[..., None], axis=-1)[..., 0]
+
+
+def downsample_mode(volume, factor=REDUCTION, slab_size=32):
+    """
+    Downsample a volume by keeping the most frequent value of each block of factor ** 3 voxels.
+    Suited to annotation volumes.
+
+    :param ndarray volume: 3D volume of labels to downsample.
+    :param int factor: reduction factor for each dimension.
+    :param int slab_size: number of planes of the input volume processed at once.
+    :return: downsampled volume
+    :rtype: ndarray
+    """
+    return _downsample(volume, factor, slab_size, _block_mode, volume.dtype)
+
+
+def build_pyramid(volume, n_levels=N_LEVELS, slab_size=32):
+    """
+    Build a pyramid of downsampled annotation volumes (block mode), each level being REDUCTION
+    times smaller than the previous one.
+
+    :param ndarray volume: 3D volume of labels at full resolution.
+    :param int n_levels: number of downsampled levels.
+    :param int slab_size: number of planes of the input volume processed at once.
+    :return: list of the downsampled volumes, from the finest to the coarsest.
+    :rtype: list
+    """
+    levels = []
+    for _ in range(n_levels):
+        volume = downsample_mode(volume if len(levels) == 0 else levels[-1], REDUCTION,
+                                 slab_size)
+        levels.append(volume)
+    return levels
+
+
+def load_pyramid(filename, n_levels=N_LEVELS, mmap_mode="r"):
+    """
+    Load the pyramid of an annotation file from its cache, or build and cache it if the cache is
+    missing, outdated or has fewer levels. The first levels of a deeper cached pyramid are used.
+
+    :param str filename: path to the annotation file.
+    :param int n_levels: number of downsampled levels.
+    :param str mmap_mode: memory mapping mode used to read the cached levels.
+    :return: list of the downsampled volumes, from the finest to the coarsest.
+    :rtype: list
+    """
+    folder = filename.rstrip("/\\") + PYRAMID_EXTENSION
+    meta_file = join(folder, "meta.json")
+    meta = dict(file_signature(filename), n_levels=n_levels)
+    if isfile(meta_file):
+        with open(meta_file, "r") as f:
+            cached = json.load(f)
+        if cached.get("n_levels", 0) >= n_levels and \
+                dict(cached, n_levels=n_levels) == meta:
+            return [np.load(join(folder, "level_{}.npy".format(i + 1)), mmap_mode=mmap_mode)
+                    for i in range(n_levels)]
+    levels = build_pyramid(load_nrrd_npy_file(filename), n_levels)
+    if not isdir(folder):
+        os.makedirs(folder)
+    for i, level in enumerate(levels):
+        np.save(join(folder, "level_{}.npy".format(i + 1)), level)
+    with open(meta_file, "w") as f:
+        json.dump(meta, f)
+    return levels
+
+
+def locate_region(level, ids, level_id, shape, margin=1):
+    """
+    Locate the bounding box of a set of region ids at full resolution using a coarse annotation
+    level.
+
+    :param ndarray level: downsampled annotation volume.
+    :param list ids: region ids to locate.
+    :param int level_id: level number of the downsampled volume (1 for the finest level).
+    :param tuple shape: shape of the volume at full resolution.
+    :param int margin: number of coarse voxels added around the region, to compensate for thin
+        structures lost while downsampling.
+    :return: Array of [start, stop[ positions at full resolution for each dimension, or None if
+        the region is not visible at this level.
+    :rtype: ndarray
+    """
+    filter_ = np.where(np.isin(level, ids))
+    if len(filter_[0]) == 0:
+        return None
+    factor = REDUCTION ** level_id
+    return np.array([[max(0, (np.min(pos) - margin) * factor),
+                      min(dim, (np.max(pos) + 1 + margin) * factor)]
+                     for pos, dim in zip(filter_, shape)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and cache the pyramid of annotation files")
+    parser.add_argument("filenames", nargs="+", help="annotation files (npy, nrrd or chunked)")
+    parser.add_argument("--levels", type=int, default=N_LEVELS,
+                        help="number of downsampled levels")
+    args = parser.parse_args()
+    for filename in args.filenames:
+        levels = load_pyramid(filename, args.levels)
+        print(filename, [level.shape for level in levels])
+
+
+if __name__ == "__main__":
+    main()
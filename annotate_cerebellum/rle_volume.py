@@ -0,0 +1,294 @@
+"""
+Run-length encoded storage of label volumes.
+
+The working annotations of AnnotationImage (group codes) are made of long runs of the same value
+outside of the region being corrected. RLEVolume stores each plane of the first axis as the runs
+of its voxels in C order (start position of each run in the flattened plane and its value), so
+that a whole brain volume only uses a few bytes per run.
+Reads and writes are vectorized per plane: voxels are found by a binary search of their run and
+writes split and merge the runs, without decoding the plane.
+"""
+import numpy as np
+
+
+def _encode(flat):
+    """
+    Compute the runs of a flattened plane.
+
+    :param ndarray flat: 1D array of values.
+    :return: start position and value of each run
+    :rtype: tuple
+    """
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1)).astype(np.int32)
+    return starts, flat[starts]
+
+
+def _read(starts, values, positions):
+    """
+    Get the values at positions of a flattened plane.
+    """
+    return values[np.searchsorted(starts, positions, side="right") - 1]
+
+
+def _decode(starts, values, start, stop):
+    """
+    Decode the positions from start to stop of a flattened plane, only expanding the runs
+    overlapping them.
+    """
+    first = np.searchsorted(starts, start, side="right") - 1
+    last = np.searchsorted(starts, stop, side="left")
+    bounds = np.append(starts[first:last], stop)
+    bounds[0] = start
+    return np.repeat(values[first:last], np.diff(bounds))
+
+
+def _write(starts, values, positions, new_values, size):
+    """
+    Change the values at positions of a flattened plane, splitting the runs at the positions and
+    merging the consecutive runs of equal values.
+
+    :return: start position and value of each new run
+    :rtype: tuple
+    """
+    bounds = np.union1d(starts, np.concatenate((positions, positions + 1)))
+    bounds = bounds[bounds < size].astype(np.int32)
+    merged = _read(starts, values, bounds)
+    merged[np.searchsorted(bounds, positions)] = new_values
+    keep = np.concatenate(([True], merged[1:] != merged[:-1]))
+    return bounds[keep], merged[keep]
+
+
+class RLEVolume:
+    """
+    3D label volume stored as runs of values, plane by plane along the first axis. Supports the
+    numpy indexing used on the working annotations: basic indexing with integers and slices of
+    step 1 (dense results), and fancy indexing with a tuple of three index arrays, for reading
+    and writing.
+    """
+
+    def __init__(self, shape, dtype=np.int8, fill_value=0):
+        """
+        Create a volume filled with a value.
+
+        :param tuple shape: shape of the volume (3 dimensions).
+        :param dtype: type of the values.
+        :param fill_value: initial value of the voxels.
+        """
+        if len(shape) != 3:
+            raise Exception("Only 3D volumes can be run-length encoded.")
+        self.shape = tuple(int(dim) for dim in shape)
+        self.dtype = np.dtype(dtype)
+        self.__plane_size = self.shape[1] * self.shape[2]
+        self.__starts = [np.zeros(1, dtype=np.int32) for _ in range(self.shape[0])]
+        self.__values = [np.full(1, fill_value, dtype=self.dtype) for _ in range(self.shape[0])]
+
+    @classmethod
+    def from_array(cls, array, slab_size=16):
+        """
+        Encode a volume.
+
+        :param ndarray array: 3D array, e.g. memory mapped.
+        :param int slab_size: number of planes read at once.
+        :return: encoded volume
+        :rtype: RLEVolume
+        """
+        volume = cls(array.shape, array.dtype)
+        for start in range(0, array.shape[0], slab_size):
+            volume[start:start + slab_size] = np.asarray(array[start:start + slab_size])
+        return volume
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return self.shape[0] * self.__plane_size
+
+    @property
+    def n_runs(self):
+        """
+        Number of runs of the volume.
+        """
+        return sum(len(starts) for starts in self.__starts)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the runs in bytes.
+        """
+        return sum(starts.nbytes + values.nbytes
+                   for starts, values in zip(self.__starts, self.__values))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def plane(self, index):
+        """
+        Decode a plane of the first axis.
+
+        :param int index: index of the plane.
+        :return: 2D array
+        :rtype: ndarray
+        """
+        return _decode(self.__starts[index], self.__values[index], 0,
+                       self.__plane_size).reshape(self.shape[1:])
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.empty(self.shape, dtype=self.dtype)
+        for index in range(self.shape[0]):
+            array[index] = self.plane(index)
+        return array if dtype is None else array.astype(dtype)
+
+    def __normalize(self, key):
+        """
+        Convert a basic index to ranges for each axis and the axes to drop.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        ranges, dropped = [], []
+        for axis, (index, dim) in enumerate(zip(key, self.shape)):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(dim)
+                if step != 1:
+                    raise Exception("Only slices of step 1 are supported.")
+                ranges.append((start, max(start, stop)))
+            else:
+                index = int(index)
+                index = index + dim if index < 0 else index
+                if not 0 <= index < dim:
+                    raise IndexError("Index {} out of bounds for axis {}.".format(index, axis))
+                ranges.append((index, index + 1))
+                dropped.append(axis)
+        return ranges, tuple(dropped)
+
+    @staticmethod
+    def __is_fancy(key):
+        return isinstance(key, tuple) and len(key) == 3 and \
+            all(isinstance(index, (np.ndarray, list)) for index in key)
+
+    def __positions(self, ranges):
+        """
+        Flat positions in a plane of the rows and columns of a box.
+        """
+        (row_start, row_stop), (col_start, col_stop) = ranges[1:]
+        return (np.arange(row_start, row_stop)[:, None] * self.shape[2] +
+                np.arange(col_start, col_stop)[None, :]).ravel()
+
+    def __plane_groups(self, planes):
+        """
+        Sort voxels by plane.
+
+        :return: order of the voxels and list of (plane, slice of the sorted voxels)
+        :rtype: tuple
+        """
+        order = np.argsort(planes, kind="stable")
+        unique, first = np.unique(planes[order], return_index=True)
+        last = np.append(first[1:], len(planes))
+        return order, [(int(plane), slice(start, stop))
+                       for plane, start, stop in zip(unique, first, last)]
+
+    def __getitem__(self, key):
+        if self.__is_fancy(key):
+            planes, rows, cols = np.broadcast_arrays(*(np.asarray(index) for index in key))
+            result = np.empty(planes.shape, dtype=self.dtype)
+            planes, flat = planes.ravel(), (rows * self.shape[2] + cols).ravel()
+            order, groups = self.__plane_groups(planes)
+            flat = flat[order]
+            values = np.empty(len(order), dtype=self.dtype)
+            for plane, part in groups:
+                values[part] = _read(self.__starts[plane], self.__values[plane], flat[part])
+            result.ravel()[order] = values
+            return result
+        ranges, dropped = self.__normalize(key)
+        box = np.empty([stop - start for start, stop in ranges], dtype=self.dtype)
+        positions = self.__positions(ranges)
+        (row_start, row_stop), (col_start, col_stop) = ranges[1:]
+        rows_size = (row_stop - row_start) * self.shape[2]
+        for i, plane in enumerate(range(*ranges[0])):
+            if 4 * len(positions) > rows_size:
+                # Decode the whole rows of the box
+                rows = _decode(self.__starts[plane], self.__values[plane],
+                               row_start * self.shape[2], row_stop * self.shape[2])
+                box[i] = rows.reshape(-1, self.shape[2])[:, col_start:col_stop]
+            else:
+                box[i] = _read(self.__starts[plane], self.__values[plane],
+                               positions).reshape(box.shape[1:])
+        return box.reshape([dim for axis, dim in enumerate(box.shape) if axis not in dropped])
+
+    def __setitem__(self, key, value):
+        if self.__is_fancy(key):
+            planes, rows, cols = np.broadcast_arrays(*(np.asarray(index) for index in key))
+            values = np.broadcast_to(np.asarray(value, dtype=self.dtype), planes.shape).ravel()
+            planes, flat = planes.ravel(), (rows * self.shape[2] + cols).ravel()
+            order, groups = self.__plane_groups(planes)
+            flat, values = flat[order], values[order]
+            for plane, part in groups:
+                self.__starts[plane], self.__values[plane] = _write(
+                    self.__starts[plane], self.__values[plane], flat[part], values[part],
+                    self.__plane_size)
+            return
+        ranges, dropped = self.__normalize(key)
+        box_shape = [stop - start for start, stop in ranges]
+        value = np.asarray(value, dtype=self.dtype)
+        value = np.broadcast_to(value, [dim for axis, dim in enumerate(box_shape)
+                                        if axis not in dropped]).reshape(box_shape)
+        positions = self.__positions(ranges)
+        for i, plane in enumerate(range(*ranges[0])):
+            if len(positions) == self.__plane_size:
+                self.__starts[plane], self.__values[plane] = _encode(value[i].ravel())
+            else:
+                self.__starts[plane], self.__values[plane] = _write(
+                    self.__starts[plane], self.__values[plane], positions, value[i].ravel(),
+                    self.__plane_size)
+
+    def __compare(self, other, operator):
+        """
+        Compare the volume with a value or another volume of the same shape, voxel by voxel.
+        Comparisons with a value only compare the values of the runs.
+        """
+        result = RLEVolume(self.shape, bool)
+        if np.ndim(other) == 0 and not isinstance(other, RLEVolume):
+            for plane in range(self.shape[0]):
+                values = operator(self.__values[plane], other)
+                keep = np.concatenate(([True], values[1:] != values[:-1]))
+                result.__starts[plane] = self.__starts[plane][keep]
+                result.__values[plane] = values[keep]
+            return result
+        if tuple(other.shape) != self.shape:
+            raise Exception("The volumes must have the same shape.")
+        for plane in range(self.shape[0]):
+            other_plane = other.plane(plane) if isinstance(other, RLEVolume) \
+                else np.asarray(other[plane])
+            result.__starts[plane], result.__values[plane] = _encode(
+                operator(self.plane(plane), other_plane).ravel())
+        return result
+
+    def __eq__(self, other):
+        return self.__compare(other, np.equal)
+
+    def __ne__(self, other):
+        return self.__compare(other, np.not_equal)
+
+    __hash__ = None
+
+    def count_nonzero(self):
+        """
+        Number of voxels whose value is not zero.
+
+        :rtype: int
+        """
+        count = 0
+        for starts, values in zip(self.__starts, self.__values):
+            lengths = np.diff(np.append(starts, self.__plane_size))
+            count += int(np.sum(lengths[values != 0]))
+        return count
+
+    def any(self):
+        """
+        Check if a voxel is not zero.
+
+        :rtype: bool
+        """
+        return any(np.any(values) for values in self.__values)
@@ -0,0 +1,157 @@
+"""
+Persistent cache of the prepared states of the annotation model, to reopen a region quickly.
+"""
+import hashlib
+import json
+import os
+import shutil
+from os.path import isdir, isfile, join
+
+import numpy as np
+
+from annotate_cerebellum.annotation_image import AnnotationImage
+from annotate_cerebellum.utils import file_checksum, save_nrrd_npy_file
+
+# Version of the stored states, part of the cache keys so that outdated states are not reused
+STATE_VERSION = 3
+
+
+class SessionCache:
+    """
+    Cache of AnnotationImage prepared states (working annotations, encoded backup, bounding box,
+    center of the region and inverse group dictionary). Each region and axis has a single state,
+    stored in a folder named after a key computed from the region ids and the axis, with the
+    checksums of the input files it was prepared from: a state prepared from other versions of the
+    files (e.g. before saving corrections) is replaced. Volumes are stored as numpy files and
+    memory mapped in copy-on-write mode when reloaded.
+    """
+
+    def __init__(self, folder):
+        """
+        Initialize the cache.
+
+        :param str folder: folder in which the states are stored.
+        """
+        self.folder = folder
+
+    @staticmethod
+    def key(dict_reg_ids, axis):
+        """
+        Compute the cache key of a region and axis.
+
+        :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS to their list of
+            brain region ids.
+        :param int axis: Axis of the slices to display.
+        :return: hexadecimal key
+        :rtype: str
+        """
+        content = {
+            "regions": {key: np.asarray(value).ravel().tolist()
+                        for key, value in sorted(dict_reg_ids.items())},
+            "axis": int(axis),
+            "version": STATE_VERSION,
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def checksums(filenames):
+        """
+        Checksums of the input files of a state.
+
+        :param list filenames: paths to the input volumetric files.
+        :return: list of hexadecimal checksums
+        :rtype: list
+        """
+        return [file_checksum(filename) for filename in filenames]
+
+    def load(self, key, checksums=None):
+        """
+        Load a prepared state from the cache.
+
+        :param str key: cache key of the region and axis.
+        :param list checksums: checksums of the input files. If provided, a state prepared from
+            other files is not loaded.
+        :return: prepared state or None if the state is not in the cache.
+        :rtype: dict
+        """
+        folder = join(self.folder, key)
+        meta_file = join(folder, "state.json")
+        if not isfile(meta_file):
+            return None
+        with open(meta_file, "r") as f:
+            state = json.load(f)
+        if checksums is not None and state.get("files") != list(checksums):
+            return None
+        state["annCPY"] = np.load(join(folder, "annCPY.npy"), mmap_mode="c")
+        state["backup"] = np.load(join(folder, "backup.npy"), mmap_mode="c")
+        return state
+
+    def save(self, key, state, checksums=None):
+        """
+        Store a prepared state in the cache, replacing the previous state of the region and axis.
+        The states stored by previous versions of the cache are removed.
+
+        :param str key: cache key of the region and axis.
+        :param dict state: prepared state, as returned by AnnotationImage.get_state.
+        :param list checksums: checksums of the input files the state was prepared from.
+        """
+        self.prune()
+        folder = join(self.folder, key)
+        if not isdir(folder):
+            os.makedirs(folder)
+        # The state file is written last: an interrupted save leaves an invalid state
+        meta_file = join(folder, "state.json")
+        if isfile(meta_file):
+            os.remove(meta_file)
+        for name in ["annCPY", "backup"]:
+            # Replaces the files, which may be memory mapped by a loaded state
+            save_nrrd_npy_file(join(folder, name + ".npy"), state[name])
+        with open(meta_file, "w") as f:
+            json.dump({
+                "ids": np.asarray(state["ids"]).tolist(),
+                "center": np.asarray(state["center"]).tolist(),
+                "inv_dict_reg_ids": np.asarray(state["inv_dict_reg_ids"]).tolist(),
+                "files": None if checksums is None else list(checksums),
+                "version": STATE_VERSION,
+            }, f)
+
+    def prune(self):
+        """
+        Remove the states stored by previous versions of the cache, which were keyed on the
+        checksums of the input files and are never reused.
+        """
+        if not isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            meta_file = join(self.folder, name, "state.json")
+            if not isfile(meta_file):
+                continue
+            with open(meta_file, "r") as f:
+                version = json.load(f).get("version")
+            if version != STATE_VERSION:
+                shutil.rmtree(join(self.folder, name))
+
+    def load_or_prepare(self, filenames, annotation, dict_reg_ids, nissl, axis=0, backup=None,
+                        processes=1):
+        """
+        Get the prepared state of a session from the cache, or prepare and store it.
+
+        :param list filenames: paths to the files of the annotation, nissl and backup volumes.
+        :param ndarray annotation: Volumetric array of brain region ids
+        :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS to their list of
+            brain region ids
+        :param ndarray nissl: Volumetric array of nissl expression
+        :param int axis: Axis of the slices to display.
+        :param ndarray backup: Volumetric array of the original brain region ids
+        :param int processes: Number of processes preparing the state.
+        :return: prepared state
+        :rtype: dict
+        """
+        key = self.key(dict_reg_ids, axis)
+        checksums = self.checksums(filenames)
+        state = self.load(key, checksums)
+        if state is None:
+            state = AnnotationImage(annotation, dict_reg_ids, nissl, axis, backup,
+                                    processes=processes).get_state()
+            self.save(key, state, checksums)
+        return state
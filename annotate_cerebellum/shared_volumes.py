@@ -0,0 +1,267 @@
+"""
+Read-only volumes shared between processes through shared memory, so that several editors running
+on the same workstation load the Nissl and original annotation volumes only once.
+
+A publisher process loads the volumes, copies them into shared memory blocks and writes a manifest
+(JSON file listing the blocks with their shapes, dtypes, source files and checksums). The editors
+attach to the blocks listed in the manifest if they were published from the files and with the
+shape the editors use, and keep only the working state of their region in private memory.
+The blocks are released and the manifest is removed when the publisher stops::
+
+    python -m annotate_cerebellum.shared_volumes data/shared_volumes.json \\
+        nissl=data/ara_nissl_25.nrrd backup=data/annotation_corrected_clf.npy
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from os.path import abspath, isfile
+
+import numpy as np
+
+from annotate_cerebellum.utils import file_checksum, load_nrrd_npy_files
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _check_shared_memory():
+    if shared_memory is None:
+        raise Exception("Shared volumes require Python 3.8 or later.")
+
+
+def _open_block(name):
+    """
+    Attach to an existing shared memory block without letting the resource tracker of this
+    process destroy it at exit.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    block = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+
+def _check_sources(manifest, sources, shape=None):
+    """
+    Check that the volumes of a manifest were published from the given files, unchanged since,
+    and have the expected shape.
+    """
+    for name, filename in sources.items():
+        if name not in manifest:
+            raise Exception("The volume {} is not shared.".format(name))
+        entry = manifest[name]
+        if entry.get("source") != abspath(filename):
+            raise Exception("The shared volume {} was not published from {}.".format(
+                name, filename))
+        if entry.get("checksum") != file_checksum(filename):
+            raise Exception("{} has changed since the volume {} was published.".format(
+                filename, name))
+        if shape is not None and tuple(entry["shape"]) != tuple(shape):
+            raise Exception("The shared volume {} has the shape {} instead of {}.".format(
+                name, tuple(entry["shape"]), tuple(shape)))
+
+
+class SharedVolumes:
+    """
+    Set of named read-only volumes stored in shared memory blocks.
+    """
+
+    def __init__(self, blocks, manifest, owner=False):
+        """
+        Map the shared memory blocks as numpy arrays. Use publish or attach instead.
+
+        :param dict blocks: Dictionary of volume name to its SharedMemory block.
+        :param dict manifest: Dictionary of volume name to the name, shape and dtype of its block
+            and its source file.
+        :param bool owner: True if this process created the blocks and must release them.
+        """
+        self.blocks = blocks
+        self.manifest = manifest
+        self.owner = owner
+        self.volumes = {}
+        for name, block in blocks.items():
+            volume = np.ndarray(manifest[name]["shape"], dtype=np.dtype(manifest[name]["dtype"]),
+                                buffer=block.buf)
+            volume.flags.writeable = False
+            self.volumes[name] = volume
+
+    @classmethod
+    def publish(cls, volumes, manifest_filename=None, sources=None):
+        """
+        Copy volumes into new shared memory blocks.
+
+        :param dict volumes: Dictionary of volume name to ndarray.
+        :param str manifest_filename: path to the JSON manifest to write for the editors.
+        :param dict sources: Dictionary of volume name to the file it was loaded from, recorded
+            in the manifest with its checksum so that the editors can check it.
+        :return: shared volumes, owning the blocks
+        :rtype: SharedVolumes
+        """
+        _check_shared_memory()
+        blocks, manifest = {}, {}
+        try:
+            for name, volume in volumes.items():
+                volume = np.ascontiguousarray(volume)
+                block = shared_memory.SharedMemory(create=True, size=max(1, volume.nbytes))
+                blocks[name] = block
+                np.ndarray(volume.shape, dtype=volume.dtype, buffer=block.buf)[...] = volume
+                manifest[name] = {"block": block.name, "shape": list(volume.shape),
+                                  "dtype": volume.dtype.str}
+                if sources is not None and name in sources:
+                    manifest[name]["source"] = abspath(sources[name])
+                    manifest[name]["checksum"] = file_checksum(sources[name])
+        except Exception:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+            raise
+        shared = cls(blocks, manifest, owner=True)
+        if manifest_filename is not None:
+            with open(manifest_filename, "w") as f:
+                json.dump(manifest, f, indent=1)
+        return shared
+
+    @classmethod
+    def attach(cls, manifest, sources=None, shape=None):
+        """
+        Attach to volumes published by another process.
+
+        :param manifest: manifest dictionary or path to the JSON manifest.
+        :param dict sources: Dictionary of volume name to the file the caller would load it from.
+            If given, each of these volumes must have been published from this file, unchanged
+            since.
+        :param tuple shape: shape expected for the volumes of sources.
+        :return: shared volumes
+        :rtype: SharedVolumes
+        """
+        _check_shared_memory()
+        if isinstance(manifest, str):
+            with open(manifest, "r") as f:
+                manifest = json.load(f)
+        if sources is not None:
+            _check_sources(manifest, sources, shape)
+        blocks = {}
+        try:
+            for name, entry in manifest.items():
+                blocks[name] = _open_block(entry["block"])
+        except FileNotFoundError:
+            for block in blocks.values():
+                block.close()
+            raise Exception("The shared volumes are not published anymore.")
+        return cls(blocks, manifest)
+
+    def __getitem__(self, name):
+        return self.volumes[name]
+
+    def __contains__(self, name):
+        return name in self.volumes
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the shared volumes in bytes.
+        """
+        return sum(volume.nbytes for volume in self.volumes.values())
+
+    def close(self, manifest_filename=None):
+        """
+        Detach from the blocks. The publisher also destroys the blocks and removes the manifest.
+        The volumes must not be used afterwards.
+
+        :param str manifest_filename: path to the JSON manifest written by publish.
+        """
+        self.volumes = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+        if self.owner and manifest_filename is not None and isfile(manifest_filename):
+            os.remove(manifest_filename)
+
+
+def process_memory():
+    """
+    Memory used by the current process, in bytes. The proportional set size (pss) divides the
+    shared pages among the processes mapping them, so that summing it over the editors gives the
+    memory they really use. Only the resident set size is available outside of Linux.
+
+    :return: Dictionary with the keys rss, pss, shared and private (None if not available).
+    :rtype: dict
+    """
+    memory = {"rss": None, "pss": None, "shared": None, "private": None}
+    if isfile("/proc/self/smaps_rollup"):
+        values = {}
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == "kB":
+                    values[fields[0].rstrip(":")] = int(fields[1]) * 1024
+        memory["rss"] = values.get("Rss")
+        memory["pss"] = values.get("Pss")
+        memory["shared"] = values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0)
+        memory["private"] = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    elif resource is not None:
+        scale = 1 if sys.platform == "darwin" else 1024
+        memory["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return memory
+
+
+def memory_report(shared=None):
+    """
+    Describe the memory used by the current process and the memory saved by the shared volumes.
+
+    :param SharedVolumes shared: shared volumes used by the process.
+    :return: report
+    :rtype: str
+    """
+    def to_mb(value):
+        return "n/a" if value is None else "{:.1f} MB".format(value / 2 ** 20)
+
+    memory = process_memory()
+    lines = ["Process memory: rss {}, pss {}, shared {}, private {}".format(
+        to_mb(memory["rss"]), to_mb(memory["pss"]), to_mb(memory["shared"]),
+        to_mb(memory["private"]))]
+    if shared is not None:
+        lines.append("Shared volumes: {} ({}), saved for each additional editor".format(
+            to_mb(shared.nbytes), ", ".join(sorted(shared.volumes.keys()))))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish read-only volumes in shared memory for "
+                                                 "the editors running on this workstation")
+    parser.add_argument("manifest", help="path to the JSON manifest read by the editors")
+    parser.add_argument("volumes", nargs="+", help="volumes to publish, as name=path "
+                                                   "(e.g. nissl=data/ara_nissl_25.nrrd)")
+    args = parser.parse_args()
+    names, filenames = zip(*[volume.split("=", 1) for volume in args.volumes])
+    volumes = load_nrrd_npy_files(list(filenames), check_shapes=True)
+    shared = SharedVolumes.publish(dict(zip(names, volumes)), args.manifest,
+                                   dict(zip(names, filenames)))
+    del volumes
+    print(memory_report(shared))
+    print("Volumes published in {}. Press Ctrl+C to stop sharing them.".format(args.manifest))
+    # Release the blocks when the publisher is terminated as well as interrupted
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shared.close(args.manifest)
+
+
+if __name__ == "__main__":
+    main()
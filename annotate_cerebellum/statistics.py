@@ -0,0 +1,154 @@
+"""
+Voxel statistics of the annotation groups, per region and per slice.
+"""
+import csv
+
+import numpy as np
+
+from annotate_cerebellum.annotation_image import DICT_REG_NUMBERS
+
+# Group codes of the working annotations, -1 being the brain voxels outside of the groups.
+GROUP_CODES = [-1] + sorted(DICT_REG_NUMBERS.values())
+GROUP_NAMES = ["other"] + [key for key, _ in sorted(DICT_REG_NUMBERS.items(),
+                                                    key=lambda item: item[1])]
+
+
+class RegionStatistics:
+    """
+    Table of the number of voxels of each group (DICT_REG_NUMBERS) for each region and each
+    slice. The table is computed in a single vectorized pass, a few slices at a time, and can be
+    updated for a subset of slices only.
+    """
+
+    def __init__(self, labels, groups, regions, axis=0, slab_size=16):
+        """
+        Compute the statistics table.
+
+        :param ndarray labels: Volumetric array of brain region ids, used to assign each voxel to
+            a region (e.g. the original annotations).
+        :param groups: Volumetric array of group codes (e.g. AnnotationImage.annCPY), ndarray or
+            RLEVolume.
+        :param dict regions: Dictionary of region name to the list of its brain region ids.
+        :param int axis: Axis of the slices.
+        :param int slab_size: Number of slices processed at once.
+        """
+        if labels.shape != groups.shape:
+            raise Exception("The labels and groups volumes must have the same shape.")
+        self.labels = labels
+        self.groups = groups
+        self.axis = axis
+        self.slab_size = slab_size
+        self.region_names = list(regions.keys())
+        region_ids = [np.asarray(regions[name]).ravel() for name in self.region_names]
+        self.__keys = np.unique(np.concatenate(region_ids)) if len(region_ids) > 0 \
+            else np.zeros(0, dtype=int)
+        # Region index of each key, the last index is used for voxels outside the regions
+        self.__key_region = np.full(len(self.__keys) + 1, len(self.region_names), dtype=np.int64)
+        for i, ids_reg in enumerate(region_ids):
+            self.__key_region[np.searchsorted(self.__keys, ids_reg)] = i
+        self.counts = np.zeros((len(self.region_names), len(GROUP_CODES),
+                                labels.shape[axis]), dtype=np.int64)
+        self.version = 0  # version of the AnnotationImage counted, see refresh
+        self.update()
+
+    @classmethod
+    def from_annotation_image(cls, annotation_image, regions, slab_size=16):
+        """
+        Compute the statistics of the working annotations of an AnnotationImage. Voxels are
+        assigned to regions with the original annotations if available.
+
+        :param AnnotationImage annotation_image: annotation model.
+        :param dict regions: Dictionary of region name to the list of its brain region ids.
+        :param int slab_size: Number of slices processed at once.
+        :return: statistics table
+        :rtype: RegionStatistics
+        """
+        labels = annotation_image.orig_ann if annotation_image.orig_ann is not None \
+            else annotation_image.annotation
+        statistics = cls(labels, annotation_image.annCPY, regions, annotation_image.axis,
+                         slab_size)
+        statistics.version = annotation_image.version
+        return statistics
+
+    def update(self, slices=None):
+        """
+        Recount the voxels of a list of slices.
+
+        :param list slices: Indices of the slices to recount. If None, all slices are counted.
+        """
+        slices = np.arange(self.labels.shape[self.axis]) if slices is None \
+            else np.unique(np.asarray(list(slices), dtype=int))
+        n_regions = len(self.region_names) + 1
+        n_groups = len(GROUP_CODES)
+        start = 0
+        while start < len(slices):
+            # Consecutive slices are read by slabs, the groups being possibly an RLEVolume
+            stop = start + 1
+            while stop < len(slices) and stop - start < self.slab_size and \
+                    slices[stop] == slices[stop - 1] + 1:
+                stop += 1
+            chunk = slices[start:stop]
+            start = stop
+            slab = [slice(None)] * 3
+            slab[self.axis] = slice(chunk[0], chunk[-1] + 1)
+            labels = np.moveaxis(np.asarray(self.labels[tuple(slab)]), self.axis, 0)
+            groups = np.moveaxis(np.asarray(self.groups[tuple(slab)]), self.axis, 0)
+            positions = np.searchsorted(self.__keys, labels)
+            positions[self.__keys[np.minimum(positions, len(self.__keys) - 1)] != labels] = \
+                len(self.__keys)
+            index = self.__key_region[positions]
+            index += n_regions * np.arange(len(chunk)).reshape((-1,) + (1,) * (labels.ndim - 1))
+            index *= n_groups
+            index += np.asarray(groups, dtype=np.int64) + 1
+            counts = np.bincount(index.ravel(), minlength=len(chunk) * n_regions * n_groups)
+            counts = counts.reshape(len(chunk), n_regions, n_groups)[:, :-1]
+            self.counts[:, :, chunk] = np.moveaxis(counts, 0, -1)
+
+    def refresh(self, annotation_image):
+        """
+        Recount the slices modified in an AnnotationImage since the last refresh. Each statistics
+        table and consistency checker keeps the version of the model it has seen, so that they
+        are refreshed independently.
+
+        :param AnnotationImage annotation_image: annotation model used to build the statistics.
+        """
+        self.groups = annotation_image.annCPY
+        self.update(annotation_image.modified_slices(self.version))
+        self.version = annotation_image.version
+
+    def totals(self):
+        """
+        Number of voxels of each group for each region, summed over all slices.
+
+        :return: array of shape (n_regions, n_groups)
+        :rtype: ndarray
+        """
+        return np.sum(self.counts, axis=-1)
+
+    def difference(self, other):
+        """
+        Difference of the voxel counts with another statistics table of the same regions.
+
+        :param RegionStatistics other: statistics to compare with (e.g. before the session).
+        :return: array of shape (n_regions, n_groups, n_slices)
+        :rtype: ndarray
+        """
+        if self.counts.shape != other.counts.shape:
+            raise Exception("The statistics tables must have the same shape.")
+        return self.counts - other.counts
+
+    def to_csv(self, filename, counts=None):
+        """
+        Export the table as a csv file with one row per region and slice containing voxels, and
+        one column per group.
+
+        :param str filename: path to the csv file.
+        :param ndarray counts: table to export, e.g. a difference table. Defaults to the counts.
+        """
+        counts = self.counts if counts is None else counts
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["region", "slice"] + GROUP_NAMES)
+            for i, name in enumerate(self.region_names):
+                for slice_id in np.where(np.any(counts[i] != 0, axis=0))[0]:
+                    writer.writerow([name, slice_id] + counts[i, :, slice_id].tolist())
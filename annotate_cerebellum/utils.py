@@ -1,9 +1,24 @@
 """
 Utility functions for all applications.
 """
+import bz2
+import hashlib
+import os
+import zlib
 import nrrd
 import numpy as np
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import getmtime, getsize, isfile, join
+from time import perf_counter
+
+from annotate_cerebellum.chunked_volume import INDEX_FILENAME, ChunkedVolume, is_chunked_volume
+from annotate_cerebellum.profiling import profiled
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 DEFAULT_HEADER = OrderedDict([('type', 'uint32'),
                               ('dimension', 3),
@@ -18,32 +33,147 @@ DEFAULT_HEADER = OrderedDict([('type', 'uint32'),
                               ('space origin', np.array([0., 0., 0.]))])
 
 
-def load_nrrd_npy_file(filename):
+def load_nrrd_npy_file(filename, roi=None, mmap_mode=None):
     """
-    Loads a volumetric nrrd file or a numpy file.
+    Loads a volumetric nrrd file, a numpy file or a chunked volume directory.
 
     :param str filename: path to the file to open.
+    :param tuple roi: tuple of slices defining the region of interest to load, e.g.
+        np.s_[10:20, :, 5:]. If None, the whole volume is loaded. Numpy files are memory mapped and
+        chunked volumes only decompress the chunks intersecting the region.
+    :param str mmap_mode: if provided, whole numpy files are memory mapped with this mode (see
+        numpy.load) instead of being loaded, e.g. "r" for read-only volumes and "c" for volumes
+        modified in memory only.
     :return: volumetric array stored in file.
     :rtype: ndarray
     """
-    if filename.endswith(".npy"):
-        return np.load(filename)
+    if is_chunked_volume(filename):
+        return ChunkedVolume(filename).read(roi)
+    elif filename.endswith(".npy"):
+        if roi is None:
+            return np.load(filename, mmap_mode=mmap_mode)
+        return np.array(np.load(filename, mmap_mode="r")[roi])
+    elif filename.endswith(".nrrd"):
+        data = nrrd.read(filename)[0]
+        return data if roi is None else np.array(data[roi])
+    else:
+        raise Exception("Extension not recognized, file could not be opened.")
+
+
+def load_nrrd_npy_files(filenames, max_workers=None, check_shapes=False, roi=None,
+                        return_timings=False, mmap_mode=None):
+    """
+    Loads several volumetric files in parallel in a thread pool. Decompression of nrrd files and
+    reading of the files release the GIL so the files are loaded concurrently.
+
+    :param list filenames: paths to the files to open.
+    :param int max_workers: maximum number of threads. Defaults to one thread per file.
+    :param bool check_shapes: if True, checks from the file headers that all volumes have the
+        same shape before loading them.
+    :param tuple roi: tuple of slices defining the region of interest to load for each file.
+    :param bool return_timings: if True, returns also the loading time in seconds of each file.
+    :param str mmap_mode: memory map mode of the whole numpy files, see load_nrrd_npy_file.
+    :return: list of the volumetric arrays stored in the files, in the same order as filenames,
+        and the list of loading times if return_timings is True.
+    :rtype: list
+    """
+    if check_shapes:
+        shapes = [read_volume_shape(filename) for filename in filenames]
+        for filename, shape in zip(filenames[1:], shapes[1:]):
+            if shape != shapes[0]:
+                raise Exception("The volumes {} and {} must have the same shape.".format(
+                    filenames[0], filename))
+
+    def timed_load(filename):
+        start = perf_counter()
+        data = load_nrrd_npy_file(filename, roi, mmap_mode)
+        return data, perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, len(filenames))) as executor:
+        results = list(executor.map(timed_load, filenames))
+    volumes = [data for data, _ in results]
+    if return_timings:
+        return volumes, [timing for _, timing in results]
+    return volumes
+
+
+def read_volume_shape(filename):
+    """
+    Reads the shape of a volumetric nrrd file, numpy file or chunked volume without loading
+    its content.
+
+    :param str filename: path to the file to open.
+    :return: shape of the volumetric array stored in file.
+    :rtype: tuple
+    """
+    if is_chunked_volume(filename):
+        return ChunkedVolume(filename).shape
+    elif filename.endswith(".npy"):
+        return np.load(filename, mmap_mode="r").shape
     elif filename.endswith(".nrrd"):
-        return nrrd.read(filename)[0]
+        return tuple(int(s) for s in nrrd.read_header(filename)["sizes"])
     else:
         raise Exception("Extension not recognized, file could not be opened.")
 
 
+def iter_nrrd_slabs(filename, slab_size=16):
+    """
+    Read a nrrd file by slabs of the last axis, which are contiguous in the file, decompressing
+    the gzip and bzip2 data on the fly so that the whole volume is never held in memory.
+
+    :param str filename: path to the nrrd file.
+    :param int slab_size: number of planes of the last axis read at once.
+    :return: generator of the index of the first plane and of the slab array
+    :rtype: generator
+    """
+    with open(filename, "rb") as f:
+        header = nrrd.read_header(f)
+        if header["encoding"] not in ["raw", "gzip", "gz", "bzip2", "bz2"] or \
+                any(key in header for key in ["data file", "datafile", "line skip", "lineskip",
+                                              "byte skip", "byteskip"]):
+            raise Exception("The nrrd file {} cannot be read by slabs.".format(filename))
+        # Same data type as nrrd.read
+        dtype = nrrd.reader._determine_datatype(header)
+        shape = tuple(int(s) for s in header["sizes"])
+        plane_bytes = int(np.prod(shape[:-1])) * dtype.itemsize
+        if header["encoding"] in ["gzip", "gz"]:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        elif header["encoding"] in ["bzip2", "bz2"]:
+            decompressor = bz2.BZ2Decompressor()
+        else:
+            decompressor = None
+        buffer = bytearray()
+        for start in range(0, shape[-1], slab_size):
+            stop = min(start + slab_size, shape[-1])
+            n_bytes = (stop - start) * plane_bytes
+            while len(buffer) < n_bytes:
+                block = f.read(1 << 20)
+                if len(block) == 0:
+                    raise Exception("The nrrd file {} is truncated.".format(filename))
+                buffer += block if decompressor is None else decompressor.decompress(block)
+            slab = np.frombuffer(bytes(buffer[:n_bytes]), dtype=dtype)
+            del buffer[:n_bytes]
+            # nrrd files store the first axis first, as in the arrays returned by nrrd.read
+            yield start, slab.reshape(shape[:-1] + (stop - start,), order="F")
+
+
 def save_nrrd_npy_file(filename, data, header=None):
     """
-    Save a volumetric array nrrd file or a numpy file.
+    Save a volumetric array nrrd file, a numpy file or a chunked volume directory.
 
     :param str filename: path to the file to save the data to.
     :param ndarray data: data to store in file
     :param dict header: Dictionary header for nrrd files
     """
-    if filename.endswith(".npy"):
-        np.save(filename, data)
+    if is_chunked_volume(filename):
+        ChunkedVolume.from_array(filename, data)
+    elif filename.endswith(".npy"):
+        # The data is written to a temporary file which replaces the file at the end, so that a
+        # volume memory mapped from the file (lazy mode) stays readable while it is saved.
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as f:
+            np.save(f, data)
+        os.replace(temporary, filename)
     elif filename.endswith(".nrrd"):
         if header:
             nrrd.write(filename, data, header=header)
@@ -53,6 +183,141 @@ def save_nrrd_npy_file(filename, data, header=None):
         raise Exception("Extension not recognized, file could not be opened.")
 
 
+def merge_npy_changes(filename, annotation, original, slab_size=16):
+    """
+    Save the voxels of an annotation volume that differ from its original version into a numpy
+    file, keeping the other voxels of the file. Editors working in parallel on different regions
+    of the same file thus keep the corrections saved by the others in the meantime. The file is
+    rewritten slab by slab into a temporary file which replaces it, under a lock file when the
+    platform supports it.
+
+    :param str filename: path to the numpy file to update. If it does not exist, the original
+        voxels are used for the unchanged voxels.
+    :param ndarray annotation: volume of brain region ids, with the changes of the editor.
+    :param ndarray original: volume of brain region ids loaded by the editor, e.g. memory mapped
+        from the file when the editor started. The saves replace the file, so such a mapping
+        keeps the content of the file when it was opened.
+    :param int slab_size: number of planes merged at once.
+    :return: number of voxels changed by the editor
+    :rtype: int
+    """
+    if not filename.endswith(".npy"):
+        raise Exception("Only numpy files can be merged.")
+    if annotation.shape != original.shape:
+        raise Exception("The annotation and original volumes must have the same shape.")
+    with open(filename + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        current = np.load(filename, mmap_mode="r") if isfile(filename) else original
+        if current.shape != annotation.shape:
+            raise Exception("The file {} does not have the shape of the annotations.".format(
+                filename))
+        temporary = filename + ".tmp"
+        merged = np.lib.format.open_memmap(temporary, mode="w+", dtype=annotation.dtype,
+                                           shape=annotation.shape)
+        n_changed = 0
+        for start in range(0, annotation.shape[0], slab_size):
+            slab = np.asarray(annotation[start:start + slab_size])
+            changed = slab != np.asarray(original[start:start + slab_size])
+            n_changed += int(np.count_nonzero(changed))
+            merged[start:start + slab_size] = np.where(changed, slab,
+                                                       current[start:start + slab_size])
+        merged.flush()
+        del merged, current
+        os.replace(temporary, filename)
+    return n_changed
+
+
+def file_signature(filename):
+    """
+    Size and modification time of a volumetric file, used to invalidate the caches derived from
+    the file.
+
+    :param str filename: path to the file.
+    :return: dictionary with the size and mtime of the file.
+    :rtype: dict
+    """
+    if is_chunked_volume(filename):
+        filename = join(filename, INDEX_FILENAME)
+    return {"size": getsize(filename), "mtime": getmtime(filename)}
+
+
+def file_checksum(filename, block_size=1 << 20):
+    """
+    Checksum of a volumetric file, computed from its size, modification time and the content of
+    its first, middle and last blocks so that it stays fast on large files. For chunked volumes,
+    the index is hashed entirely.
+
+    :param str filename: path to the file.
+    :param int block_size: number of bytes read in each sampled block.
+    :return: hexadecimal SHA-1 digest
+    :rtype: str
+    """
+    if is_chunked_volume(filename):
+        filename = join(filename, INDEX_FILENAME)
+    signature = file_signature(filename)
+    digest = hashlib.sha1("{size}_{mtime}".format(**signature).encode())
+    with open(filename, "rb") as f:
+        for position in [0, signature["size"] // 2, signature["size"] - block_size]:
+            f.seek(max(0, position))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def compute_label_histogram(volume, slab_size=16):
+    """
+    Counts the number of voxels of each label of a volume. The volume is processed slab by slab
+    along its first axis and the counts of each slab are merged.
+
+    :param ndarray volume: Volumetric array of integer labels.
+    :param int slab_size: number of planes of the volume processed at once.
+    :return: sorted array of the labels present in the volume and array of their voxel counts.
+    :rtype: tuple
+    """
+    labels, counts = [], []
+    for start in range(0, volume.shape[0], slab_size):
+        slab_labels, slab_counts = np.unique(volume[start:start + slab_size], return_counts=True)
+        labels.append(slab_labels)
+        counts.append(slab_counts)
+    if len(labels) == 0:
+        return np.zeros(0, dtype=volume.dtype), np.zeros(0, dtype=np.int64)
+    labels, inverse = np.unique(np.concatenate(labels), return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate(counts), minlength=len(labels))
+    return labels, np.asarray(counts, dtype=np.int64)
+
+
+def load_label_histogram(filename, volume=None):
+    """
+    Loads the label histogram of a volumetric file from its cache, stored next to the file, or
+    computes and caches it if the cache is missing, unreadable or if the file has changed since.
+
+    :param str filename: path to the volumetric file.
+    :param ndarray volume: content of the file, if it is already loaded.
+    :return: sorted array of the labels present in the volume and array of their voxel counts.
+    :rtype: tuple
+    """
+    cache_file = filename.rstrip("/\\") + ".hist.npz"
+    signature = file_signature(filename)
+    if isfile(cache_file):
+        try:
+            with np.load(cache_file) as cache:
+                if cache["size"] == signature["size"] and cache["mtime"] == signature["mtime"]:
+                    return cache["labels"], cache["counts"]
+        except Exception:
+            pass  # unreadable cache, e.g. truncated: the histogram is computed again
+    if volume is None:
+        volume = load_nrrd_npy_file(filename)
+    labels, counts = compute_label_histogram(volume)
+    # Written to a temporary file replacing the cache, so that concurrent readers never see a
+    # partial file
+    temporary = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(temporary, "wb") as f:
+        np.savez(f, labels=labels, counts=counts, **signature)
+    os.replace(temporary, cache_file)
+    return labels, counts
+
+
+@profiled("find_group")
 def find_group(image, position, id_reg):
     """
     Find all voxels labeled with the same id_reg id.
@@ -78,6 +343,152 @@ def find_group(image, position, id_reg):
     return np.array(list_position)
 
 
+def find_connected(mask, seeds):
+    """
+    Find all voxels of a mask connected to the seed positions, through their faces.
+    The exploration is done by waves: all the voxels of the current front are expanded at once.
+
+    :param np.ndarray mask: Boolean n-dimensional array of the voxels that can be reached.
+    :param list seeds: Starting position or list of starting positions.
+    :return: Array of the positions connected to the seeds, of shape (N, mask.ndim).
+    :rtype: ndarray
+    """
+    padded = np.pad(np.asarray(mask, dtype=bool), 1, mode="constant", constant_values=False)
+    flat = padded.ravel()
+    strides = np.cumprod((padded.shape[1:] + (1,))[::-1])[::-1]
+    offsets = np.concatenate((strides, -strides))
+    seeds = np.reshape(np.asarray(seeds, dtype=int), (-1, mask.ndim)) + 1
+    front = np.ravel_multi_index(tuple(seeds.T), padded.shape)
+    front = np.unique(front[flat[front]])
+    flat[front] = False
+    reached = [front]
+    while len(front) > 0:
+        front = (front[:, None] + offsets).ravel()
+        front = np.unique(front[flat[front]])
+        flat[front] = False
+        reached.append(front)
+    return np.array(np.unravel_index(np.concatenate(reached), padded.shape), dtype=int).T - 1
+
+
+def grow_region(intensity, seed, tolerance, mask=None):
+    """
+    Find all pixels (or voxels) connected to a seed position whose intensity differs from the
+    intensity of the seed by at most a tolerance.
+
+    :param np.ndarray intensity: n-dimensional array of intensities.
+    :param list seed: Starting position.
+    :param float tolerance: Maximum absolute difference with the intensity of the seed.
+    :param np.ndarray mask: Boolean array of the positions that can be reached.
+    :return: Array of the positions of the region, of shape (N, intensity.ndim).
+    :rtype: ndarray
+    """
+    seed = tuple(np.asarray(seed, dtype=int))
+    within = np.abs(np.asarray(intensity, dtype=np.float32) - np.float32(intensity[seed])) <= \
+        tolerance
+    if mask is not None:
+        within *= mask
+    return find_connected(within, seed)
+
+
+def arrival_levels(levels, seed, mask=None):
+    """
+    Compute for each position the minimum tolerance for which grow_region reaches it from a
+    seed: the lowest possible maximum difference with the level of the seed along a path from the
+    seed. Positions are processed by increasing tolerance with a bucket queue, so that any
+    tolerance can then be previewed with a threshold.
+
+    :param np.ndarray levels: n-dimensional array of non-negative integer levels, e.g. 8-bit
+        intensities.
+    :param list seed: Starting position.
+    :param np.ndarray mask: Boolean array of the positions that can be reached.
+    :return: Array of the minimum tolerances, of the shape of levels. Unreachable positions get
+        the maximum value of the int32 type.
+    :rtype: ndarray
+    """
+    levels = np.asarray(levels, dtype=np.int32)
+    seed = tuple(np.asarray(seed, dtype=int))
+    unreachable = np.iinfo(np.int32).max
+    costs = np.abs(levels - levels[seed])
+    if mask is not None:
+        costs[~np.asarray(mask, dtype=bool)] = unreachable
+    padded = np.pad(costs, 1, mode="constant", constant_values=unreachable)
+    strides = np.cumprod((padded.shape[1:] + (1,))[::-1])[::-1]
+    offsets = np.concatenate((strides, -strides)).tolist()
+    costs = padded.ravel().tolist()
+    arrival = [unreachable] * len(costs)
+    start = int(np.ravel_multi_index(tuple(np.array(seed) + 1), padded.shape))
+    if costs[start] == unreachable:
+        return np.full(levels.shape, unreachable, dtype=np.int32)
+    buckets = [[] for _ in range(int(np.max(padded, initial=0, where=padded != unreachable)) + 1)]
+    arrival[start] = 0
+    buckets[0].append(start)
+    for level, bucket in enumerate(buckets):
+        while len(bucket) > 0:
+            position = bucket.pop()
+            if arrival[position] < level:
+                continue  # already reached with a lower tolerance
+            for offset in offsets:
+                neighbor = position + offset
+                cost = costs[neighbor]
+                if cost == unreachable:
+                    continue
+                cost = max(level, cost)
+                if cost < arrival[neighbor]:
+                    arrival[neighbor] = cost
+                    buckets[cost].append(neighbor)
+    arrival = np.reshape(np.array(arrival, dtype=np.int32), padded.shape)
+    return arrival[tuple(slice(1, -1) for _ in range(levels.ndim))]
+
+
+def distance_to_mask(mask, block_size=32):
+    """
+    Compute the exact Euclidean distance of each pixel of an image to the nearest pixel of a mask.
+    The distance to the nearest mask pixel of the same column is computed first, then combined
+    along the rows for blocks of rows at once.
+
+    :param np.ndarray mask: Boolean 2D array, not empty.
+    :param int block_size: number of rows processed at once.
+    :return: Array of the distances, of the shape of the mask.
+    :rtype: ndarray
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape[1] > mask.shape[0]:  # the row pass is quadratic in the number of columns
+        return distance_to_mask(mask.T, block_size).T
+    height, width = mask.shape
+    far = height + width
+    rows = np.arange(height)[:, None]
+    above = np.maximum.accumulate(np.where(mask, rows, -far), axis=0)
+    below = np.minimum.accumulate(np.where(mask, rows, 2 * far)[::-1], axis=0)[::-1]
+    column_distances = np.minimum(np.minimum(rows - above, below - rows), far) ** 2
+    columns = np.arange(width)
+    column_offsets = (columns[:, None] - columns[None, :]) ** 2
+    distances = np.zeros(mask.shape, dtype=np.float32)
+    for start in range(0, height, block_size):
+        block = column_distances[start:start + block_size]
+        distances[start:start + block_size] = np.sqrt(
+            np.min(block[:, None, :] + column_offsets[None], axis=2))
+    return distances
+
+
+def signed_distance(mask):
+    """
+    Compute the signed Euclidean distance of each pixel of an image to the boundary of a mask,
+    negative inside the mask. Empty and full masks get the largest possible distance of the image.
+
+    :param np.ndarray mask: Boolean 2D array.
+    :return: Array of the signed distances, of the shape of the mask.
+    :rtype: ndarray
+    """
+    mask = np.asarray(mask, dtype=bool)
+    far = float(np.sum(mask.shape))
+    if not np.any(mask):
+        return np.full(mask.shape, far, dtype=np.float32)
+    if np.all(mask):
+        return np.full(mask.shape, -far, dtype=np.float32)
+    return distance_to_mask(mask) - distance_to_mask(~mask)
+
+
+@profiled("draw_2d_line")
 def draw_2d_line(x0, y0, x1, y1):
     """
     Draws a 2D line between 2 points and returns intermediate positions.
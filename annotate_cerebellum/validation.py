@@ -0,0 +1,318 @@
+"""
+Anatomical consistency checks of the group annotations.
+
+The rules are evaluated on the group codes (DICT_REG_NUMBERS) by comparing each voxel with its
+face neighbors, a few slices at a time. The number of voxels violating each rule is indexed per
+slice, so that the editor can jump from one slice with issues to the next. Three kinds of rules
+are available:
+
+* contact: voxels of a group touching a voxel of other groups, e.g. the molecular layer touching
+  the fiber tracts.
+* isolated: voxels of a group without neighbor of the same group.
+* enclosed: voxels of a group inside the brain, i.e. which cannot be reached from the border of
+  their slice without crossing brain voxels.
+
+The module can also be run to check an annotation volume:
+
+.. code-block:: bash
+
+    python -m annotate_cerebellum.validation data/annotation_corrected.nrrd \
+        data/brain_regions.json --backup data/annotation_corrected_clf.npy --csv issues.csv
+"""
+import argparse
+import csv
+
+import numpy as np
+
+from annotate_cerebellum import morphology
+from annotate_cerebellum.annotation_image import DICT_REG_NUMBERS, encode_slab
+from annotate_cerebellum.hierarchy import BrainHierarchy, cerebellar_layer_ids
+from annotate_cerebellum.utils import load_nrrd_npy_file
+
+DEFAULT_RULES = [
+    {"name": "mol_fib_contact", "kind": "contact", "key": "mol", "neighbors": ["fib"]},
+    {"name": "isolated_gl", "kind": "isolated", "key": "gl"},
+    {"name": "corrected_inside_brain", "kind": "enclosed", "key": "corrected"},
+]
+RULE_KINDS = ["contact", "isolated", "enclosed"]
+
+
+def _violations(codes, rule, axis):
+    """
+    Find the voxels of a block of group codes violating a rule.
+
+    :param ndarray codes: 3D array of group codes.
+    :param dict rule: rule, see DEFAULT_RULES.
+    :param int axis: Axis of the slices, used by the enclosed rules.
+    :return: Boolean array
+    :rtype: ndarray
+    """
+    group = codes == DICT_REG_NUMBERS[rule["key"]]
+    if rule["kind"] == "contact":
+        others = np.isin(codes, [DICT_REG_NUMBERS[key] for key in rule["neighbors"]])
+        return group & (morphology.count_neighbors(others) > 0)
+    if rule["kind"] == "isolated":
+        return group & (morphology.count_neighbors(group) == 0)
+    brain = ~np.isin(codes, [DICT_REG_NUMBERS["out"], DICT_REG_NUMBERS["corrected"]])
+    return group & morphology.fill_holes(brain, axis)
+
+
+def encode_groups(annotation, dict_reg_ids, backup=None, slab_size=16):
+    """
+    Compute the group codes of an annotation volume, as in the working annotations of
+    AnnotationImage: voxels outside of the groups are -1 in the brain, and outside voxels whose
+    original group is not outside are corrected.
+
+    :param ndarray annotation: Volumetric array of brain region ids.
+    :param dict dict_reg_ids: Dictionary linking keys of DICT_REG_NUMBERS to their list of brain
+        region ids.
+    :param ndarray backup: Volumetric array of the original brain region ids.
+    :param int slab_size: Number of slices of the first axis encoded at once.
+    :return: Volumetric array of group codes
+    :rtype: ndarray
+    """
+    groups = np.zeros(annotation.shape, np.int8)
+    for start in range(0, annotation.shape[0], slab_size):
+        encode_slab(annotation, backup, dict_reg_ids, groups, None, start, start + slab_size)
+    return groups
+
+
+class ConsistencyChecker:
+    """
+    Index of the number of voxels violating each consistency rule for each slice. The index is
+    computed in a single pass over slabs of slices, each slab being extended by one slice on each
+    side for the neighbor comparisons, and can be updated for a subset of slices only.
+    """
+
+    def __init__(self, groups, rules=None, axis=0, slab_size=16, box=None):
+        """
+        Compute the violation index.
+
+        :param groups: Volumetric array of group codes (e.g. AnnotationImage.annCPY), ndarray or
+            RLEVolume. The slabs are read from it at each update, so that the index follows the
+            changes of the groups.
+        :param list rules: List of rules, see DEFAULT_RULES.
+        :param int axis: Axis of the slices.
+        :param int slab_size: Number of slices processed at once.
+        :param tuple box: Region of the groups to check, as a tuple of slices of step 1. Defaults
+            to the whole volume. The reported slices and voxels are positions in groups.
+        """
+        self.rules = DEFAULT_RULES if rules is None else rules
+        for rule in self.rules:
+            if rule["kind"] not in RULE_KINDS:
+                raise Exception("Unknown rule kind: {}. Available kinds: {}".format(
+                    rule["kind"], ", ".join(RULE_KINDS)))
+        self.rule_names = [rule["name"] for rule in self.rules]
+        self.groups = groups
+        self.axis = axis
+        self.slab_size = slab_size
+        if box is None:
+            box = tuple(slice(0, dim) for dim in groups.shape)
+        self.box = tuple(slice(*index.indices(dim)[:2]) for index, dim in zip(box, groups.shape))
+        self.origin = np.array([index.start for index in self.box], dtype=int)
+        self.shape = tuple(index.stop - index.start for index in self.box)
+        self.counts = np.zeros((len(self.rules), self.shape[axis]), dtype=np.int64)
+        self.version = 0  # version of the AnnotationImage checked, see refresh
+        self.update()
+
+    @classmethod
+    def from_annotation_image(cls, annotation_image, rules=None, slab_size=16):
+        """
+        Check the working annotations of an AnnotationImage inside the bounding box of its
+        region.
+
+        :param AnnotationImage annotation_image: annotation model.
+        :param list rules: List of rules, see DEFAULT_RULES.
+        :param int slab_size: Number of slices processed at once.
+        :return: violation index
+        :rtype: ConsistencyChecker
+        """
+        box = tuple(slice(start, stop + 1) for start, stop in annotation_image.ids)
+        checker = cls(annotation_image.annCPY, rules, annotation_image.axis, slab_size, box)
+        checker.version = annotation_image.version
+        return checker
+
+    def __slab(self, start, stop):
+        """
+        Evaluate the rules on slices of the groups.
+
+        :param int start: index of the first slice.
+        :param int stop: index after the last slice.
+        :return: Boolean array of shape (n_rules,) + shape of the slices, the slice axis being
+            the second axis.
+        :rtype: ndarray
+        """
+        low, high = max(0, start - 1), min(self.shape[self.axis], stop + 1)
+        box = list(self.box)
+        offset = self.origin[self.axis]
+        box[self.axis] = slice(offset + low, offset + high)
+        codes = np.moveaxis(np.asarray(self.groups[tuple(box)]), self.axis, 0)
+        violations = np.stack([_violations(codes, rule, 0) for rule in self.rules])
+        return violations[:, start - low:stop - low]
+
+    def update(self, slices=None):
+        """
+        Recompute the violations of a list of slices.
+
+        :param list slices: Indices of the slices to recompute. If None, all slices are checked.
+        """
+        n_slices = self.shape[self.axis]
+        slices = np.arange(n_slices) if slices is None \
+            else np.unique(np.asarray(list(slices), dtype=int))
+        slices = slices[(slices >= 0) * (slices < n_slices)]
+        start = 0
+        while start < len(slices):
+            # Consecutive slices are processed by slabs
+            stop = start + 1
+            while stop < len(slices) and stop - start < self.slab_size and \
+                    slices[stop] == slices[stop - 1] + 1:
+                stop += 1
+            violations = self.__slab(slices[start], slices[stop - 1] + 1)
+            self.counts[:, slices[start]:slices[stop - 1] + 1] = \
+                np.sum(violations, axis=(2, 3))
+            start = stop
+
+    def refresh(self, annotation_image):
+        """
+        Recheck the slices modified in an AnnotationImage since the last refresh and their
+        neighbors.
+
+        :param AnnotationImage annotation_image: annotation model used to build the checker.
+        """
+        self.groups = annotation_image.annCPY
+        offset = self.origin[self.axis]
+        slices = set()
+        for position in annotation_image.modified_slices(self.version):
+            slices.update([position - offset - 1, position - offset, position - offset + 1])
+        self.update(slices)
+        self.version = annotation_image.version
+
+    def __rule_index(self, rule):
+        if rule is None:
+            return slice(None)
+        if rule not in self.rule_names:
+            raise Exception("Unknown rule: {}.".format(rule))
+        return self.rule_names.index(rule)
+
+    def slices(self, rule=None):
+        """
+        Positions of the slices containing violations.
+
+        :param str rule: Name of the rule. If None, all the rules are considered.
+        :return: sorted array of slice positions
+        :rtype: ndarray
+        """
+        counts = np.atleast_2d(self.counts[self.__rule_index(rule)])
+        return np.where(np.any(counts > 0, axis=0))[0] + self.origin[self.axis]
+
+    def next_slice(self, position, rule=None):
+        """
+        Position of the next slice containing violations, after a slice position. The search
+        continues from the first slice after the last one.
+
+        :param int position: current slice position.
+        :param str rule: Name of the rule. If None, all the rules are considered.
+        :return: slice position, or None if there is no violation.
+        :rtype: int
+        """
+        slices = self.slices(rule)
+        if len(slices) == 0:
+            return None
+        following = slices[slices > position]
+        return int(following[0] if len(following) > 0 else slices[0])
+
+    def voxels(self, position, rule=None):
+        """
+        Voxels of a slice violating the rules.
+
+        :param int position: slice position.
+        :param str rule: Name of the rule. If None, all the rules are considered.
+        :return: Array of voxel indices in the annotations, of shape (N, 3)
+        :rtype: ndarray
+        """
+        local = position - self.origin[self.axis]
+        violations = self.__slab(local, local + 1)[:, 0]
+        if rule is not None:
+            violations = violations[[self.__rule_index(rule)]]
+        rows, cols = np.where(np.any(violations, axis=0))
+        voxels = np.insert(np.array([rows, cols]).T, self.axis, local, axis=1)
+        return voxels + self.origin
+
+    def totals(self):
+        """
+        Number of voxels violating each rule, summed over all slices.
+
+        :return: dictionary of rule name to number of voxels
+        :rtype: dict
+        """
+        return dict(zip(self.rule_names, np.sum(self.counts, axis=1).tolist()))
+
+    def report(self):
+        """
+        Describe the number of violations of each rule and the slices containing them.
+
+        :return: report
+        :rtype: str
+        """
+        lines = []
+        for name, total in self.totals().items():
+            slices = self.slices(name)
+            lines.append("{}: {} voxels in {} slices{}".format(
+                name, total, len(slices),
+                " ({})".format(", ".join(str(pos) for pos in slices[:10]) +
+                               (", ..." if len(slices) > 10 else "")) if len(slices) else ""))
+        return "\n".join(lines)
+
+    def to_csv(self, filename):
+        """
+        Export the index as a csv file with one row per slice containing violations, and one
+        column per rule.
+
+        :param str filename: path to the csv file.
+        """
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["slice"] + self.rule_names)
+            for slice_id in np.where(np.any(self.counts > 0, axis=0))[0]:
+                writer.writerow([slice_id + self.origin[self.axis]] +
+                                self.counts[:, slice_id].tolist())
+
+
+def cerebellar_group_ids(hierarchy):
+    """
+    Region ids of the groups of the whole cerebellar cortex, merging the lobules.
+
+    :param BrainHierarchy hierarchy: hierarchy index.
+    :return: Dictionary linking the keys of DICT_REG_NUMBERS to their list of region ids.
+    :rtype: dict
+    """
+    lobules = list(cerebellar_layer_ids(hierarchy).values())
+    return {
+        "mol": [id_ for lobule in lobules for id_ in lobule["mol"]],
+        "gl": [id_ for lobule in lobules for id_ in lobule["gl"]],
+        "fib": list(lobules[0]["fib"]) if lobules else [],
+        "out": [0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the consistency of the cerebellar "
+                                                 "annotations")
+    parser.add_argument("annotation", help="annotation volume (npy, nrrd or chunked)")
+    parser.add_argument("hierarchy", help="JSON file of the hierarchy of the brain regions")
+    parser.add_argument("--backup", default=None,
+                        help="original annotation volume, to find the corrected voxels")
+    parser.add_argument("--axis", type=int, default=0, help="axis of the slices")
+    parser.add_argument("--csv", default=None, help="csv file of the violations per slice")
+    args = parser.parse_args()
+    dict_reg_ids = cerebellar_group_ids(BrainHierarchy.from_json(args.hierarchy))
+    backup = load_nrrd_npy_file(args.backup) if args.backup else None
+    groups = encode_groups(load_nrrd_npy_file(args.annotation), dict_reg_ids, backup)
+    checker = ConsistencyChecker(groups, axis=args.axis)
+    print(checker.report())
+    if args.csv:
+        checker.to_csv(args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Comparison of two versions of an annotation volume, e.g. the backup and the corrected annotations
+or two releases of an atlas.
+
+The volumes are compared slab by slab in parallel threads, numpy files being memory mapped and
+chunked volumes read by region of interest, so that 10 um volumes are compared in bounded memory
+(a window of slabs is compared ahead of the results consumed).
+The number of changed voxels is counted for each pair of (old, new) region ids and for each slice
+of each axis, and the changed voxels are listed.
+
+The module can also be run to compare two files:
+
+.. code-block:: bash
+
+    python -m annotate_cerebellum.volume_diff data/annotation_corrected_clf.npy \
+        data/annotation_corrected_clfd.npy --hierarchy data/brain_regions.json \
+        --output diff.npz --csv diff.csv
+"""
+import argparse
+import csv
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+
+from annotate_cerebellum.chunked_volume import ChunkedVolume, is_chunked_volume
+from annotate_cerebellum.hierarchy import BrainHierarchy
+from annotate_cerebellum.utils import load_nrrd_npy_file
+
+
+def open_volume(filename):
+    """
+    Open a volume to read it by slabs: numpy files are memory mapped, chunked volumes are read
+    by region of interest and nrrd files are loaded.
+
+    :param str filename: path to the file to open.
+    :return: volume supporting slicing
+    :rtype: ndarray or ChunkedVolume
+    """
+    if is_chunked_volume(filename):
+        return ChunkedVolume(filename)
+    return load_nrrd_npy_file(filename, mmap_mode="r")
+
+
+def _diff_slab(first, second, start, stop, max_listed=None):
+    """
+    Compare a slab of two volumes.
+
+    :param int max_listed: maximum number of changed voxels listed, all of them if None.
+    :return: the counts of changed voxels per slice of each axis, the changed (old, new) pairs
+        with their number of voxels, and the flat indices and values of the first max_listed
+        changed voxels.
+    :rtype: tuple
+    """
+    old = np.asarray(first[start:stop, :, :])
+    new = np.asarray(second[start:stop, :, :])
+    changed = old != new
+    slice_counts = [np.sum(changed, axis=(1, 2)), np.sum(changed, axis=(0, 2)),
+                    np.sum(changed, axis=(0, 1))]
+    local = np.flatnonzero(changed)
+    old, new = old.ravel()[local], new.ravel()[local]
+    pairs, counts = np.unique(np.stack([old, new], axis=1), axis=0, return_counts=True)
+    listed = slice(None) if max_listed is None else slice(0, max_listed)
+    offset = start * int(np.prod(changed.shape[1:]))
+    return slice_counts, pairs, counts, (local[listed] + offset, old[listed], new[listed])
+
+
+class VolumeDiff:
+    """
+    Voxels changed between two versions of an annotation volume.
+    """
+
+    def __init__(self, first, second, slab_size=16, workers=None, max_changes=None):
+        """
+        Compare two volumes.
+
+        :param first: old volume, ndarray or ChunkedVolume (see open_volume).
+        :param second: new volume, of the same shape.
+        :param int slab_size: Number of planes of the first axis compared at once by each thread.
+        :param int workers: Maximum number of threads.
+        :param int max_changes: Maximum number of changed voxels listed. If None, all the changed
+            voxels are listed. The counts are always complete.
+        """
+        if tuple(first.shape) != tuple(second.shape):
+            raise Exception("The volumes must have the same shape: {} and {}.".format(
+                first.shape, second.shape))
+        self.shape = tuple(first.shape)
+        self.slice_counts = [np.zeros(dim, dtype=np.int64) for dim in self.shape]
+        self.truncated = False
+        all_pairs, all_counts, changes = [], [], []
+        n_listed = 0
+        starts = list(range(0, self.shape[0], slab_size))
+        # Only a few slabs are submitted ahead of the consumed results, so that the memory of the
+        # pending results is bounded and the quota of listed voxels is known at submission.
+        window = 2 * (workers or min(32, (os.cpu_count() or 1) + 4))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while len(pending) > 0 or len(starts) > 0:
+                while len(starts) > 0 and len(pending) < window:
+                    start = starts.pop(0)
+                    quota = None if max_changes is None else max_changes - n_listed
+                    pending.append((start, executor.submit(
+                        _diff_slab, first, second, start, min(start + slab_size, self.shape[0]),
+                        quota)))
+                start, future = pending.popleft()
+                slice_counts, pairs, counts, listed = future.result()
+                self.slice_counts[0][start:start + slab_size] = slice_counts[0]
+                self.slice_counts[1] += slice_counts[1]
+                self.slice_counts[2] += slice_counts[2]
+                all_pairs.append(pairs)
+                all_counts.append(counts)
+                if max_changes is not None:
+                    listed = tuple(array[:max_changes - n_listed] for array in listed)
+                if len(listed[0]) < counts.sum():
+                    self.truncated = True
+                if len(listed[0]) > 0:
+                    changes.append(listed)
+                    n_listed += len(listed[0])
+        self.pairs, inverse = np.unique(np.concatenate(all_pairs), axis=0, return_inverse=True)
+        self.pair_counts = np.bincount(inverse.ravel(), weights=np.concatenate(all_counts),
+                                       minlength=len(self.pairs)).astype(np.int64)
+        order = np.argsort(-self.pair_counts, kind="stable")
+        self.pairs, self.pair_counts = self.pairs[order], self.pair_counts[order]
+        if len(changes) > 0:
+            self.indices, self.old_values, self.new_values = \
+                (np.concatenate(arrays) for arrays in zip(*changes))
+        else:
+            self.indices = np.zeros(0, dtype=np.int64)
+            self.old_values = self.new_values = np.zeros(0, dtype=self.pairs.dtype)
+
+    @classmethod
+    def from_files(cls, first_filename, second_filename, slab_size=16, workers=None,
+                   max_changes=None):
+        """
+        Compare two volume files, see open_volume and the constructor.
+
+        :return: changes between the volumes
+        :rtype: VolumeDiff
+        """
+        return cls(open_volume(first_filename), open_volume(second_filename), slab_size, workers,
+                   max_changes)
+
+    @property
+    def n_changed(self):
+        """
+        Number of changed voxels.
+        """
+        return int(np.sum(self.pair_counts))
+
+    def voxels(self):
+        """
+        Indices of the listed changed voxels.
+
+        :return: Array of shape (N, 3)
+        :rtype: ndarray
+        """
+        return np.array(np.unravel_index(self.indices, self.shape)).T
+
+    def __pair_names(self, hierarchy):
+        """
+        Names of the old and new regions of each pair, the id 0 being outside of the brain.
+        """
+        names = {0: "outside"}
+        ids = np.unique(self.pairs)
+        known = hierarchy.contains(ids) if len(ids) > 0 else np.zeros(0, dtype=bool)
+        for id_reg in ids[known]:
+            names[int(id_reg)] = hierarchy.names[hierarchy.index(id_reg)]
+        return [(names.get(int(old), str(old)), names.get(int(new), str(new)))
+                for old, new in self.pairs]
+
+    def report(self, hierarchy=None, top=20):
+        """
+        Describe the number of changed voxels, the most frequent changes and the slices of each
+        axis containing changes.
+
+        :param BrainHierarchy hierarchy: hierarchy used to name the regions.
+        :param int top: number of region pairs listed.
+        :return: report
+        :rtype: str
+        """
+        lines = ["{} voxels changed out of {}{}".format(
+            self.n_changed, int(np.prod(self.shape)),
+            " ({} listed)".format(len(self.indices)) if self.truncated else "")]
+        names = self.__pair_names(hierarchy) if hierarchy is not None else \
+            [(str(old), str(new)) for old, new in self.pairs]
+        for (old, new), count in list(zip(names, self.pair_counts))[:top]:
+            lines.append("{:>12d}  {} -> {}".format(count, old, new))
+        if len(self.pairs) > top:
+            lines.append("{:>12d}  in {} other region pairs".format(
+                int(np.sum(self.pair_counts[top:])), len(self.pairs) - top))
+        for axis, counts in enumerate(self.slice_counts):
+            positions = np.where(counts > 0)[0]
+            if len(positions) > 0:
+                lines.append("Axis {}: changes in {} slices, from {} to {}".format(
+                    axis, len(positions), positions[0], positions[-1]))
+        return "\n".join(lines)
+
+    def save(self, filename):
+        """
+        Save the counts and the list of changed voxels in a npz file.
+
+        :param str filename: path to the npz file.
+        """
+        np.savez_compressed(filename, shape=self.shape, pairs=self.pairs,
+                            pair_counts=self.pair_counts,
+                            slice_counts_0=self.slice_counts[0],
+                            slice_counts_1=self.slice_counts[1],
+                            slice_counts_2=self.slice_counts[2], indices=self.indices,
+                            old_values=self.old_values, new_values=self.new_values,
+                            truncated=self.truncated)
+
+    def to_csv(self, filename, hierarchy=None):
+        """
+        Export the number of changed voxels of each region pair as a csv file.
+
+        :param str filename: path to the csv file.
+        :param BrainHierarchy hierarchy: hierarchy used to name the regions.
+        """
+        names = self.__pair_names(hierarchy) if hierarchy is not None else \
+            [("", "")] * len(self.pairs)
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["old_id", "new_id", "old_name", "new_name", "voxels"])
+            for (old, new), (old_name, new_name), count in zip(self.pairs, names,
+                                                                self.pair_counts):
+                writer.writerow([old, new, old_name, new_name, count])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two versions of an annotation volume")
+    parser.add_argument("first", help="old volume (npy, nrrd or chunked)")
+    parser.add_argument("second", help="new volume (npy, nrrd or chunked)")
+    parser.add_argument("--hierarchy", default=None,
+                        help="JSON file of the hierarchy of the brain regions, to name them")
+    parser.add_argument("--output", default=None,
+                        help="npz file of the counts and of the list of changed voxels")
+    parser.add_argument("--csv", default=None, help="csv file of the counts per region pair")
+    parser.add_argument("--slab-size", type=int, default=16,
+                        help="number of planes compared at once by each thread")
+    parser.add_argument("--workers", type=int, default=None, help="number of threads")
+    parser.add_argument("--max-changes", type=int, default=None,
+                        help="maximum number of changed voxels listed")
+    args = parser.parse_args()
+    start = perf_counter()
+    diff = VolumeDiff.from_files(args.first, args.second, args.slab_size, args.workers,
+                                 args.max_changes)
+    hierarchy = BrainHierarchy.from_json(args.hierarchy) if args.hierarchy else None
+    print(diff.report(hierarchy))
+    print("Volumes compared in {:.2f}s".format(perf_counter() - start))
+    if args.output:
+        diff.save(args.output)
+    if args.csv:
+        diff.to_csv(args.csv, hierarchy)
+
+
+if __name__ == "__main__":
+    main()
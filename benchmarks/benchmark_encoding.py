@@ -0,0 +1,72 @@
+"""
+Measure the scaling of the preparation of the annotation model (group encodings and bounding box
+of the region, see AnnotationImage.__prepare) with the number of worker processes, on synthetic
+atlases.
+Run from the repository root:
+python benchmarks/benchmark_encoding.py [--resolution 10] [--cerebellum-only] [--processes 1 2 4]
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from annotate_cerebellum.annotation_image import AnnotationImage  # noqa: E402
+from annotate_cerebellum.hierarchy import BrainHierarchy, cerebellar_layer_ids  # noqa: E402
+from synthetic import synthetic_hierarchy, synthetic_volumes  # noqa: E402
+
+# Lobule whose annotations are prepared
+LOBULE = "Declive (VI)"
+
+
+def measure(annotation, nissl, backup, dict_reg_ids, processes, repeat=3):
+    """
+    Time the construction of the annotation model.
+
+    :return: minimum time in seconds
+    :rtype: float
+    """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        AnnotationImage(annotation, dict_reg_ids, nissl, 0, backup, processes=processes)
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling of the preparation of the annotation "
+                                                 "model with the number of processes")
+    parser.add_argument("--resolution", type=int, default=10, choices=[10, 25],
+                        help="voxel size in um")
+    parser.add_argument("--cerebellum-only", action="store_true",
+                        help="only generate the block surrounding the cerebellum")
+    parser.add_argument("--processes", type=int, nargs="+", default=None,
+                        help="numbers of processes to measure (default: powers of 2 up to the "
+                             "number of cores)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs")
+    args = parser.parse_args()
+    processes = args.processes
+    if processes is None:
+        processes = [2 ** i for i in range(int(np.log2(os.cpu_count())) + 1)]
+        if processes[-1] != os.cpu_count():
+            processes.append(os.cpu_count())
+    hierarchy_dict = synthetic_hierarchy()
+    annotation, nissl = synthetic_volumes(hierarchy_dict, args.resolution, args.cerebellum_only)
+    backup = np.copy(annotation)
+    dict_reg_ids = cerebellar_layer_ids(BrainHierarchy.from_dict(hierarchy_dict))[LOBULE]
+    print("{} um volumes {}, {} cores".format(args.resolution, annotation.shape, os.cpu_count()))
+    print("{:>10s} {:>10s} {:>8s}".format("processes", "time (s)", "speedup"))
+    reference = None
+    for n_processes in processes:
+        duration = measure(annotation, nissl, backup, dict_reg_ids, n_processes, args.repeat)
+        reference = reference or duration
+        print("{:>10d} {:>10.2f} {:>8.2f}".format(n_processes, duration, reference / duration))
+
+
+if __name__ == "__main__":
+    main()
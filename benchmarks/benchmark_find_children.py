@@ -0,0 +1,78 @@
+"""
+Compare the post-order implementation of JSONread.find_children with the previous implementation
+walking from every leaf to the root.
+Run from the repository root: python benchmarks/benchmark_find_children.py
+"""
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import JSONread  # noqa: E402
+from synthetic import synthetic_hierarchy  # noqa: E402
+
+
+def find_children_reference(uniques, id_to_region_dictionary_ALLNAME, is_leaf,
+                            region_dictionary_to_id_ALLNAME_parent,
+                            region_dictionary_to_id_ALLNAME):
+    """
+    Previous implementation of JSONread.find_children.
+    """
+    children = {}
+    order_ = np.zeros(uniques.shape)
+    for id_reg, allname in id_to_region_dictionary_ALLNAME.items():
+        if is_leaf[allname]:
+            inc = 0
+            ids_reg = [id_reg]
+            parentname = region_dictionary_to_id_ALLNAME_parent[allname]
+            while parentname != '':
+                if parentname not in children:
+                    children[parentname] = []
+                children[parentname] += ids_reg
+                inc += 1
+                id_parent = region_dictionary_to_id_ALLNAME[parentname]
+                if id_parent in uniques:
+                    ids_reg.append(id_parent)
+                    place_ = np.where(uniques == id_parent)
+                    order_[place_] = max(order_[place_], inc)
+                allname = parentname
+                parentname = region_dictionary_to_id_ALLNAME_parent[allname]
+
+    for parent, child in children.items():
+        children[parent] = np.unique(child)
+    return children, order_
+
+
+def timeit(function, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function(*args)
+        times.append(perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    JSONread.search_children(synthetic_hierarchy(1300))
+    ids = np.array(list(JSONread.id_to_region_dictionary_ALLNAME.keys()))
+    uniques = np.random.RandomState(0).choice(ids, len(ids) // 2, replace=False)
+    args = (uniques, JSONread.id_to_region_dictionary_ALLNAME, JSONread.is_leaf,
+            JSONread.region_dictionary_to_id_ALLNAME_parent,
+            JSONread.region_dictionary_to_id_ALLNAME)
+    (children_ref, order_ref), time_ref = timeit(find_children_reference, *args)
+    (children, order_), time_new = timeit(JSONread.find_children, *args)
+
+    same = children.keys() == children_ref.keys() and np.array_equal(order_, order_ref) and \
+        all(np.array_equal(children[key], children_ref[key]) for key in children_ref)
+    print("Regions: {}, uniques: {}".format(len(ids), len(uniques)))
+    print("Reference implementation: {:.4f}s".format(time_ref))
+    print("Post-order implementation: {:.4f}s".format(time_new))
+    print("Speed-up: {:.1f}x, identical results: {}".format(time_ref / time_new, same))
+
+
+if __name__ == "__main__":
+    main()
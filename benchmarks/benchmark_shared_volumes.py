@@ -0,0 +1,88 @@
+"""
+Measure the memory used by several editor processes holding the Nissl and original annotation
+volumes, either each with its own copies or attached to the volumes published in shared memory.
+The memory of each editor is its proportional set size (Linux only), so that the shared pages are
+counted once over all the editors.
+Run from the repository root: python benchmarks/benchmark_shared_volumes.py [n_editors]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from os.path import join
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annotate_cerebellum.shared_volumes import SharedVolumes, process_memory  # noqa: E402
+
+# Shape of the 25 um Allen Brain atlas volumes
+SHAPE = (528, 320, 456)
+
+
+def editor(manifest):
+    """
+    Hold the volumes as an editor would (shared if a manifest is given, private copies otherwise),
+    print the memory used and wait for a line on the standard input before exiting.
+    """
+    if manifest is None:
+        volumes = {"nissl": np.ones(SHAPE, dtype=np.float32),
+                   "backup": np.ones(SHAPE, dtype=np.uint32)}
+    else:
+        volumes = SharedVolumes.attach(manifest)
+    # Touch all the pages, e.g. when preparing the annotations of a region
+    for name in ["nissl", "backup"]:
+        np.sum(volumes[name])
+    print(process_memory()["pss"], flush=True)
+    sys.stdin.readline()
+    if manifest is not None:
+        volumes.close()
+
+
+def run(n_editors, manifest=None):
+    """
+    Run editors in parallel, as independent processes, and measure the memory they use together
+    with the current process, which holds the published volumes if any.
+
+    :param int n_editors: number of editors.
+    :param str manifest: path to the manifest of the shared volumes.
+    :return: total proportional set size of the processes in bytes
+    :rtype: int
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--editor"]
+    if manifest is not None:
+        command.append(manifest)
+    processes = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  universal_newlines=True) for _ in range(n_editors)]
+    memory = sum(int(process.stdout.readline()) for process in processes)
+    memory += process_memory()["pss"]
+    for process in processes:
+        process.communicate("\n")
+    return memory
+
+
+def main():
+    if process_memory()["pss"] is None:
+        raise Exception("The proportional set size is only available on Linux.")
+    n_editors = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    private = run(n_editors)
+    manifest = join(tempfile.mkdtemp(), "shared_volumes.json")
+    shared = SharedVolumes.publish({"nissl": np.ones(SHAPE, dtype=np.float32),
+                                    "backup": np.ones(SHAPE, dtype=np.uint32)}, manifest)
+    size = shared.nbytes
+    try:
+        attached = run(n_editors, manifest)
+    finally:
+        shared.close(manifest)
+    print("Editors: {}, volumes: {:.1f} MB".format(n_editors, size / 2 ** 20))
+    print("Private copies: {:.1f} MB".format(private / 2 ** 20))
+    print("Shared memory: {:.1f} MB".format(attached / 2 ** 20))
+    print("Saved: {:.1f} MB".format((private - attached) / 2 ** 20))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--editor":
+        editor(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        main()
@@ -0,0 +1,76 @@
+"""
+Check that the run-length encoded storage of the working annotations (storage="rle") gives the
+same results as the dense storage: the same edits are applied to two annotation models of a
+synthetic atlas, then their working annotations, statistics tables and consistency checks are
+compared. The statistics refreshed after the consistency checks are also compared with a full
+recount.
+Run from the repository root: python benchmarks/check_storage.py [--resolution 25]
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from annotate_cerebellum.annotation_image import AnnotationImage  # noqa: E402
+from annotate_cerebellum.hierarchy import BrainHierarchy, cerebellar_layer_ids  # noqa: E402
+from annotate_cerebellum.statistics import RegionStatistics  # noqa: E402
+from annotate_cerebellum.validation import ConsistencyChecker  # noqa: E402
+from synthetic import synthetic_hierarchy, synthetic_volumes  # noqa: E402
+
+# Lobule whose annotations are edited
+LOBULE = "Declive (VI)"
+
+
+def edit(model, n_voxels=2000, seed=0):
+    """
+    Paint random voxels of the bounding box of the region as granular layer and a few voxels as
+    molecular layer, giving isolated granular layer voxels.
+    """
+    rng = np.random.RandomState(seed)
+    voxels = rng.randint(model.ids[:, 0], model.ids[:, 1] + 1, (n_voxels, 3))
+    model.update_voxels(voxels[:n_voxels // 2], "gl")
+    model.update_voxels(voxels[n_voxels // 2:], "mol")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the dense and run-length encoded "
+                                                 "storages of the working annotations")
+    parser.add_argument("--resolution", type=int, default=25, choices=[10, 25],
+                        help="voxel size in um")
+    args = parser.parse_args()
+    hierarchy_dict = synthetic_hierarchy()
+    annotation, nissl = synthetic_volumes(hierarchy_dict, args.resolution, True)
+    layer_ids = cerebellar_layer_ids(BrainHierarchy.from_dict(hierarchy_dict))
+    dict_reg_ids = layer_ids[LOBULE]
+    regions = {name: np.concatenate((ids["mol"], ids["gl"])) for name, ids in layer_ids.items()}
+    results = {}
+    for storage in ["dense", "rle"]:
+        model = AnnotationImage(np.copy(annotation), dict_reg_ids, nissl, 1, np.copy(annotation),
+                                storage=storage)
+        statistics = RegionStatistics.from_annotation_image(model, regions)
+        checker = ConsistencyChecker.from_annotation_image(model)
+        edit(model)
+        checker.refresh(model)
+        statistics.refresh(model)
+        # The refreshes must see the same edits as a full recount
+        if not np.array_equal(statistics.counts,
+                              RegionStatistics.from_annotation_image(model, regions).counts):
+            raise Exception("The refreshed statistics of the {} storage are outdated.".format(
+                storage))
+        results[storage] = (np.asarray(model.annCPY), statistics.counts, checker.counts)
+        print("{}: {}".format(storage, checker.totals()))
+    names = ["working annotations", "statistics", "consistency checks"]
+    failed = [name for name, dense, rle in zip(names, results["dense"], results["rle"])
+              if not np.array_equal(dense, rle)]
+    if failed:
+        raise Exception("The rle storage differs from the dense storage: {}.".format(
+            ", ".join(failed)))
+    print("The dense and rle storages give the same results.")
+
+
+if __name__ == "__main__":
+    main()
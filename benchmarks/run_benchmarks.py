@@ -0,0 +1,360 @@
+"""
+Benchmark suite of the editing pipeline on synthetic atlases: construction of the annotation model,
+image generation and edit operations, saving of the changes, hierarchy queries and volume I/O.
+Each benchmark records its wall time (best and median over several runs) and the peak memory
+allocated during one run (measured with tracemalloc, in a separate run so that tracing does not
+slow down the timed runs). Results are written as JSON and can be compared with a previous run.
+
+Run from the repository root::
+
+    python benchmarks/run_benchmarks.py --resolutions 25 --output results_25.json
+    python benchmarks/run_benchmarks.py --resolutions 10 --cerebellum-only --output results_10.json
+    python benchmarks/run_benchmarks.py --compare results_old.json results_new.json
+
+The whole brain volumes at 10 um need about 25 GB of memory: use --cerebellum-only to generate only
+the block surrounding the cerebellum.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from os.path import join
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import JSONread  # noqa: E402
+from annotate_cerebellum.annotation_image import AnnotationImage, DICT_REG_NUMBERS  # noqa: E402
+from annotate_cerebellum.chunked_volume import ChunkedVolume  # noqa: E402
+from annotate_cerebellum.hierarchy import BrainHierarchy, RegionNameIndex, \
+    cerebellar_layer_ids  # noqa: E402
+from annotate_cerebellum.pyramid import build_pyramid  # noqa: E402
+from annotate_cerebellum.utils import compute_label_histogram, draw_2d_line, find_group, \
+    load_nrrd_npy_file, load_nrrd_npy_files, save_nrrd_npy_file  # noqa: E402
+from annotate_cerebellum.volume_diff import VolumeDiff  # noqa: E402
+from synthetic import synthetic_hierarchy, synthetic_volumes  # noqa: E402
+
+# Lobule corrected in the benchmarks of the annotation model
+LOBULE = "Declive (VI)"
+
+
+class Benchmark:
+    """
+    Benchmark of one operation.
+    """
+
+    def __init__(self, name, run, setup=None, repeat=None):
+        """
+        :param str name: name of the benchmark.
+        :param run: function to measure.
+        :param setup: function called before each run, not measured.
+        :param int repeat: number of timed runs, overrides the value of the suite.
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.repeat = repeat
+
+    def measure(self, repeat):
+        """
+        Time the benchmark and measure the peak memory allocated by one run.
+
+        :param int repeat: number of timed runs.
+        :return: measures of the benchmark
+        :rtype: dict
+        """
+        times = []
+        for _ in range(self.repeat or repeat):
+            if self.setup is not None:
+                self.setup()
+            start = perf_counter()
+            self.run()
+            times.append(perf_counter() - start)
+        if self.setup is not None:
+            self.setup()
+        tracemalloc.start()
+        try:
+            self.run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {"name": self.name, "min": min(times), "median": float(np.median(times)),
+                "repeat": len(times), "peak_memory": peak}
+
+
+def _stroke(image, n_points=8, seed=0):
+    """
+    Pixels of a random polyline crossing an image, as drawn with the pen tool.
+    """
+    rng = np.random.RandomState(seed)
+    points = rng.randint(0, min(image.shape[:2]), (n_points, 2))
+    return np.unique(np.concatenate([draw_2d_line(x0, y0, x1, y1)
+                                     for (x0, y0), (x1, y1) in zip(points[:-1], points[1:])]),
+                     axis=0)
+
+
+def _first_pixel(image, code):
+    """
+    First pixel of an image of working annotations with a group code.
+    """
+    pixels = np.argwhere(image == code)
+    return pixels[len(pixels) // 2]
+
+
+def model_benchmarks(annotation, nissl, backup, dict_reg_ids):
+    """
+    Benchmarks of the annotation model: construction, image generation and edit operations.
+    """
+    benchmarks = []
+    for axis in range(3):
+        benchmarks.append(Benchmark(
+            "AnnotationImage axis {}".format(axis),
+            lambda axis=axis: AnnotationImage(annotation, dict_reg_ids, nissl, axis, backup)))
+    benchmarks.append(Benchmark(
+        "AnnotationImage axis 0 (rle)",
+        lambda: AnnotationImage(annotation, dict_reg_ids, nissl, 0, backup, storage="rle")))
+    benchmarks.append(Benchmark(
+        "AnnotationImage.multi_planar",
+        lambda: AnnotationImage.multi_planar(annotation, dict_reg_ids, nissl, backup=backup)))
+
+    image = AnnotationImage(np.copy(annotation), dict_reg_ids, nissl, 0, backup)
+    stroke = _stroke(image.picRGB)
+    slice_image = image.get_plane(image.annCPY)
+    keys = ["gl", "mol"]
+
+    def paint():
+        keys.reverse()
+        image.update_slice(stroke, keys[0])
+
+    benchmarks.extend([
+        Benchmark("generate_image", image.generate_image),
+        Benchmark("draw_2d_line", lambda: draw_2d_line(0, 0, *image.picRGB.shape[:2])),
+        Benchmark("find_group", lambda: find_group(
+            slice_image, _first_pixel(slice_image, DICT_REG_NUMBERS["gl"]),
+            DICT_REG_NUMBERS["gl"])),
+        Benchmark("update_slice", paint),
+        Benchmark("revert_voxels", lambda: image.revert_voxels(stroke),
+                  setup=lambda: image.update_slice(stroke, "fib")),
+        Benchmark("revert_slice", image.revert_slice,
+                  setup=lambda: image.update_slice(stroke, "fib")),
+        Benchmark("fill", lambda: image.fill(
+            _first_pixel(image.get_plane(image.annCPY), DICT_REG_NUMBERS["gl"]), "mol"),
+            setup=image.revert_slice),
+        Benchmark("wand", lambda: image.wand(
+            _first_pixel(image.get_plane(image.annCPY), DICT_REG_NUMBERS["gl"]), "mol", 20),
+            setup=image.revert_slice),
+        Benchmark("wand_3d", lambda: image.wand_3d(
+            image.get_position(_first_pixel(image.get_plane(image.annCPY),
+                                            DICT_REG_NUMBERS["gl"])), "mol", 20, ["gl"]),
+            setup=image.revert_slice),
+        Benchmark("clean_group (remove_islands)", lambda: image.clean_group(
+            "remove_islands", "gl", 20), setup=image.revert_slice),
+        Benchmark("clean_group (open, 3D)", lambda: image.clean_group(
+            "open", "mol", 1, planar=False), setup=image.revert_slice),
+        Benchmark("fill_3d", lambda: image.fill_3d(
+            image.get_position(_first_pixel(image.get_plane(image.annCPY),
+                                            DICT_REG_NUMBERS["mol"])), "gl"),
+            setup=image.revert_slice),
+    ])
+
+    def edit_slices():
+        keys.reverse()
+        center = image.slice_pos
+        for pos in range(center - 5, center + 5):
+            image.change_slice(pos)
+            image.update_slice(stroke, keys[0])
+        image.change_slice(center)
+
+    benchmarks.append(Benchmark("apply_changes (10 slices)", image.apply_changes,
+                                setup=edit_slices))
+
+    rle_image = AnnotationImage(np.copy(annotation), dict_reg_ids, nissl, 2, backup,
+                                storage="rle")
+    rle_stroke = _stroke(rle_image.picRGB)
+    benchmarks.extend([
+        Benchmark("generate_image axis 2 (rle)", rle_image.generate_image),
+        Benchmark("update_slice axis 2 (rle)", lambda: rle_image.update_slice(rle_stroke, "fib"),
+                  setup=rle_image.revert_slice),
+        Benchmark("revert_slice axis 2 (rle)", rle_image.revert_slice,
+                  setup=lambda: rle_image.update_slice(rle_stroke, "fib")),
+    ])
+    return benchmarks
+
+
+def hierarchy_benchmarks(hierarchy_dict, folder, annotation):
+    """
+    Benchmarks of the hierarchy parsing and queries.
+    """
+    filename = join(folder, "hierarchy.json")
+    with open(filename, "w") as f:
+        json.dump({"msg": [hierarchy_dict]}, f)
+    hierarchy = BrainHierarchy.from_json(filename)  # create the binary cache
+    name_index = RegionNameIndex(hierarchy.ids.tolist(), hierarchy.full_names, hierarchy.is_leaf)
+    histogram = compute_label_histogram(annotation)
+    JSONread.load_hierarchy(filename)
+    u_regions = JSONread.find_unique_regions(
+        annotation, JSONread.id_to_region_dictionary_ALLNAME,
+        JSONread.region_dictionary_to_id_ALLNAME, JSONread.region_dictionary_to_id_ALLNAME_parent,
+        JSONread.name2allname, histogram=histogram)
+    return [
+        Benchmark("BrainHierarchy.from_dict", lambda: BrainHierarchy.from_dict(hierarchy_dict)),
+        Benchmark("BrainHierarchy.from_json (cached)", lambda: BrainHierarchy.from_json(filename)),
+        Benchmark("BrainHierarchy.descendants (all regions)",
+                  lambda: [hierarchy.descendants(id_reg) for id_reg in hierarchy.ids]),
+        Benchmark("RegionNameIndex", lambda: RegionNameIndex(
+            hierarchy.ids.tolist(), hierarchy.full_names, hierarchy.is_leaf)),
+        Benchmark("RegionNameIndex.query",
+                  lambda: name_index.query(["Cerebellar cortex", "molecular"], True)),
+        Benchmark("cerebellar_layer_ids", lambda: cerebellar_layer_ids(hierarchy)),
+        Benchmark("JSONread.find_unique_regions (histogram)", lambda: JSONread.find_unique_regions(
+            annotation, JSONread.id_to_region_dictionary_ALLNAME,
+            JSONread.region_dictionary_to_id_ALLNAME,
+            JSONread.region_dictionary_to_id_ALLNAME_parent, JSONread.name2allname,
+            histogram=histogram)),
+        Benchmark("JSONread.find_children", lambda: JSONread.find_children(
+            u_regions, JSONread.id_to_region_dictionary_ALLNAME, JSONread.is_leaf,
+            JSONread.region_dictionary_to_id_ALLNAME_parent,
+            JSONread.region_dictionary_to_id_ALLNAME)),
+        Benchmark("compute_label_histogram", lambda: compute_label_histogram(annotation)),
+    ]
+
+
+def io_benchmarks(annotation, nissl, folder):
+    """
+    Benchmarks of the volume I/O helpers.
+    """
+    filenames = {name: join(folder, name) for name in
+                 ["annotation.npy", "nissl.npy", "annotation.nrrd", "annotation.chunks",
+                  "corrected.npy"]}
+    center = [s // 2 for s in annotation.shape]
+    roi = tuple(slice(max(0, c - 64), c + 64) for c in center)
+    save_nrrd_npy_file(filenames["annotation.npy"], annotation)
+    save_nrrd_npy_file(filenames["nissl.npy"], nissl)
+    chunked = ChunkedVolume.from_array(filenames["annotation.chunks"], annotation)
+    # Second version of the annotations, with a block relabelled to outside
+    corrected = np.copy(annotation)
+    corrected[tuple(slice(c - 16, c + 16) for c in center)] = 0
+    save_nrrd_npy_file(filenames["corrected.npy"], corrected)
+    del corrected
+    return [
+        Benchmark("save npy", lambda: save_nrrd_npy_file(filenames["annotation.npy"], annotation)),
+        Benchmark("load npy", lambda: load_nrrd_npy_file(filenames["annotation.npy"])),
+        Benchmark("load npy roi", lambda: load_nrrd_npy_file(filenames["annotation.npy"], roi)),
+        Benchmark("save nrrd", lambda: save_nrrd_npy_file(filenames["annotation.nrrd"],
+                                                          annotation)),
+        Benchmark("load nrrd", lambda: load_nrrd_npy_file(filenames["annotation.nrrd"])),
+        Benchmark("load_nrrd_npy_files (2 files)", lambda: load_nrrd_npy_files(
+            [filenames["annotation.npy"], filenames["nissl.npy"]], check_shapes=True)),
+        Benchmark("ChunkedVolume.from_array", lambda: ChunkedVolume.from_array(
+            filenames["annotation.chunks"], annotation), repeat=1),
+        Benchmark("ChunkedVolume.read roi", lambda: chunked.read(roi)),
+        Benchmark("VolumeDiff npy (1 thread)", lambda: VolumeDiff.from_files(
+            filenames["annotation.npy"], filenames["corrected.npy"], workers=1)),
+        Benchmark("VolumeDiff npy", lambda: VolumeDiff.from_files(
+            filenames["annotation.npy"], filenames["corrected.npy"])),
+        Benchmark("build_pyramid (mode)", lambda: build_pyramid(annotation, 1),
+                  repeat=1),
+    ]
+
+
+def run_suite(resolution, cerebellum_only=False, repeat=3, groups=("model", "hierarchy", "io")):
+    """
+    Run the benchmarks on synthetic volumes at one resolution.
+
+    :param int resolution: voxel size in um.
+    :param bool cerebellum_only: if True, only the block surrounding the cerebellum is generated.
+    :param int repeat: number of timed runs of each benchmark.
+    :param list groups: groups of benchmarks to run.
+    :return: list of the measures of each benchmark
+    :rtype: list
+    """
+    start = perf_counter()
+    hierarchy_dict = synthetic_hierarchy()
+    annotation, nissl = synthetic_volumes(hierarchy_dict, resolution, cerebellum_only)
+    print("{} um volumes {} generated in {:.1f}s".format(resolution, annotation.shape,
+                                                         perf_counter() - start))
+    dict_reg_ids = cerebellar_layer_ids(BrainHierarchy.from_dict(hierarchy_dict))[LOBULE]
+    backup = np.copy(annotation)
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        benchmarks = []
+        if "model" in groups:
+            benchmarks.extend(model_benchmarks(annotation, nissl, backup, dict_reg_ids))
+        if "hierarchy" in groups:
+            benchmarks.extend(hierarchy_benchmarks(hierarchy_dict, folder, annotation))
+        if "io" in groups:
+            benchmarks.extend(io_benchmarks(annotation, nissl, folder))
+        for benchmark in benchmarks:
+            result = benchmark.measure(repeat)
+            result.update(resolution=resolution, shape=list(annotation.shape))
+            print("{:45s} {:10.4f}s {:10.1f} MB".format(result["name"], result["min"],
+                                                       result["peak_memory"] / 2 ** 20))
+            results.append(result)
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def compare(old_filename, new_filename):
+    """
+    Print the ratio of the times and peak memory of two result files, for the benchmarks run on
+    volumes of the same shape.
+    """
+    with open(old_filename, "r") as f:
+        old = {(tuple(r["shape"]), r["name"]): r for r in json.load(f)["results"]}
+    with open(new_filename, "r") as f:
+        new = json.load(f)["results"]
+    print("{:5s} {:45s} {:>10s} {:>10s} {:>8s} {:>8s}".format(
+        "res", "benchmark", "old (s)", "new (s)", "time", "memory"))
+    for result in new:
+        key = (tuple(result["shape"]), result["name"])
+        if key in old:
+            print("{:5d} {:45s} {:10.4f} {:10.4f} {:7.2f}x {:7.2f}x".format(
+                result["resolution"], result["name"], old[key]["min"], result["min"],
+                result["min"] / max(old[key]["min"], 1e-9),
+                result["peak_memory"] / max(old[key]["peak_memory"], 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the editing pipeline on synthetic "
+                                                 "atlases")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[25],
+                        help="voxel sizes in um of the synthetic volumes")
+    parser.add_argument("--cerebellum-only", action="store_true",
+                        help="generate only the block surrounding the cerebellum")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs")
+    parser.add_argument("--groups", nargs="+", default=["model", "hierarchy", "io"],
+                        choices=["model", "hierarchy", "io"], help="benchmarks to run")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON result file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running the benchmarks")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = []
+    for resolution in args.resolutions:
+        results.extend(run_suite(resolution, args.cerebellum_only, args.repeat, args.groups))
+    with open(args.output, "w") as f:
+        json.dump({
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cerebellum_only": args.cerebellum_only,
+            "results": results,
+        }, f, indent=1)
+    print("Results written in {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Synthetic brain region hierarchies and volumes used by the benchmarks.
+"""
+import numpy as np
+
+CEREBELLAR_LOBULES = ["Lingula (I)", "Lobule II", "Lobule III", "Lobules IV-V", "Declive (VI)",
+                      "Folium-tuber vermis (VII)", "Pyramus (VIII)", "Uvula (IX)",
+                      "Nodulus (X)", "Simple lobule", "Crus 1", "Crus 2", "Paramedian lobule",
+                      "Copula pyramidis", "Paraflocculus", "Flocculus"]
+CEREBELLAR_LAYERS = ["molecular layer", "Purkinje layer", "granular layer"]
+
+
+def synthetic_hierarchy(n_regions=1300, max_children=6, seed=0):
+    """
+    Generate a hierarchy dictionary with the same structure as the AIBS json file.
+    It contains a cerebellar cortex with lobules split into layers, cerebellar fiber tracts and
+    random regions to reach the requested number of regions.
+
+    :param int n_regions: approximate number of regions in the hierarchy.
+    :param int max_children: maximum number of sub-regions of the random regions.
+    :param int seed: seed of the random generator.
+    :return: dictionary of the root region
+    :rtype: dict
+    """
+    rng = np.random.RandomState(seed)
+    counter = [1000]
+
+    def node(name, children=None):
+        counter[0] += 1
+        region = {"id": counter[0], "name": name, "acronym": name[:6],
+                  "color_hex_triplet": "{:02x}{:02x}{:02x}".format(*rng.randint(0, 256, 3)),
+                  "children": children or []}
+        return region
+
+    cortex = node("Cerebellar cortex", [node("Cerebellar cortex, " + layer)
+                                        for layer in CEREBELLAR_LAYERS])
+    for lobule in CEREBELLAR_LOBULES:
+        cortex["children"].append(node(lobule, [node(lobule + ", " + layer)
+                                                for layer in CEREBELLAR_LAYERS]))
+    cerebellum = node("Cerebellum", [cortex])
+    fiber_tracts = node("fiber tracts", [node("cerebellum related fiber tracts",
+                                              [node("arbor vitae"),
+                                               node("cerebellar peduncles")])])
+    basic_groups = node("Basic cell groups and regions", [cerebellum])
+    parents = [basic_groups]
+    i = 0
+    while counter[0] - 1000 < n_regions:
+        parent = parents[rng.randint(len(parents))]
+        if len(parent["children"]) >= max_children and parent is not basic_groups:
+            continue
+        region = node("Region {}".format(i))
+        i += 1
+        parent["children"].append(region)
+        parents.append(region)
+    root = node("root", [basic_groups, fiber_tracts])
+    root["id"] = 997
+    return root
+
+
+# Extent of the Allen Brain atlas volumes in um (anterior-posterior, dorsal-ventral, left-right)
+ATLAS_EXTENT = (13200, 8000, 11400)
+# Synthetic brain and cerebellum ellipsoids in um: center and radii
+BRAIN_ELLIPSOID = ((6600, 4000, 5700), (6200, 3600, 5200))
+CEREBELLUM_ELLIPSOID = ((10800, 2600, 5700), (1800, 1500, 3200))
+# Normalized distance to the cerebellum center of the inner boundary of each layer, from the
+# surface: molecular, Purkinje and granular layers. Deeper voxels are fiber tracts.
+LAYER_BOUNDARIES = (0.86, 0.83, 0.6)
+# Nissl expression of the other brain regions, molecular, Purkinje and granular layers and fibers
+NISSL_LEVELS = (0.4, 0.2, 0.7, 0.9, 0.1)
+
+
+def _find(region, name):
+    to_explore = [region]
+    while len(to_explore) > 0:
+        region = to_explore.pop()
+        if region["name"] == name:
+            return region
+        to_explore.extend(region.get("children", []))
+    raise Exception("Region not found: {}.".format(name))
+
+
+def synthetic_volumes(hierarchy, resolution=25, cerebellum_only=False, slab_size=16, seed=0):
+    """
+    Generate annotation and Nissl volumes with a layered cerebellum-like structure, using the
+    regions of a synthetic hierarchy. The cerebellum is an ellipsoid split into the lobules of
+    CEREBELLAR_LOBULES (vermis lobules in the middle, hemisphere lobules on the sides), each made of
+    folded molecular, Purkinje and granular layers around the arbor vitae. The rest of the brain is
+    an ellipsoid of blocks of random regions.
+
+    :param dict hierarchy: dictionary of the root region, see synthetic_hierarchy.
+    :param int resolution: voxel size in um (25 or 10 for the Allen Brain atlases).
+    :param bool cerebellum_only: if True, only the block surrounding the cerebellum is generated.
+    :param int slab_size: number of planes generated at once.
+    :param int seed: seed of the random generator.
+    :return: annotation (uint32) and Nissl (float32) volumes
+    :rtype: tuple
+    """
+    rng = np.random.RandomState(seed)
+    lobules = [_find(hierarchy, lobule) for lobule in CEREBELLAR_LOBULES]
+    layer_ids = np.array([[_find(lobule, lobule["name"] + ", " + layer)["id"]
+                           for layer in CEREBELLAR_LAYERS] for lobule in lobules], dtype=np.uint32)
+    fiber_id = _find(hierarchy, "arbor vitae")["id"]
+    other_ids = []
+    to_explore = [_find(hierarchy, "Basic cell groups and regions")]
+    while len(to_explore) > 0:
+        region = to_explore.pop()
+        if region["name"].startswith("Region"):
+            other_ids.append(region["id"])
+        to_explore.extend(region.get("children", []))
+    other_ids = np.array(other_ids, dtype=np.uint32)
+    n_vermis = 9  # lobules from Lingula (I) to Nodulus (X)
+
+    if cerebellum_only:
+        center, radii = CEREBELLUM_ELLIPSOID
+        start = [max(0, c - r - 400) for c, r in zip(center, radii)]
+        stop = [min(e, c + r + 400) for c, r, e in zip(center, radii, ATLAS_EXTENT)]
+    else:
+        start, stop = [0, 0, 0], list(ATLAS_EXTENT)
+    shape = tuple(int((b - a) // resolution) for a, b in zip(start, stop))
+    annotation = np.zeros(shape, dtype=np.uint32)
+    nissl = np.zeros(shape, dtype=np.float32)
+    coords = [start[i] + (np.arange(shape[i]) + 0.5) * resolution for i in range(3)]
+    block = max(1, int(800 // resolution))  # size of the blocks of other regions in voxels
+    (bc, br), (cc, cr) = BRAIN_ELLIPSOID, CEREBELLUM_ELLIPSOID
+    for s0 in range(0, shape[0], slab_size):
+        x = coords[0][s0:s0 + slab_size, None, None]
+        y, z = coords[1][None, :, None], coords[2][None, None, :]
+        slab = annotation[s0:s0 + slab_size]
+        brain = ((x - bc[0]) / br[0]) ** 2 + ((y - bc[1]) / br[1]) ** 2 + \
+            ((z - bc[2]) / br[2]) ** 2 <= 1
+        i = np.arange(s0, s0 + slab.shape[0])[:, None, None] // block
+        j = np.arange(shape[1])[None, :, None] // block
+        k = np.arange(shape[2])[None, None, :] // block
+        slab[...] = np.where(brain, other_ids[(i + 3 * j + 7 * k) % len(other_ids)], 0)
+        # Cerebellum: layers depend on the folded distance to the center, lobules on the angle
+        # in the sagittal plane and on the distance to the midline
+        dx, dy, dz = (x - cc[0]) / cr[0], (y - cc[1]) / cr[1], (z - cc[2]) / cr[2]
+        radius = np.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
+        theta = np.arctan2(dy, dx)
+        folded = radius + 0.04 * np.sin(24 * theta) * (radius > 0.5)
+        inside = radius <= 1
+        vermis = np.abs(dz) < 0.35
+        sector = ((theta + np.pi) / (2 * np.pi) * n_vermis).astype(int) % n_vermis
+        hemisphere = n_vermis + ((theta + np.pi) / (2 * np.pi) *
+                                 (len(lobules) - n_vermis)).astype(int) % (len(lobules) - n_vermis)
+        lobule = np.where(vermis, sector, hemisphere)
+        layer = np.full(inside.shape, 3)
+        for index, boundary in reversed(list(enumerate(LAYER_BOUNDARIES))):
+            layer[folded >= boundary] = index
+        ids = np.where(layer < 3, layer_ids[lobule, np.minimum(layer, 2)], fiber_id)
+        slab[inside] = ids[inside]
+        levels = np.where(inside, np.asarray(NISSL_LEVELS)[layer + 1], NISSL_LEVELS[0] * brain)
+        nissl[s0:s0 + slab_size] = levels + 0.05 * rng.rand(*slab.shape) * (slab > 0)
+    return annotation, nissl
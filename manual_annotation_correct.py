@@ -1,6 +1,10 @@
-from os.path import join
-import json
+from os.path import isfile, join
+from time import perf_counter
+from annotate_cerebellum.hierarchy import cerebellar_layer_ids
+from annotate_cerebellum.memory import MemoryBudget, load_compact_volume
 from annotate_cerebellum.paint_tools import PaintAnnotations
+from annotate_cerebellum.session import SessionCache
+from annotate_cerebellum.shared_volumes import SharedVolumes, memory_report
 from annotate_cerebellum.utils import *
 from JSONread import *
 
@@ -12,23 +16,80 @@ backup_filename = join(DATA_FOLDER, "annotation_corrected_clf.npy")
 
 hierarchy_filename = join(DATA_FOLDER, "brain_regions.json")
 output_filename = join(DATA_FOLDER, "annotation_corrected_clfd.npy")
+# Folder storing the prepared states of the regions already opened
+session_folder = join(DATA_FOLDER, "sessions")
+# Manifest of the volumes published in shared memory
+shared_manifest = join(DATA_FOLDER, "shared_volumes.json")
+# Optional memory budget of the session in bytes (e.g. 8 * 2 ** 30). If the volumes and the working
+# annotations would exceed it, the Nissl volume is stored on 8 bits or the numpy volumes are memory
+# mapped, and the working annotations only cover the region of interest.
+memory_budget = None
+# Number of processes preparing the working annotations of a region
+processes = 1
+# Storage of the working annotations: "dense" or "rle" (run-length encoded, uses less memory)
+storage = "dense"
 
 # Protected regions
 protected_regions = ["Lingula (I)", "Flocculus", "Crus 1"]
 
 # Load json hierarchy file
-jsontextfile = open(hierarchy_filename, "r")
-jsoncontent = json.loads(jsontextfile.read())
-search_children(jsoncontent['msg'][0])
+load_hierarchy(hierarchy_filename)
 
-# Load Nissl and annotations
-nissl = load_nrrd_npy_file(nissl_filename)
-ann = load_nrrd_npy_file(annotation_filename)
-backup = load_nrrd_npy_file(backup_filename)
+# Annotations when the session starts. The saves replace the numpy files, so the mapping keeps
+# this version of the file.
+original = np.load(annotation_filename, mmap_mode="r") if annotation_filename.endswith(".npy") \
+    else None
 
+# Load Nissl and annotations. The read-only volumes are taken from the shared memory if another
+# process published them (see annotate_cerebellum.shared_volumes).
+shared = None
+if isfile(shared_manifest):
+    try:
+        # The volumes must have been published from the files of this editor, with its shape
+        shared = SharedVolumes.attach(shared_manifest,
+                                      {"nissl": nissl_filename, "backup": backup_filename},
+                                      read_volume_shape(annotation_filename))
+        nissl, backup = shared["nissl"], shared["backup"]
+    except Exception as error:
+        # E.g. the publisher was stopped without removing the manifest
+        print("Warning: {} The volumes are loaded from their files.".format(error))
+        if shared is not None:
+            shared.close()
+            shared = None
+if shared is not None:
+    ann = load_nrrd_npy_file(annotation_filename)
+    print("Attached to the volumes shared in {}".format(shared_manifest))
+else:
+    filenames = [nissl_filename, annotation_filename, backup_filename]
+    volume_mode = "full"
+    if memory_budget is not None:
+        volume_mode = MemoryBudget(memory_budget).volume_mode(filenames)
+        print("Memory mode of the volumes: {}".format(volume_mode))
+    if volume_mode == "compact":
+        # The Nissl volume is converted slab by slab, without loading its intensities.
+        (ann, backup), timings = load_nrrd_npy_files(filenames[1:], check_shapes=True,
+                                                     return_timings=True)
+        start = perf_counter()
+        nissl = load_compact_volume(nissl_filename)
+        timings = [perf_counter() - start] + timings
+    else:
+        # Saving replaces the annotation file, so memory mapping it is safe (see
+        # save_nrrd_npy_file).
+        (nissl, ann, backup), timings = load_nrrd_npy_files(
+            filenames, check_shapes=True, return_timings=True,
+            mmap_mode="c" if volume_mode == "lazy" else None)
+    for filename, timing in zip(filenames, timings):
+        print("Loaded {} in {:.2f}s".format(filename, timing))
+print(memory_report(shared))
+
+histogram = load_label_histogram(annotation_filename, ann)
 u_regions = find_unique_regions(ann, id_to_region_dictionary_ALLNAME,
                                 region_dictionary_to_id_ALLNAME,
-                                region_dictionary_to_id_ALLNAME_parent, name2allname)
+                                region_dictionary_to_id_ALLNAME_parent, name2allname,
+                                histogram=histogram)
+voxel_counts = region_voxel_counts(histogram, id_to_region_dictionary_ALLNAME,
+                                   region_dictionary_to_id_ALLNAME_parent,
+                                   region_dictionary_to_id_ALLNAME)
 children, _ = find_children(u_regions, id_to_region_dictionary_ALLNAME, is_leaf,
                             region_dictionary_to_id_ALLNAME_parent, region_dictionary_to_id_ALLNAME)
 ids_prot = []
@@ -39,21 +100,25 @@ ids_mol = return_ids_containing_str_list(["Cerebellar cortex", "molecular"], Tru
 ids_FT = return_ids_containing_str_list(["cerebellum related fiber tracts"], True)
 
 for i, id_ in enumerate(ids_mol[1:]):
-    print(i, region_dictionary_to_id_parent[id_to_region_dictionary[id_]])
+    lobule_name = region_dictionary_to_id_parent[id_to_region_dictionary[id_]]
+    print(i, lobule_name, "({} voxels)".format(
+        voxel_counts.get(region_dictionary_to_id[lobule_name], 0)))
 
 i = int(input("Enter the number of the region to correct "))
 if i + 1 >= len(ids_mol):
     raise Exception("Incorrect region number")
 id_mol = ids_mol[i + 1]
 parent_name = region_dictionary_to_id_parent[id_to_region_dictionary[id_mol]]
+region_name = parent_name
 print("You have selected:")
 print(i, parent_name)
 print("")
-axes = ["coronal", "axial", "sagittal"]
+axes = ["coronal", "axial", "sagittal", "all (multi-planar)"]
 for i, id_ in enumerate(axes):
     print(i, id_)
 i = int(input("Enter the number of the axis to display "))
-axis = i
+axis = [0, 1, 2] if i == 3 else i
+first_axis = 0 if i == 3 else i
 print("You have selected:")
 print(i, axes[i])
 
@@ -64,14 +129,38 @@ parent_name = region_dictionary_to_id_ALLNAME_parent[id_to_region_dictionary_ALL
 last_name = parent_name[parent_name.rfind("|") + 1:]
 id_gr = region_dictionary_to_id_ALLNAME[parent_name + "|" + last_name + ", granular layer"]
 
-paintAppli = PaintAnnotations(ann, nissl,
-                              {
-                                  "mol": [id_mol],
-                                  "gl": [id_gr],
-                                  "fib": ids_FT,
-                                  "out": [0],
-                                  "prot": ids_prot
-                              }, axis, backup=backup)
+dict_reg_ids = {
+    "mol": [id_mol],
+    "gl": [id_gr],
+    "fib": ids_FT,
+    "out": [0],
+    "prot": ids_prot
+}
+session_cache = SessionCache(session_folder)
+
+
+def load_state(dict_reg_ids_, axis_):
+    # The cached states cover the whole volume: they are not used with a memory budget.
+    if memory_budget is not None:
+        return None
+    return session_cache.load_or_prepare([annotation_filename, nissl_filename, backup_filename],
+                                         ann, dict_reg_ids_, nissl, axis_, backup, processes)
+
+
+# Other lobules can be opened from the application without reloading the volumes.
+regions = cerebellar_layer_ids(get_hierarchy(), protected_regions)
+paintAppli = PaintAnnotations(ann, nissl, dict_reg_ids, axis, backup=backup,
+                              state=load_state(dict_reg_ids, first_axis), regions=regions,
+                              region=region_name, load_state=load_state,
+                              memory_budget=memory_budget, processes=processes, storage=storage)
 
 ann = paintAppli.get_annotations()
-save_nrrd_npy_file(output_filename, ann, header=DEFAULT_HEADER)
+if output_filename.endswith(".npy") and annotation_filename.endswith(".npy"):
+    # Only the voxels changed in this session are saved, keeping the corrections saved meanwhile
+    # by the other editors of the file.
+    n_changed = merge_npy_changes(output_filename, ann, original)
+    print("Saved {} changed voxels in {}".format(n_changed, output_filename))
+else:
+    save_nrrd_npy_file(output_filename, ann, header=DEFAULT_HEADER)
+if shared is not None:
+    shared.close()